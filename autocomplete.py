@@ -0,0 +1,202 @@
+# Подсказки имен схем, таблиц и колонок: inline-режим и клавиатура в диалогах.
+# Имена хранятся в отсортированных массивах, поиск по префиксу - bisect, без обращений к базе.
+# Индекс строится из кэша схемы (schema_cache) и после DDL обновляется только для измененной таблицы
+import logging
+from bisect import bisect_left
+
+import schema_cache
+from db import on_release
+
+# Сколько подсказок показывается на клавиатуре и в inline-режиме (у Telegram не больше 50)
+KEYBOARD_SUGGESTIONS = 12
+INLINE_SUGGESTIONS = 50
+
+# Сколько секунд Telegram может кэшировать ответ на inline-запрос (ответ у каждого пользователя свой)
+INLINE_CACHE_TIME = 5
+
+
+class SortedNames:
+    """Отсортированный без учета регистра список имен с поиском по префиксу."""
+    __slots__ = ('keys', 'names')
+
+    def __init__(self, names=()):
+        pairs = sorted((name.lower(), name) for name in set(names))
+        self.keys = [key for key, _ in pairs]
+        self.names = [name for _, name in pairs]
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        key = name.lower()
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if self.names[i] == name:
+                return
+            i += 1
+        self.keys.insert(i, key)
+        self.names.insert(i, name)
+
+    def remove(self, name):
+        key = name.lower()
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if self.names[i] == name:
+                del self.keys[i]
+                del self.names[i]
+                return
+            i += 1
+
+    def prefixed(self, prefix, limit):
+        prefix = prefix.lower()
+        i = bisect_left(self.keys, prefix)
+        found = []
+        while i < len(self.keys) and len(found) < limit and self.keys[i].startswith(prefix):
+            found.append(self.names[i])
+            i += 1
+        return found
+
+    def similar(self, name, limit):
+        """Имена с самым длинным общим с name началом - подсказка после опечатки."""
+        for length in range(len(name), min(len(name), 2) - 1, -1):
+            found = self.prefixed(name[:length], limit)
+            if found:
+                return found
+        return []
+
+
+class SchemaIndex:
+    """Индекс имен одного подключения: таблицы (все и по схемам) и колонки таблиц."""
+    __slots__ = ('tables', 'table_names', 'schema_tables', 'columns')
+
+    def __init__(self, tables):
+        # tables - словарь из schema_cache; по нему видно, что кэш схемы был перезагружен
+        self.tables = tables
+        self.table_names = SortedNames(tables)
+        self.schema_tables = {}
+        self.columns = {}
+        for table_name, table in tables.items():
+            self._add(table_name, table)
+
+    def _add(self, table_name, table):
+        self.schema_tables.setdefault(table['schema'], SortedNames()).add(table_name)
+        self.columns[table_name] = SortedNames(col['column_name'] for col in table['columns'])
+
+    def _remove(self, table_name):
+        self.columns.pop(table_name, None)
+        for schema, names in list(self.schema_tables.items()):
+            names.remove(table_name)
+            if not names:
+                del self.schema_tables[schema]
+
+    def update_table(self, table_name, table):
+        """Заменяет таблицу в индексе после DDL; table=None - таблицы больше нет."""
+        self._remove(table_name)
+        if table is None:
+            self.table_names.remove(table_name)
+        else:
+            self.table_names.add(table_name)
+            self._add(table_name, table)
+
+
+# user_id -> SchemaIndex
+_indexes = {}
+
+
+async def load(user_id):
+    """Строит индекс пользователя, если его нет или кэш схемы перезагружен.
+
+    Каталог читается только при загрузке кэша схемы (не чаще раза в SCHEMA_TTL).
+    Ошибка загрузки не мешает диалогу: подсказок просто не будет.
+    """
+    try:
+        tables = await schema_cache.get_tables(user_id)
+    except Exception as e:
+        logging.warning(f"Не удалось загрузить схему для подсказок: {e}")
+        return None
+    index = _indexes.get(user_id)
+    if index is None or index.tables is not tables:
+        index = _indexes[user_id] = SchemaIndex(tables)
+    return index
+
+
+async def refresh_table(user_id, table_name):
+    """После DDL перечитывает из каталога одну таблицу и обновляет кэш схемы и индекс."""
+    refreshed = False
+    try:
+        table = await schema_cache.refresh_table(user_id, table_name)
+        index = _indexes.get(user_id)
+        if index is not None and index.tables is schema_cache.cached_tables(user_id):
+            index.update_table(table_name, table)
+        refreshed = True
+    except Exception as e:
+        logging.warning(f"Не удалось обновить схему таблицы {table_name}: {e}")
+    finally:
+        if not refreshed:
+            forget(user_id)
+
+
+def forget(user_id):
+    """Сбрасывает индекс и кэш схемы (смена подключения)."""
+    _indexes.pop(user_id, None)
+    schema_cache.invalidate(user_id)
+
+
+@on_release
+def _release(user_id):
+    # Индекс строится из кэша схемы и освобождается вместе с ним
+    _indexes.pop(user_id, None)
+
+
+def suggest_tables(user_id, prefix='', limit=KEYBOARD_SUGGESTIONS):
+    index = _indexes.get(user_id)
+    return index.table_names.prefixed(prefix, limit) if index else []
+
+
+def suggest_columns(user_id, table_name, prefix='', limit=KEYBOARD_SUGGESTIONS):
+    index = _indexes.get(user_id)
+    names = index.columns.get(table_name) if index else None
+    return names.prefixed(prefix, limit) if names else []
+
+
+def similar_tables(user_id, table_name, limit=KEYBOARD_SUGGESTIONS):
+    index = _indexes.get(user_id)
+    return index.table_names.similar(table_name, limit) if index else []
+
+
+def similar_columns(user_id, table_name, column_name, limit=KEYBOARD_SUGGESTIONS):
+    index = _indexes.get(user_id)
+    names = index.columns.get(table_name) if index else None
+    return names.similar(column_name, limit) if names else []
+
+
+def suggest(user_id, query, table_name=None, limit=INLINE_SUGGESTIONS):
+    """Подсказки для inline-запроса: список (вид, имя, пояснение).
+
+    "префикс" - таблицы (или колонки table_name, если диалог ждет колонку),
+    "схема.префикс" - таблицы схемы, "таблица.префикс" - колонки таблицы.
+    """
+    index = _indexes.get(user_id)
+    if index is None:
+        return []
+    query = query.strip()
+
+    if '.' in query:
+        owner, prefix = query.split('.', 1)
+        schema = next((name for name in index.schema_tables if name.lower() == owner.lower()), None)
+        if schema is not None:
+            return [('table', name, f"таблица в схеме {schema}")
+                    for name in index.schema_tables[schema].prefixed(prefix, limit)]
+        # Точное совпадение без учета регистра идет первым среди имен с этим префиксом
+        table = next((name for name in index.table_names.prefixed(owner, 1) if name.lower() == owner.lower()), None)
+        if table is not None:
+            return [('column', name, f"колонка таблицы {table}")
+                    for name in index.columns[table].prefixed(prefix, limit)]
+        return []
+
+    if table_name is not None and table_name in index.columns:
+        return [('column', name, f"колонка таблицы {table_name}")
+                for name in index.columns[table_name].prefixed(query, limit)]
+
+    return [('table', name, f"таблица в схеме {index.tables[name]['schema']}")
+            for name in index.table_names.prefixed(query, limit)]
@@ -1,9 +1,38 @@
 
 import logging
-from aiogram import Bot, Dispatcher, types, Router
+import os
+from contextlib import aclosing
+from aiogram import Bot, Dispatcher, types, Router, F
 from aiogram.filters import Command
 import asyncio
-from db import connect_to_db, close_connection, execute, fetch
+import signal
+import tempfile
+import time
+from db import (connect_to_db, close_connection, execute, fetch, iterate, is_connected, start_pool_reaper,
+                cancel_queries, cancel_all_queries, command_timeout, parse_replicas, replica_status,
+                start_replica_monitor, save_connection, saved_connections, is_active_connection,
+                use_saved_connection, forget_saved_connection, explain_query, connection_target,
+                run_transaction, TransactionStepError)
+from paging import build_page_query, read_page_rows, render_page
+import schema_cache
+import autocomplete
+import sql
+from coercion import coerce_value
+import bulk_insert
+import export
+import webhook
+import shards
+import jobs
+import result_cache
+import stats
+import fanout
+import explain
+import transactions
+import metrics
+import offload
+from sender import reply, start_sender, stop_sender
+from dialogs import close_dialogs, dialog_step, dispatch, end_dialog, get_dialog, save_dialog, start_dialog
+from sessions import MemorySessionStore
 from config import API_TOKEN
 
 # Логирование
@@ -16,104 +45,263 @@ dp = Dispatcher()
 # Создаем маршрутизатор для команд
 router = Router()
 
-# Храним параметры подключения для каждого пользователя
-user_db_params = {}  # для хранения параметров подключения к БД
-user_db_states = {}  # для отслеживания состояния подключения к БД
+# Маршрутизатор для шагов диалогов подключается после команд,
+# поэтому команда всегда прерывает незавершенный диалог
+dialog_router = Router()
 
-# Отдельно храним параметры для создания таблиц
-user_table_params = {}  # для хранения параметров создания таблицы
-user_table_states = {}  # для отслеживания состояния создания таблицы
+# Время обработки и ошибки команд; шаги диалогов замеряются в dialogs.dispatch
+router.message.middleware(metrics.HandlerMetricsMiddleware())
+router.callback_query.middleware(metrics.HandlerMetricsMiddleware())
+router.inline_query.middleware(metrics.HandlerMetricsMiddleware())
 
-# Отдельно храним параметры для изменения таблиц
-user_alter_params = {}  # для хранения параметров изменения таблицы
-user_alter_states = {}  # для отслеживания состояния изменения таблицы
+# Telegram id пользователей, которым доступны служебные команды (/metrics, /stop), через запятую
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
 
-# Отдельно храним параметры для вставки данных
-user_insert_params = {}  # для хранения параметров вставки данных
-user_insert_states = {}  # для отслеживания состояния вставки данных
+# Параметры подключения хранятся только в db и забываются, когда пул закрывается по простою.
+# Состояние пошаговых диалогов хранится в dialogs.user_dialogs: одна запись на пользователя
 
-# Отдельно храним параметры для выборки данных
-user_select_params = {}
-user_select_states = {}
+# Сколько секунд можно листать результаты выборки
+SELECT_PAGES_TTL = 600
 
-user_update_params = {}
-user_update_states = {}
+# Страницы результатов выборки для листания кнопками (с TTL, как и диалоги)
+user_select_pages = MemorySessionStore(ttl=SELECT_PAGES_TTL)
+
+# Сколько строк просматривается и сколько значений показывается при выборе значения в /update
+UPDATE_SAMPLE_ROWS = 1000
+UPDATE_SHOWN_VALUES = 20
+
+# До какого числа подсчитываются строки, которые изменит /update
+UPDATE_COUNT_LIMIT = 10000
 
 # Шаги для ввода параметров подключения
-DB_STATE_STEP = ["user", "password", "database", "host", "port"]
+DB_STATE_STEP = ["user", "password", "database", "host", "port", "replicas"]
+
+# Подсказки для шагов, у которых недостаточно названия параметра
+DB_STEP_PROMPTS = {
+    'replicas': "Введите read-реплики через запятую в формате host[:port] или '-', если их нет:",
+}
 
-# Переменная для остановки бота
-stop_polling = False
+# Событие остановки бота: по нему webhook-сервер или polling завершают работу,
+# дождавшись уже принятых обновлений
+stop_event = asyncio.Event()
+
+# HTTP-сервер с метриками для Prometheus, если задан METRICS_PORT
+metrics_runner = None
 
 # Подключение к базе данных при старте бота
 async def on_startup():
+    global metrics_runner
+    start_pool_reaper()
+    start_replica_monitor()
+    transactions.start_transaction_reaper()
+    # У каждого рабочего процесса свой порт метрик: METRICS_PORT + номер процесса
+    metrics_port = metrics.METRICS_PORT
+    if metrics_port and shards.worker_index is not None:
+        metrics_port += shards.worker_index
+    metrics_runner = await metrics.start_metrics_server(port=metrics_port)
+    offload.start_render_pool()
+    start_sender(bot)
+    jobs.start_jobs(bot)
     logging.info("Бот запущен.")
 
 
-# Отключение от базы данных при завершении работы бота
+# Закрытие всех пулов соединений при завершении работы бота
 async def on_shutdown():
+    await cancel_all_queries()
+    transactions.stop_transaction_reaper()
+    await jobs.stop_jobs()
+    await result_cache.close_listeners()
+    await stop_sender()
+    offload.stop_render_pool()
     await close_connection()
+    close_dialogs()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
     logging.info("Бот завершил работу и подключение к базе данных закрыто.")
 
 @router.message(Command("help"))
 async def send_help(message: types.Message):
     help_text = (
         "/start - Запуск бота.\n"
-        "/connect - Подключение к базе данных. Пошагово вводятся параметры: пользователь, пароль, БД, хост и порт.\n"
+        "/connect - Подключение к базе данных. Пошагово вводятся параметры: пользователь, пароль, БД, хост, порт и необязательный список read-реплик.\n"
         "/create_table - Создание новой таблицы. Введите название таблицы, колонки и их типы данных.\n"
         "/alter_table - Изменение существующей таблицы. Позволяет добавить или удалить колонки.\n"
-        "/insert - Вставка данных в таблицу. Выбираете колонку, вводите значения, можно ввести несколько значений.\n"
+        "/insert - Вставка данных в таблицу. Выбираете колонку и вводите значение или вводите 'bulk' для массовой загрузки строк текстом или CSV/TSV-файлом.\n"
         "/select - Выборка данных из таблицы. Позволяет просмотреть все данные из указанной таблицы.\n"
+        "/export - Выгрузка таблицы или выбранных колонок в файл (CSV, CSV.gz, JSON Lines, Parquet).\n"
+        "/save_connection <имя> - Сохранить текущее подключение под именем; /connections - список, /use <имя> - переключиться, /drop_connection <имя> - удалить.\n"
+        "/fanout <имя1,имя2,...|all> <SELECT ...> - Выполнить запрос на чтение сразу на нескольких сохраненных подключениях.\n"
+        "/begin - Начать транзакцию: изменения /insert, /update и /alter_table копятся и применяются вместе по /commit; /rollback [N] - отменить все шаги или шаги начиная с N.\n"
+        "/stats <таблица> [exact] - Сводка по колонкам таблицы: число строк, доля NULL, различные и частые значения, min/max. С 'exact' строки и min/max считаются точно проходом по таблице.\n"
         "/update - Обновление данных в таблице. Выбираете колонку и обновляете значения существующих записей.\n"
-        "/stop - Остановка бота.\n"
-        "/help - Выводит список всех доступных команд."
+        "/explain <select|insert|update> - Тот же диалог, но вместо результата - план запроса (EXPLAIN ANALYZE) со сводкой затратных узлов; изменения откатываются.\n"
+        "/profile <таблица> - История времени запросов к таблице и замеченные замедления.\n"
+        "/jobs - Список фоновых задач (массовая загрузка, экспорт, изменение таблиц).\n"
+        "/job <id> - Состояние и результат фоновой задачи.\n"
+        "/cancel - Отмена текущей операции, выполняющегося запроса и фоновых задач (или просто напишите 'отмена').\n"
+        "/metrics - Сводка метрик: время команд и запросов, ошибки (только для администраторов).\n"
+        "/stop - Остановка бота (только для администраторов).\n"
+        "/help - Выводит список всех доступных команд.\n\n"
+        "Имена таблиц и колонок можно выбирать на клавиатуре подсказок или в inline-режиме: "
+        "наберите @имя_бота и начало имени ('таблица.' - колонки таблицы, 'схема.' - таблицы схемы)."
     )
-    await message.answer(help_text)
+    reply(message, help_text)
 
 # Команда для начала ввода параметров подключения
 @router.message(Command("connect"))
 async def start_db_connection(message: types.Message):
     user_id = message.from_user.id
-    user_db_params[user_id] = {}
-    user_db_states[user_id] = 0  # Начинаем с первого шага
-    await message.answer("Введите имя пользователя для подключения к базе данных:")
+    start_dialog(user_id, 'connect', DB_STATE_STEP[0])  # Начинаем с первого шага
+    reply(message, "Введите имя пользователя для подключения к базе данных:")
 
 
 # Обработка ввода параметров подключения
-@router.message(lambda message: message.from_user.id in user_db_states)
-async def handle_db_params(message: types.Message):
+async def handle_db_params(message: types.Message, dialog):
     user_id = message.from_user.id
-    step = user_db_states[user_id]
+    step = DB_STATE_STEP.index(dialog.step)
 
     # Сохраняем введенный параметр
     current_param = DB_STATE_STEP[step]
-    user_db_params[user_id][current_param] = message.text
+    dialog.params[current_param] = message.text
 
     step += 1
 
     # Если шаги еще не завершены, запрашиваем следующий параметр
     if step < len(DB_STATE_STEP):
-        user_db_states[user_id] = step
+        dialog.step = DB_STATE_STEP[step]
         next_param = DB_STATE_STEP[step]
-        await message.answer(f"Введите {next_param}:")
+        reply(message, DB_STEP_PROMPTS.get(next_param, f"Введите {next_param}:"))
     else:
-        # Все параметры получены, пытаемся подключиться
+        # Все параметры получены, пытаемся подключиться.
+        # Запросы на чтение пойдут на доступные реплики, запись - на основной сервер
+        dialog.params['replicas'] = parse_replicas(dialog.params['replicas'], dialog.params['port'])
         try:
-            await connect_to_db(user_db_params[user_id])  # Пытаемся подключиться с введенными параметрами
-            await message.answer("Подключение к базе данных успешно установлено!")
+            await connect_to_db(user_id, dialog.params)  # Пытаемся подключиться с введенными параметрами
+            autocomplete.forget(user_id)
+            await autocomplete.load(user_id)  # Индекс имен для подсказок
+            replicas = replica_status(user_id)
+            if replicas:
+                healthy = sum(1 for _, is_healthy, _ in replicas if is_healthy)
+                reply(message, f"Подключение к базе данных успешно установлено! Доступно реплик: {healthy} из {len(replicas)}.")
+            else:
+                reply(message, "Подключение к базе данных успешно установлено!")
         except Exception as e:
             logging.error(f"Ошибка подключения к базе данных: {e}")
-            await message.answer("Не удалось подключиться к базе данных. Проверьте параметры подключения.")
-            user_db_params.pop(user_id)
+            reply(message, "Не удалось подключиться к базе данных. Проверьте параметры подключения.")
 
         # Сбрасываем состояние пользователя после подключения
-        user_db_states.pop(user_id, None)
+        end_dialog(user_id)
+
+
+# Каждый шаг ввода параметров подключения обрабатывается одной функцией
+for db_step in DB_STATE_STEP:
+    dialog_step('connect', db_step)(handle_db_params)
+
+
+# Сохраненные подключения: текущее подключение запоминается под именем, чтобы переключаться
+# между базами без повторного ввода параметров и выполнять запросы сразу на нескольких (/fanout)
+@router.message(Command("save_connection"))
+async def save_current_connection(message: types.Message):
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    if len(args) != 1:
+        reply(message, "Использование: /save_connection <имя>")
+        return
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+        return
+    try:
+        save_connection(user_id, args[0])
+    except ValueError as e:
+        reply(message, str(e))
+        return
+    reply(message, f"Подключение сохранено как '{args[0]}'. Переключиться на него: /use {args[0]}")
+
+
+@router.message(Command("connections"))
+async def list_connections(message: types.Message):
+    user_id = message.from_user.id
+    saved = saved_connections(user_id)
+    if not saved:
+        reply(message, "Сохраненных подключений нет. Сохраните текущее командой /save_connection <имя>.")
+        return
+    lines = [f"{'* ' if is_active_connection(user_id, name) else ''}{name}: {target}" for name, target in saved.items()]
+    reply(message, "Сохраненные подключения (* - текущее):\n" + "\n".join(lines))
+
+
+@router.message(Command("use"))
+async def use_connection(message: types.Message):
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    if len(args) != 1:
+        reply(message, "Использование: /use <имя>")
+        return
+    try:
+        await use_saved_connection(user_id, args[0])
+    except KeyError:
+        reply(message, f"Подключение '{args[0]}' не найдено. Список подключений: /connections")
+        return
+    except Exception as e:
+        logging.error(f"Ошибка подключения к базе данных: {e}")
+        reply(message, f"Не удалось подключиться к '{args[0]}'.")
+        return
+    end_dialog(user_id)
+    user_select_pages.delete(user_id)
+    autocomplete.forget(user_id)
+    await autocomplete.load(user_id)
+    reply(message, f"Текущее подключение: '{args[0]}'.")
+
+
+@router.message(Command("drop_connection"))
+async def drop_connection(message: types.Message):
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    if len(args) != 1:
+        reply(message, "Использование: /drop_connection <имя>")
+        return
+    if await forget_saved_connection(user_id, args[0]):
+        reply(message, f"Подключение '{args[0]}' удалено.")
+    else:
+        reply(message, f"Подключение '{args[0]}' не найдено.")
+
+
+# Один запрос на чтение сразу на нескольких сохраненных подключениях:
+# /fanout shard1,shard2 SELECT ... или /fanout all SELECT ...
+@router.message(Command("fanout"))
+async def fanout_query(message: types.Message):
+    user_id = message.from_user.id
+    args = message.text.split(maxsplit=2)
+    if len(args) != 3:
+        reply(message, "Использование: /fanout <имя1,имя2,...|all> <запрос SELECT>")
+        return
+
+    saved = saved_connections(user_id)
+    if not saved:
+        reply(message, "Сохраненных подключений нет. Сохраните подключения командой /save_connection <имя>.")
+        return
+    if args[1].lower() == 'all':
+        names = list(saved)
+    else:
+        names = list(dict.fromkeys(name.strip() for name in args[1].split(',') if name.strip()))
+    unknown = [name for name in names if name not in saved]
+    if unknown or not names:
+        reply(message, f"Подключения не найдены: {', '.join(unknown) or args[1]}. Список подключений: /connections")
+        return
+
+    query = fanout.validate_query(args[2])
+    if query is None:
+        reply(message, "Можно выполнить только один запрос на чтение (SELECT, WITH, VALUES или TABLE) без ';'.")
+        return
+
+    results, elapsed = await fanout.run_fanout(user_id, names, query)
+    text, options = await fanout.format_fanout(results, elapsed)
+    reply(message, text, **options)
 
 
 # Приветственная команда /start
 @router.message(Command("start"))
 async def send_welcome(message: types.Message):
-    await message.answer(
+    reply(message,
         "Привет! Я бот для взаимодействия с базой данных через DBeaver.\n"
         "Для подключения к базе данных введите команду /connect."
     )
@@ -121,70 +309,293 @@ async def send_welcome(message: types.Message):
 # Команда для остановки бота
 @router.message(Command("stop"))
 async def stop_bot(message: types.Message):
-    global stop_polling
-    await message.answer("Останавливаю бота...")
+    if message.from_user.id not in ADMIN_IDS:
+        reply(message, "Команда доступна только администраторам.")
+        return
+    reply(message, "Останавливаю бота...")
+    request_stop()
+
+
+def request_stop():
+    # В рабочем процессе останавливаются все процессы - через основной
+    if shards.worker_index is not None:
+        shards.request_stop()
+        return
+    # Закрытие пулов и сессии бота выполняется в main() после завершения обработки
+    stop_event.set()
+    if webhook.BOT_MODE != 'webhook':
+        asyncio.create_task(dp.stop_polling())
+
+
+# Отмена текущего диалога и выполняющихся запросов пользователя
+@router.message(Command("cancel"))
+@router.message(F.text.lower() == "отмена")
+async def cancel_operation(message: types.Message):
+    user_id = message.from_user.id
+    cancelled = cancel_queries(user_id)  # asyncpg отправляет серверу запрос на отмену
+    cancelled_jobs = jobs.cancel_user_jobs(user_id)
+    end_dialog(user_id)
+    user_select_pages.delete(user_id)
+
+    if cancelled or cancelled_jobs:
+        reply(message, f"Операция отменена, прервано запросов: {cancelled}, фоновых задач: {cancelled_jobs}.")
+    else:
+        reply(message, "Операция отменена.")
+
+
+# Транзакция из нескольких шагов: изменения копятся в transactions и применяются вместе по /commit
+@router.message(Command("begin"))
+async def begin_transaction(message: types.Message):
+    user_id = message.from_user.id
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+        return
+
+    transaction, created = transactions.begin(user_id, message.chat.id)
+    if not created:
+        reply(message, f"Транзакция уже открыта.\n{transaction.describe()}")
+        return
+    reply(message,
+        "Транзакция начата. Изменения /insert, /update и /alter_table не выполняются сразу, а копятся "
+        "и применяются одной транзакцией по /commit. /rollback отменяет все шаги, /rollback N - шаги начиная с N. "
+        f"Без новых шагов транзакция отменяется через {transactions.TRANSACTION_IDLE_TIMEOUT:g} с.")
+
+
+# Диалог изменения, начатый внутри /begin, помнит это: если транзакция истечет по простою
+# до последнего шага, изменение не должно молча выполниться сразу
+def transaction_params(user_id):
+    return {'in_transaction': True} if transactions.get(user_id) is not None else {}
+
+
+def transaction_expired(message: types.Message, dialog):
+    if dialog.params.get('explain') or not dialog.params.get('in_transaction'):
+        return False
+    if transactions.get(message.from_user.id) is not None:
+        return False
+    reply(message, "Транзакция истекла по простою, изменение не выполнено. "
+                   "Начните новую командой /begin и повторите команду.")
+    end_dialog(message.from_user.id)
+    return True
+
+
+def buffer_step(message: types.Message, query, args, description, table_name, ddl=False):
+    try:
+        number = transactions.add_step(message.from_user.id, query, args, description, table_name, ddl)
+    except ValueError as e:
+        reply(message, str(e))
+        return
+    reply(message, f"Шаг {number} добавлен в транзакцию: {description}.\n/commit - применить, /rollback - отменить.")
+
+
+@router.message(Command("commit"))
+async def commit_transaction(message: types.Message):
+    user_id = message.from_user.id
+    transaction = transactions.get(user_id)
+    if transaction is None:
+        reply(message, "Нет открытой транзакции. Начните ее командой /begin.")
+        return
+    if not transaction.steps:
+        transactions.discard(user_id)
+        reply(message, "Транзакция закрыта: в ней не было шагов.")
+        return
+    if transaction.target != connection_target(user_id):
+        reply(message, "Подключение изменилось после /begin, а шаги относятся к другой базе. "
+                       "Вернитесь к ней через /use или отмените транзакцию командой /rollback.")
+        return
+
+    # Пока транзакция выполняется, новые шаги в нее не попадают
+    transactions.discard(user_id)
+    steps = transaction.steps
+    started = time.perf_counter()
+    try:
+        await run_transaction(user_id, [(step.query, step.args) for step in steps],
+                              timeout=command_timeout('transaction'))
+    except TransactionStepError as e:
+        transactions.restore(user_id, transaction)
+        numbers = str(e.first) if e.first == e.last else f"{e.first}-{e.last}"
+        reply(message,
+            f"Ошибка на шаге {numbers} ({steps[e.first - 1].description}): {e}\n"
+            f"Транзакция откачена, изменения не применены. Шаги сохранены: /rollback {e.first} отменит "
+            "шаги начиная с ошибочного, после чего можно повторить /commit.")
+        return
+    except Exception as e:
+        logging.error(f"Ошибка выполнения транзакции: {e}")
+        transactions.restore(user_id, transaction)
+        reply(message, "Произошла ошибка при выполнении транзакции, изменения не применены. "
+                       "Повторите /commit или отмените транзакцию командой /rollback.")
+        return
+
+    for table_name in {step.table_name for step in steps}:
+        result_cache.invalidate_table(user_id, table_name)
+    for table_name in {step.table_name for step in steps if step.ddl}:
+        await autocomplete.refresh_table(user_id, table_name)
+    reply(message, f"Транзакция применена: шагов {len(steps)}, время {time.perf_counter() - started:.2f} с.")
+
 
-    stop_polling = True
-    await on_shutdown()
-    await bot.session.close()
-    logging.info("Бот остановлен.")
+@router.message(Command("rollback"))
+async def rollback_transaction(message: types.Message):
+    user_id = message.from_user.id
+    transaction = transactions.get(user_id)
+    if transaction is None:
+        reply(message, "Нет открытой транзакции.")
+        return
+
+    args = message.text.split()[1:]
+    if args:
+        if len(args) != 1 or not args[0].isdigit() or not 1 <= int(args[0]) <= len(transaction.steps):
+            reply(message, f"Использование: /rollback N, где N - номер шага от 1 до {len(transaction.steps)}.")
+            return
+        removed = transactions.rollback_to(user_id, int(args[0]))
+        reply(message, f"Отменено шагов: {removed}.\n{transaction.describe()}")
+        return
+
+    transactions.discard(user_id)
+    reply(message, f"Транзакция отменена, шагов не применено: {len(transaction.steps)}.")
+
+
+async def submit_job(message: types.Message, title, func):
+    # Тяжелая операция выполняется в фоне: обработчик сразу освобождается,
+    # а прогресс и результат появляются в отдельном сообщении задачи
+    try:
+        await jobs.submit(message.from_user.id, message.chat.id, title, func)
+    except jobs.QueueFullError as e:
+        reply(message, str(e))
+
+
+# Клавиатура с подсказками имен: нажатие кнопки отправляет имя обычным сообщением
+def suggestion_options(names, extra=()):
+    buttons = [types.KeyboardButton(text=name) for name in (*extra, *names)]
+    if not buttons:
+        return {}
+    keyboard = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    return {'reply_markup': types.ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True, one_time_keyboard=True)}
+
+
+def table_suggestions(user_id):
+    return suggestion_options(autocomplete.suggest_tables(user_id))
+
+
+def column_suggestions(user_id, table_name, extra=()):
+    return suggestion_options(autocomplete.suggest_columns(user_id, table_name), extra)
+
+
+# Таблица не найдена: если есть похожие имена, предлагаем их и ждем ввода заново,
+# иначе завершаем диалог
+def report_missing_table(message, table_name):
+    user_id = message.from_user.id
+    similar = autocomplete.similar_tables(user_id, table_name)
+    if similar:
+        reply(message,
+            f"Таблица '{table_name}' не найдена. Возможно, вы имели в виду: {', '.join(similar)}.\n"
+            "Введите название таблицы:", **suggestion_options(similar))
+    else:
+        reply(message, f"Таблица '{table_name}' не найдена.")
+        end_dialog(user_id)
+
+
+def report_missing_column(message, table_name, column_name, hint):
+    similar = autocomplete.similar_columns(message.from_user.id, table_name, column_name)
+    if similar:
+        reply(message,
+            f"Колонка '{column_name}' не найдена. Возможно, вы имели в виду: {', '.join(similar)}.\n{hint}",
+            **suggestion_options(similar))
+    else:
+        reply(message, f"Колонка '{column_name}' не найдена. {hint}")
+
+
+# Сводка метрик для администраторов; полный набор - в формате Prometheus на METRICS_PORT
+@router.message(Command("metrics"))
+async def show_metrics(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        reply(message, "Команда доступна только администраторам.")
+        return
+    reply(message, metrics.summary())
+
+
+# Список фоновых задач пользователя
+@router.message(Command("jobs"))
+async def list_jobs(message: types.Message):
+    user_jobs = jobs.user_jobs(message.from_user.id)
+    if not user_jobs:
+        reply(message, "Фоновых задач нет.")
+        return
+
+    lines = [f"#{job.id} {job.title}: {jobs.STATUS_TITLES[job.status]}" for job in user_jobs[-20:]]
+    reply(message, "Фоновые задачи:\n" + "\n".join(lines) + "\n\nПодробности: /job <id>")
+
+
+# Состояние и результат одной фоновой задачи
+@router.message(Command("job"))
+async def show_job(message: types.Message):
+    args = message.text.split(maxsplit=1)
+    if len(args) != 2 or not args[1].strip().lstrip('#').isdigit():
+        reply(message, "Укажите номер задачи: /job <id>")
+        return
+
+    job = jobs.get_job(int(args[1].strip().lstrip('#')))
+    if job is None or job.user_id != message.from_user.id:
+        reply(message, "Задача не найдена.")
+        return
+    reply(message, job.describe())
 
 
 # DDL - создание таблицы, где пользователь вводит параметры (используем отдельные переменные)
 @router.message(Command("create_table"))
 async def create_table(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in user_db_params:
-        await message.answer("Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
         return
 
-    await message.answer("Введите название таблицы для создания:")
+    reply(message, "Введите название таблицы для создания:")
 
     # Включаем пользователя в состояние ожидания имени таблицы
-    user_table_params[user_id] = {}  # Инициализируем параметры таблицы для этого пользователя
-    user_table_states[user_id] = 'waiting_table_name'
+    start_dialog(user_id, 'create_table', 'waiting_table_name')
 
 
 # Обработка ввода названия таблицы и параметров колонок
-@router.message(lambda message: message.from_user.id in user_table_states and user_table_states[
-    message.from_user.id] == 'waiting_table_name')
-async def handle_table_creation(message: types.Message):
+@dialog_step('create_table', 'waiting_table_name')
+async def handle_table_creation(message: types.Message, dialog):
     user_id = message.from_user.id
-    table_name = message.text
+    table_name = sql.normalize_ident(message.text)
 
     # Спрашиваем пользователя о колонках
-    await message.answer(f"Введите колонки для таблицы {table_name} в формате: column_name data_type, ...")
-    user_table_params[user_id]['table_name'] = table_name
-    user_table_states[user_id] = 'waiting_columns'
+    reply(message, f"Введите колонки для таблицы {table_name} в формате: column_name data_type, ...")
+    dialog.params['table_name'] = table_name
+    dialog.step = 'waiting_columns'
 
 
 # Обработка ввода колонок таблицы
-@router.message(lambda message: message.from_user.id in user_table_states and user_table_states[
-    message.from_user.id] == 'waiting_columns')
-async def handle_columns_creation(message: types.Message):
+@dialog_step('create_table', 'waiting_columns')
+async def handle_columns_creation(message: types.Message, dialog):
     user_id = message.from_user.id
     columns = message.text
 
-    table_name = user_table_params[user_id].get('table_name')
+    table_name = dialog.params.get('table_name')
 
     if not table_name:
-        await message.answer("Ошибка: не найдено название таблицы.")
-        user_table_states.pop(user_id, None)
+        reply(message, "Ошибка: не найдено название таблицы.")
+        end_dialog(user_id)
+        return
+
+    # Определения колонок передаются как есть, поэтому запрещаем несколько команд в одном запросе
+    if ';' in columns:
+        reply(message, "Определение колонок не должно содержать ';'. Введите колонки в формате: column_name data_type, ...")
         return
 
     # Создаем запрос для создания таблицы
-    create_table_query = f"CREATE TABLE IF NOT EXISTS {table_name} ({columns});"
+    create_table_query = sql.create_table_query(table_name, columns)
 
     try:
-        await execute(create_table_query)
-        await message.answer(f"Таблица '{table_name}' успешно создана с колонками: {columns}.")
+        await execute(user_id, create_table_query, timeout=command_timeout('ddl'))
+        await autocomplete.refresh_table(user_id, table_name)
+        reply(message, f"Таблица '{table_name}' успешно создана с колонками: {columns}.")
     except Exception as e:
         logging.error(f"Ошибка создания таблицы: {e}")
-        await message.answer(f"Ошибка при создании таблицы '{table_name}'.")
+        reply(message, f"Ошибка при создании таблицы '{table_name}'.")
 
     # После создания таблицы сбрасываем состояние
-    user_table_states.pop(user_id, None)
-    user_table_params.pop(user_id, None)
+    end_dialog(user_id)
 
 
 # DML - вставка данных в любую таблицу
@@ -192,498 +603,936 @@ async def handle_columns_creation(message: types.Message):
 @router.message(Command("insert"))
 async def start_insert_data(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in user_db_params:
-        await message.answer("Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
         return
 
-    await message.answer("Введите название таблицы, в которую хотите вставить данные:")
+    await autocomplete.load(user_id)
+    reply(message, "Введите название таблицы, в которую хотите вставить данные:", **table_suggestions(user_id))
 
     # Инициализируем параметры вставки данных
-    user_insert_params[user_id] = {}
-    user_insert_states[user_id] = 'waiting_table_name'
+    start_dialog(user_id, 'insert', 'waiting_table_name', transaction_params(user_id))
 
 
 # Обработка ввода названия таблицы для вставки данных
-@router.message(lambda message: message.from_user.id in user_insert_states and user_insert_states[message.from_user.id] == 'waiting_table_name')
-async def handle_insert_table_name(message: types.Message):
+@dialog_step('insert', 'waiting_table_name')
+async def handle_insert_table_name(message: types.Message, dialog):
     user_id = message.from_user.id
-    table_name = message.text.strip()
+    table_name = await schema_cache.resolve_table_name(user_id, message.text)
 
-    user_insert_params[user_id]['table_name'] = table_name
+    dialog.params['table_name'] = table_name
 
     try:
-        # Получаем список колонок и их типов данных
-        columns_query = f"""
-        SELECT column_name, data_type 
-        FROM information_schema.columns 
-        WHERE table_name = '{table_name}';
-        """
-        columns = await fetch(columns_query)
-
-        if not columns:
-            await message.answer(f"Таблица '{table_name}' не найдена.")
-            user_insert_states.pop(user_id, None)
-            user_insert_params.pop(user_id, None)
+        # Получаем список колонок и их типов данных из кэша схемы
+        table = await schema_cache.get_table(user_id, table_name)
+
+        if not table:
+            report_missing_table(message, table_name)
             return
 
         # Сохраняем информацию о колонках
-        user_insert_params[user_id]['available_columns'] = columns
+        columns = table['columns']
+        dialog.params['available_columns'] = columns
 
         # Формируем ответ для пользователя
         columns_info = "\n".join([f"{col['column_name']} ({col['data_type']})" for col in columns])
-        await message.answer(f"Таблица '{table_name}' содержит следующие колонки:\n{columns_info}\n\nВведите название колонки, в которую хотите вставить данные:")
+        dialog.params['schema'] = table['schema']
+        reply(message,
+            f"Таблица '{table_name}' содержит следующие колонки:\n{columns_info}\n\n"
+            "Введите название колонки, в которую хотите вставить данные.\n"
+            "Для массовой загрузки введите 'bulk' (все колонки) или 'bulk колонка1, колонка2, ...':",
+            **column_suggestions(user_id, table_name, extra=('bulk',)))
 
-        user_insert_states[user_id] = 'waiting_column_name'
+        dialog.step = 'waiting_column_name'
 
     except Exception as e:
         logging.error(f"Ошибка получения колонок таблицы: {e}")
-        await message.answer("Ошибка при получении информации о колонках таблицы.")
-        user_insert_states.pop(user_id, None)
-        user_insert_params.pop(user_id, None)
+        reply(message, "Ошибка при получении информации о колонках таблицы.")
+        end_dialog(user_id)
 
 
 # Обработка ввода названия колонки для вставки данных
-@router.message(lambda message: message.from_user.id in user_insert_states and user_insert_states[message.from_user.id] == 'waiting_column_name')
-async def handle_insert_column_name(message: types.Message):
+@dialog_step('insert', 'waiting_column_name')
+async def handle_insert_column_name(message: types.Message, dialog):
     user_id = message.from_user.id
     column_name = message.text.strip()
-    table_name = user_insert_params[user_id]['table_name']
+    table_name = dialog.params['table_name']
 
     # Проверяем, что колонка существует
-    available_columns = [col['column_name'] for col in user_insert_params[user_id]['available_columns']]
+    available_columns = [col['column_name'] for col in dialog.params['available_columns']]
+
+    # Массовая загрузка: bulk [колонка1, колонка2, ...]
+    if column_name.lower() == 'bulk' or column_name.lower().startswith('bulk '):
+        if dialog.params.get('explain'):
+            reply(message, "В режиме /explain массовая загрузка недоступна. Введите название одной колонки:")
+            return
+        if transaction_expired(message, dialog):
+            return
+        if transactions.get(user_id) is not None:
+            reply(message, "В транзакции массовая загрузка недоступна: она применяется пачками. "
+                           "Введите название одной колонки или выполните /commit:")
+            return
+        columns = [schema_cache.resolve_column_name(available_columns, col)
+                   for col in column_name[4:].split(',') if col.strip()] or available_columns
+        for col in columns:
+            if col not in available_columns:
+                report_missing_column(message, table_name, col, "Пожалуйста, выберите корректные колонки.")
+                return
+
+        udt_names = {col['column_name']: col['udt_name'] for col in dialog.params['available_columns']}
+        dialog.params['bulk_columns'] = columns
+        dialog.params['bulk_types'] = [udt_names[col] for col in columns]
+        reply(message,
+            f"Колонки для загрузки: {', '.join(columns)}.\n"
+            "Вставьте строки текстом (по одной на строку, значения через запятую или табуляцию) "
+            "или отправьте CSV/TSV-файл. Пустое значение записывается как NULL, "
+            "слово NULL - тоже, кроме текстовых колонок.")
+        dialog.step = 'waiting_bulk_data'
+        return
+
+    column_name = schema_cache.resolve_column_name(available_columns, column_name)
     if column_name not in available_columns:
-        await message.answer(f"Колонка '{column_name}' не найдена. Пожалуйста, выберите корректную колонку.")
+        report_missing_column(message, table_name, column_name, "Пожалуйста, выберите корректную колонку.")
         return
 
-    user_insert_params[user_id]['column_name'] = column_name
+    dialog.params['column_name'] = column_name
 
     # Получаем тип данных колонки
-    column_type = next(col['data_type'] for col in user_insert_params[user_id]['available_columns'] if col['column_name'] == column_name)
-    user_insert_params[user_id]['column_type'] = column_type
+    column = next(col for col in dialog.params['available_columns'] if col['column_name'] == column_name)
+    column_type = column['data_type']
+    dialog.params['column_type'] = column_type
+    dialog.params['udt_name'] = column['udt_name']
 
-    await message.answer(f"Вы выбрали колонку '{column_name}' с типом данных '{column_type}'. Введите значение:")
+    reply(message, f"Вы выбрали колонку '{column_name}' с типом данных '{column_type}'. Введите значение:")
 
-    user_insert_states[user_id] = 'waiting_value'
+    dialog.step = 'waiting_value'
 
 
 # Обработка ввода значения для вставки данных
-@router.message(lambda message: message.from_user.id in user_insert_states and user_insert_states[message.from_user.id] == 'waiting_value')
-async def handle_insert_value(message: types.Message):
+@dialog_step('insert', 'waiting_value')
+async def handle_insert_value(message: types.Message, dialog):
     user_id = message.from_user.id
     value = message.text.strip()
-    column_name = user_insert_params[user_id]['column_name']
-    table_name = user_insert_params[user_id]['table_name']
-    column_type = user_insert_params[user_id]['column_type']
+    column_name = dialog.params['column_name']
+    table_name = dialog.params['table_name']
+    column_type = dialog.params['column_type']
 
+    # Преобразуем значение в тип колонки до обращения к базе
     try:
-        # Преобразуем значение в нужный тип данных в зависимости от типа колонки
-        if column_type in ('integer', 'int4'):
-            value = int(value)
-        elif column_type in ('numeric', 'float8', 'double precision'):
-            value = float(value)
-        # Для строковых типов (text, varchar и т.д.) преобразование не нужно
-        # Пропускаем преобразование для этих типов
+        value = coerce_value(value, dialog.params['udt_name'])
+    except ValueError as e:
+        reply(message, f"Некорректное значение для типа данных '{column_type}' ({e}). Пожалуйста, введите корректное значение.")
+        return
+
+    if transaction_expired(message, dialog):
+        return
 
+    try:
         # Выполняем вставку данных
-        insert_query = f"INSERT INTO {table_name} ({column_name}) VALUES ($1);"
-        await execute(insert_query, value)
+        insert_query = sql.insert_query(table_name, (column_name,), dialog.params['schema'])
+        if dialog.params.get('explain'):
+            reply(message, await run_explain(user_id, table_name, 'insert', insert_query, (value,)))
+        elif transactions.get(user_id) is not None:
+            buffer_step(message, insert_query, (value,),
+                        f"вставка '{value}' в колонку '{column_name}' таблицы '{table_name}'", table_name)
+        else:
+            started = time.perf_counter()
+            await execute(user_id, insert_query, value, timeout=command_timeout('insert'))
+            explain.record(user_id, table_name, 'insert', time.perf_counter() - started, 1)
+            result_cache.invalidate_table(user_id, table_name)
 
-        await message.answer(f"Значение '{value}' успешно вставлено в колонку '{column_name}' таблицы '{table_name}'.")
-    except ValueError:
-        await message.answer(f"Некорректное значение для типа данных '{column_type}'. Пожалуйста, введите корректное значение.")
+            reply(message, f"Значение '{value}' успешно вставлено в колонку '{column_name}' таблицы '{table_name}'.")
     except Exception as e:
         logging.error(f"Ошибка вставки данных: {e}")
-        await message.answer("Произошла ошибка при вставке данных.")
+        reply(message, "Произошла ошибка при вставке данных.")
 
     # Очищаем состояние после вставки данных
-    user_insert_states.pop(user_id, None)
-    user_insert_params.pop(user_id, None)
+    end_dialog(user_id)
+
+# Обработка данных для массовой вставки: текст или CSV/TSV-документ
+@dialog_step('insert', 'waiting_bulk_data', accepts_files=True)
+async def handle_bulk_insert_data(message: types.Message, dialog):
+    user_id = message.from_user.id
+    params = dialog.params
+    table_name = params['table_name']
+    schema, columns, udt_names = params['schema'], params['bulk_columns'], params['bulk_types']
+
+    if not message.document and not message.text:
+        reply(message, "Отправьте строки текстом или CSV/TSV-файл.")
+        return
+
+    async def run_bulk_insert(job):
+        async def report_progress(inserted, processed):
+            await jobs.set_progress(job, f"Обработано строк: {processed}, вставлено: {inserted}...")
+
+        # Файл скачивается во временный файл и читается потоково, а не целиком в память
+        with tempfile.TemporaryFile() as tmp:
+            if message.document:
+                await bot.download(message.document, destination=tmp)
+                tmp.seek(0)
+                first_line = tmp.readline().decode('utf-8-sig', errors='ignore')
+                delimiter = bulk_insert.detect_delimiter(first_line, message.document.file_name)
+                stream = bulk_insert.file_stream(tmp)
+            else:
+                delimiter = bulk_insert.detect_delimiter(message.text.split('\n', 1)[0])
+                stream = bulk_insert.text_stream(message.text)
+
+            rows = bulk_insert.read_rows(stream, delimiter)
+            try:
+                inserted, error_count, errors = await bulk_insert.load_rows(
+                    user_id, schema, table_name, columns, udt_names, rows, report_progress)
+            finally:
+                # Пачки коммитятся по отдельности, поэтому сбрасываем кэш и при ошибке
+                result_cache.invalidate_table(user_id, table_name)
+
+        return bulk_insert.format_report(table_name, inserted, error_count, errors)
+
+    await submit_job(message, f"загрузка в {table_name}", run_bulk_insert)
+
+    # Очищаем состояние: загрузка продолжается в фоне
+    end_dialog(user_id)
 
 # DDL - изменение таблицы (добавление или удаление столбцов)
 @router.message(Command("alter_table"))
 async def alter_table(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in user_db_params:
-        await message.answer("Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
         return
 
-    await message.answer("Введите название таблицы, которую хотите изменить:")
+    await autocomplete.load(user_id)
+    reply(message, "Введите название таблицы, которую хотите изменить:", **table_suggestions(user_id))
 
     # Инициализируем параметры изменения таблицы
-    user_alter_params[user_id] = {}
-    user_alter_states[user_id] = 'waiting_table_name'
+    start_dialog(user_id, 'alter_table', 'waiting_table_name', transaction_params(user_id))
 
 # Обработка ввода названия таблицы для изменения
-@router.message(lambda message: message.from_user.id in user_alter_states and user_alter_states[
-    message.from_user.id] == 'waiting_table_name')
-async def handle_alter_table_name(message: types.Message):
+@dialog_step('alter_table', 'waiting_table_name')
+async def handle_alter_table_name(message: types.Message, dialog):
     user_id = message.from_user.id
-    table_name = message.text
+    table_name = await schema_cache.resolve_table_name(user_id, message.text)
 
     # Сохраняем название таблицы
-    user_alter_params[user_id]['table_name'] = table_name
-    await message.answer(
+    dialog.params['table_name'] = table_name
+    reply(message,
         f"Вы хотите добавить или удалить столбец из таблицы {table_name}? Введите 'add' для добавления или 'remove' для удаления.")
-    user_alter_states[user_id] = 'waiting_action'
+    dialog.step = 'waiting_action'
 
 # Обработка действия (добавить или удалить столбец)
-@router.message(lambda message: message.from_user.id in user_alter_states and user_alter_states[
-    message.from_user.id] == 'waiting_action')
-async def handle_alter_action(message: types.Message):
+@dialog_step('alter_table', 'waiting_action')
+async def handle_alter_action(message: types.Message, dialog):
     user_id = message.from_user.id
     action = message.text.lower()
 
     if action == 'add':
-        await message.answer("Введите название и тип данных нового столбца в формате: column_name data_type")
-        user_alter_states[user_id] = 'waiting_add_column'
+        reply(message, "Введите название и тип данных нового столбца в формате: column_name data_type")
+        dialog.step = 'waiting_add_column'
     elif action == 'remove':
-        await message.answer("Введите название столбца, который хотите удалить:")
-        user_alter_states[user_id] = 'waiting_remove_column'
+        reply(message, "Введите название столбца, который хотите удалить:",
+              **column_suggestions(user_id, dialog.params['table_name']))
+        dialog.step = 'waiting_remove_column'
     else:
-        await message.answer("Неверный ввод. Введите 'add' для добавления или 'remove' для удаления столбца.")
+        reply(message, "Неверный ввод. Введите 'add' для добавления или 'remove' для удаления столбца.")
 
 # Обработка добавления нового столбца
-@router.message(lambda message: message.from_user.id in user_alter_states and user_alter_states[
-    message.from_user.id] == 'waiting_add_column')
-async def handle_add_column(message: types.Message):
+@dialog_step('alter_table', 'waiting_add_column')
+async def handle_add_column(message: types.Message, dialog):
     user_id = message.from_user.id
-    column_info = message.text.split()
+    column_info = message.text.split(maxsplit=1)
 
-    if len(column_info) != 2:
-        await message.answer("Неверный формат. Введите данные в формате: column_name data_type")
+    if len(column_info) != 2 or not sql.is_valid_type(column_info[1]):
+        reply(message, "Неверный формат. Введите данные в формате: column_name data_type")
         return
 
-    column_name, data_type = column_info
-    table_name = user_alter_params[user_id].get('table_name')
+    column_name, data_type = sql.normalize_ident(column_info[0]), column_info[1]
+    table_name = dialog.params.get('table_name')
 
     if not table_name:
-        await message.answer("Ошибка: не найдено название таблицы.")
-        user_alter_states.pop(user_id, None)
+        reply(message, "Ошибка: не найдено название таблицы.")
+        end_dialog(user_id)
         return
 
-    try:
-        # Формируем запрос для добавления столбца
-        alter_query = f"ALTER TABLE {table_name} ADD COLUMN {column_name} {data_type};"
-        await execute(alter_query)
-        await message.answer(f"Столбец '{column_name}' успешно добавлен в таблицу '{table_name}'.")
-    except Exception as e:
-        logging.error(f"Ошибка добавления столбца: {e}")
-        await message.answer(f"Ошибка при добавлении столбца '{column_name}'.")
+    if transaction_expired(message, dialog):
+        return
+    if transactions.get(user_id) is not None:
+        buffer_step(message, sql.add_column_query(table_name, column_name, data_type), (),
+                    f"добавление столбца '{column_name}' ({data_type}) в таблицу '{table_name}'", table_name, ddl=True)
+        end_dialog(user_id)
+        return
+
+    # ALTER TABLE может ждать блокировку или переписывать таблицу, поэтому выполняется в фоне
+    async def run_add_column(job):
+        alter_query = sql.add_column_query(table_name, column_name, data_type)
+        try:
+            await execute(user_id, alter_query, timeout=command_timeout('ddl'))
+        finally:
+            await autocomplete.refresh_table(user_id, table_name)
+            result_cache.invalidate_table(user_id, table_name)
+        return f"Столбец '{column_name}' успешно добавлен в таблицу '{table_name}'."
+
+    await submit_job(message, f"добавление столбца {column_name}", run_add_column)
 
     # Очищаем состояния после добавления столбца
-    user_alter_states.pop(user_id, None)
-    user_alter_params.pop(user_id, None)
+    end_dialog(user_id)
 
 # Обработка удаления столбца
-@router.message(lambda message: message.from_user.id in user_alter_states and user_alter_states[
-    message.from_user.id] == 'waiting_remove_column')
-async def handle_remove_column(message: types.Message):
+@dialog_step('alter_table', 'waiting_remove_column')
+async def handle_remove_column(message: types.Message, dialog):
     user_id = message.from_user.id
-    column_name = message.text
-    table_name = user_alter_params[user_id].get('table_name')
+    table_name = dialog.params.get('table_name')
 
     if not table_name:
-        await message.answer("Ошибка: не найдено название таблицы.")
-        user_alter_states.pop(user_id, None)
+        reply(message, "Ошибка: не найдено название таблицы.")
+        end_dialog(user_id)
         return
 
-    try:
-        # Формируем запрос для удаления столбца
-        alter_query = f"ALTER TABLE {table_name} DROP COLUMN {column_name};"
-        await execute(alter_query)
-        await message.answer(f"Столбец '{column_name}' успешно удален из таблицы '{table_name}'.")
-    except Exception as e:
-        logging.error(f"Ошибка удаления столбца: {e}")
-        await message.answer(f"Ошибка при удалении столбца '{column_name}'.")
+    # Схема уже загружена при выборе таблицы
+    table = (schema_cache.cached_tables(user_id) or {}).get(table_name)
+    column_names = [col['column_name'] for col in table['columns']] if table else ()
+    column_name = schema_cache.resolve_column_name(column_names, message.text)
+
+    if transaction_expired(message, dialog):
+        return
+    if transactions.get(user_id) is not None:
+        buffer_step(message, sql.drop_column_query(table_name, column_name), (),
+                    f"удаление столбца '{column_name}' из таблицы '{table_name}'", table_name, ddl=True)
+        end_dialog(user_id)
+        return
+
+    async def run_drop_column(job):
+        alter_query = sql.drop_column_query(table_name, column_name)
+        try:
+            await execute(user_id, alter_query, timeout=command_timeout('ddl'))
+        finally:
+            await autocomplete.refresh_table(user_id, table_name)
+            result_cache.invalidate_table(user_id, table_name)
+        return f"Столбец '{column_name}' успешно удален из таблицы '{table_name}'."
+
+    await submit_job(message, f"удаление столбца {column_name}", run_drop_column)
 
     # Очищаем состояния после удаления столбца
-    user_alter_states.pop(user_id, None)
-    user_alter_params.pop(user_id, None)
+    end_dialog(user_id)
 
 # DML - получение данных из любой таблицы
 @router.message(Command("select"))
 async def start_select_data(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in user_db_params:
-        await message.answer("Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
         return
 
-    await message.answer("Введите название таблицы, из которой хотите получить данные:")
+    await autocomplete.load(user_id)
+    reply(message, "Введите название таблицы, из которой хотите получить данные:", **table_suggestions(user_id))
 
     # Инициализируем параметры выборки данных
-    user_select_params[user_id] = {}
-    user_select_states[user_id] = 'waiting_table_name'
+    start_dialog(user_id, 'select', 'waiting_table_name')
 
 # Обработка ввода названия таблицы для выборки данных
-@router.message(lambda message: message.from_user.id in user_select_states and user_select_states[
-    message.from_user.id] == 'waiting_table_name')
-async def handle_select_table_name(message: types.Message):
+@dialog_step('select', 'waiting_table_name')
+async def handle_select_table_name(message: types.Message, dialog):
     user_id = message.from_user.id
-    table_name = message.text
+    table_name = await schema_cache.resolve_table_name(user_id, message.text)
 
-    user_select_params[user_id]['table_name'] = table_name
+    dialog.params['table_name'] = table_name
 
     try:
-        # Получаем список колонок и их типов
-        columns_query = f"""
-        SELECT column_name 
-        FROM information_schema.columns 
-        WHERE table_name = '{table_name}';
-        """
-        columns = await fetch(columns_query)
-
-        if not columns:
-            await message.answer(f"Таблица '{table_name}' не найдена.")
-            user_select_states.pop(user_id, None)
-            user_select_params.pop(user_id, None)
+        # Получаем список колонок и первичный ключ из кэша схемы
+        table = await schema_cache.get_table(user_id, table_name)
+
+        if not table:
+            report_missing_table(message, table_name)
             return
 
-        # Сохраняем информацию о колонках
-        user_select_params[user_id]['available_columns'] = columns
+        # Сохраняем информацию о колонках и первичном ключе для пагинации
+        columns = table['columns']
+        dialog.params['available_columns'] = columns
+        dialog.params['schema'] = table['schema']
+        dialog.params['key_columns'] = table['primary_key']
 
         # Формируем ответ для пользователя
         columns_info = ", ".join([col['column_name'] for col in columns])
-        await message.answer(
-            f"Таблица '{table_name}' содержит следующие колонки:\n{columns_info}\n\nВыберите, хотите ли вы получить все данные из таблицы или выбрать конкретные колонки. Введите 'all' для всех данных или введите названия колонок через запятую:")
+        reply(message,
+            f"Таблица '{table_name}' содержит следующие колонки:\n{columns_info}\n\nВыберите, хотите ли вы получить все данные из таблицы или выбрать конкретные колонки. Введите 'all' для всех данных или введите названия колонок через запятую:",
+            **column_suggestions(user_id, table_name, extra=('all',)))
 
-        user_select_states[user_id] = 'waiting_column_choice'
+        dialog.step = 'waiting_column_choice'
 
     except Exception as e:
         logging.error(f"Ошибка получения колонок таблицы: {e}")
-        await message.answer("Ошибка при получении информации о колонках таблицы.")
-        user_select_states.pop(user_id, None)
-        user_select_params.pop(user_id, None)
+        reply(message, "Ошибка при получении информации о колонках таблицы.")
+        end_dialog(user_id)
+
+# Формирование одной страницы выборки: строки читаются из серверного курсора
+# начиная с ключа, на котором закончилась предыдущая страница.
+# Готовая страница сохраняется в result_cache, если он включен
+async def build_select_page(user_id, pager):
+    query, args = build_page_query(
+        pager['table_name'], pager['columns'], pager['key_columns'], pager['page_starts'][-1],
+        schema=pager['schema'])
+    cache_key = result_cache.make_key(user_id, query, args)
+    page = result_cache.get(cache_key)
+    if page is None:
+        started = time.perf_counter()
+        async with aclosing(iterate(user_id, query, *args, timeout=command_timeout('select'))) as records:
+            rows = await read_page_rows(records)
+        explain.record(user_id, pager['table_name'], 'select', time.perf_counter() - started, len(rows))
+        page = await render_page(rows, pager['columns'], pager['key_columns'])
+        await result_cache.put(user_id, cache_key, pager['table_name'], page, len(page[0]))
+    response, is_html, last_key, has_more = page
+    pager['next_key'] = last_key if has_more else None
+
+    page_number = len(pager['page_starts'])
+    if not response:
+        return "Записей пока нет.", {}
+
+    buttons = []
+    if page_number > 1:
+        buttons.append(types.InlineKeyboardButton(text="◀ Назад", callback_data="select:prev"))
+    if has_more:
+        buttons.append(types.InlineKeyboardButton(text="Далее ▶", callback_data="select:next"))
+    options = {'reply_markup': types.InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None}
+    if is_html:
+        options['parse_mode'] = 'HTML'
+    return f"Результаты выборки (страница {page_number}):\n{response}", options
+
 
 # Обработка выбора колонок для выборки данных
-@router.message(lambda message: message.from_user.id in user_select_states and user_select_states[
-    message.from_user.id] == 'waiting_column_choice')
-async def handle_column_choice_for_select(message: types.Message):
+@dialog_step('select', 'waiting_column_choice')
+async def handle_column_choice_for_select(message: types.Message, dialog):
     user_id = message.from_user.id
-    choice = message.text.strip().lower()
-    table_name = user_select_params[user_id]['table_name']
+    choice = message.text.strip()
+    table_name = dialog.params['table_name']
+    available_columns = [col['column_name'] for col in dialog.params['available_columns']]
 
     try:
-        if choice == 'all':
-            select_query = f"SELECT * FROM {table_name};"
+        if choice.lower() == 'all':
+            columns = available_columns
         else:
-            columns = choice.split(',')
-            columns = [col.strip() for col in columns if col.strip()]  # Убираем лишние пробелы
+            # Имена с клавиатуры совпадают точно, набранные вручную понимаются как в PostgreSQL
+            columns = [schema_cache.resolve_column_name(available_columns, col)
+                       for col in choice.split(',') if col.strip()]
 
             # Проверяем, что все указанные колонки существуют в таблице
-            available_columns = [col['column_name'] for col in user_select_params[user_id]['available_columns']]
             for col in columns:
                 if col not in available_columns:
-                    await message.answer(f"Колонка '{col}' не найдена. Пожалуйста, выберите корректные колонки.")
+                    report_missing_column(message, table_name, col, "Пожалуйста, выберите корректные колонки.")
                     return
 
-            select_query = f"SELECT {', '.join(columns)} FROM {table_name};"
+        if dialog.params.get('explain'):
+            query, args = build_page_query(table_name, columns, dialog.params['key_columns'],
+                                           schema=dialog.params['schema'])
+            reply(message, await run_explain(user_id, table_name, 'select', query, args, readonly=True))
+            end_dialog(user_id)
+            return
 
-        records = await fetch(select_query)
-
-        if records:
-            response = "\n".join([str(record) for record in records])
-            await message.answer(f"Результаты выборки:\n{response}")
-        else:
-            await message.answer("Записей пока нет.")
+        pager = {
+            'table_name': table_name,
+            'schema': dialog.params['schema'],
+            'columns': columns,
+            'key_columns': dialog.params['key_columns'],
+            'page_starts': [None],  # ключи, с которых начинаются открытые страницы
+            'next_key': None,
+        }
+        text, options = await build_select_page(user_id, pager)
+        user_select_pages.set(user_id, pager)
+        reply(message, text, **options)
 
     except Exception as e:
         logging.error(f"Ошибка получения записей: {e}")
-        await message.answer("Произошла ошибка при получении записей.")
+        reply(message, "Произошла ошибка при получении записей.")
 
     # Очищаем состояние после выборки данных
-    user_select_states.pop(user_id, None)
-    user_select_params.pop(user_id, None)
+    end_dialog(user_id)
+
+
+# Листание страниц выборки кнопками "Назад" / "Далее"
+@router.callback_query(F.data.in_({"select:prev", "select:next"}))
+async def handle_select_page(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    pager = user_select_pages.get(user_id)
+    if pager is None:
+        await callback.answer("Выборка устарела. Выполните /select заново.")
+        return
+
+    if callback.data == "select:next" and pager['next_key'] is not None:
+        pager['page_starts'].append(pager['next_key'])
+    elif callback.data == "select:prev" and len(pager['page_starts']) > 1:
+        pager['page_starts'].pop()
+    else:
+        await callback.answer()
+        return
+
+    try:
+        text, options = await build_select_page(user_id, pager)
+        await callback.message.edit_text(text, **options)
+        await callback.answer()
+    except Exception as e:
+        logging.error(f"Ошибка получения страницы выборки: {e}")
+        await callback.answer("Произошла ошибка при получении записей.")
+
+
+# Сводка по таблице: считается на сервере одним запросом по статистике планировщика
+@router.message(Command("stats"))
+async def show_table_stats(message: types.Message):
+    user_id = message.from_user.id
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+        return
+
+    args = message.text.split()[1:]
+    exact = len(args) == 2 and args[1].lower() == 'exact'
+    if len(args) != 1 and not exact:
+        reply(message, "Использование: /stats <таблица> [exact]")
+        return
+
+    table_name = await schema_cache.resolve_table_name(user_id, args[0])
+    try:
+        table = await schema_cache.get_table(user_id, table_name)
+        if not table:
+            reply(message, f"Таблица '{table_name}' не найдена.")
+            return
+        reply(message, await stats.table_stats(user_id, table_name, table, exact))
+    except Exception as e:
+        logging.error(f"Ошибка получения статистики таблицы: {e}")
+        reply(message, "Произошла ошибка при получении статистики таблицы.")
+
+
+# Экспорт данных таблицы в файл
+@router.message(Command("export"))
+async def start_export_data(message: types.Message):
+    user_id = message.from_user.id
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+        return
+
+    await autocomplete.load(user_id)
+    reply(message, "Введите название таблицы, которую хотите выгрузить:", **table_suggestions(user_id))
+
+    # Инициализируем параметры экспорта
+    start_dialog(user_id, 'export', 'waiting_table_name')
+
+
+# Обработка ввода названия таблицы для экспорта
+@dialog_step('export', 'waiting_table_name')
+async def handle_export_table_name(message: types.Message, dialog):
+    user_id = message.from_user.id
+    table_name = await schema_cache.resolve_table_name(user_id, message.text)
+
+    try:
+        table = await schema_cache.get_table(user_id, table_name)
+    except Exception as e:
+        logging.error(f"Ошибка получения колонок таблицы: {e}")
+        reply(message, "Ошибка при получении информации о колонках таблицы.")
+        end_dialog(user_id)
+        return
+
+    if not table:
+        report_missing_table(message, table_name)
+        return
+
+    columns = [col['column_name'] for col in table['columns']]
+    dialog.params['table_name'] = table_name
+    dialog.params['available_columns'] = columns
+    dialog.params['column_types'] = {col['column_name']: col['data_type'] for col in table['columns']}
+    dialog.params['schema'] = table['schema']
+
+    reply(message,
+        f"Таблица '{table_name}' содержит следующие колонки:\n{', '.join(columns)}\n\n"
+        "Введите 'all' для выгрузки всех колонок или названия колонок через запятую:",
+        **column_suggestions(user_id, table_name, extra=('all',)))
+    dialog.step = 'waiting_column_choice'
+
+
+# Обработка выбора колонок для экспорта
+@dialog_step('export', 'waiting_column_choice')
+async def handle_export_columns(message: types.Message, dialog):
+    user_id = message.from_user.id
+    choice = message.text.strip()
+    available_columns = dialog.params['available_columns']
+
+    if choice.lower() == 'all':
+        columns = available_columns
+    else:
+        columns = [schema_cache.resolve_column_name(available_columns, col)
+                   for col in choice.split(',') if col.strip()]
+        for col in columns:
+            if col not in available_columns:
+                report_missing_column(message, dialog.params['table_name'], col,
+                                      "Пожалуйста, выберите корректные колонки.")
+                return
+
+    dialog.params['columns'] = columns
+    reply(message, f"Выберите формат файла: {', '.join(export.available_formats())}")
+    dialog.step = 'waiting_format'
+
+
+# Обработка выбора формата и выгрузка файла
+@dialog_step('export', 'waiting_format')
+async def handle_export_format(message: types.Message, dialog):
+    user_id = message.from_user.id
+    export_format = message.text.strip().lower()
+    if export_format not in export.available_formats():
+        reply(message, f"Неизвестный формат. Доступные форматы: {', '.join(export.available_formats())}")
+        return
+
+    table_name = dialog.params['table_name']
+    columns = dialog.params['columns']
+    column_types = [dialog.params['column_types'][col] for col in columns]
+    select_query = sql.select_query(table_name, tuple(columns), dialog.params['schema'])
+
+    async def run_export(job):
+        # Строки читаются курсором порциями и сразу пишутся во временный файл,
+        # поэтому память ограничена размером порции, а не размером результата
+        with export.new_spool() as spool:
+            records = iterate(user_id, select_query, prefetch=export.EXPORT_CHUNK_ROWS,
+                              timeout=command_timeout('export'))
+            try:
+                async with aclosing(records):
+                    count = await export.EXPORT_WRITERS[export_format](records, columns, column_types, spool)
+            except export.ExportTooLargeError:
+                return "Файл получился больше 50 МБ и не может быть отправлен в Telegram. Выберите меньше колонок."
+
+            size = spool.tell()
+            if size > export.TELEGRAM_DOCUMENT_LIMIT:
+                return "Файл получился больше 50 МБ и не может быть отправлен в Telegram. Выберите меньше колонок."
+
+            await jobs.set_progress(job, f"Отправка файла, строк: {count}...")
+            document = export.SpooledInputFile(spool, filename=f"{table_name}.{export_format}")
+            await bot.send_document(message.chat.id, document, caption=f"Выгружено строк: {count}")
+            metrics.sent(size)
+        return f"Выгружено строк: {count}"
+
+    await submit_job(message, f"экспорт {table_name}", run_export)
+
+    # Очищаем состояние: выгрузка продолжается в фоне
+    end_dialog(user_id)
 
 
 # DML - обновление данных в любой колонке таблицы
 @router.message(Command("update"))
 async def start_update_data(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in user_db_params:
-        await message.answer("Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
         return
 
-    await message.answer("Введите название таблицы, в которой хотите обновить данные:")
+    await autocomplete.load(user_id)
+    reply(message, "Введите название таблицы, в которой хотите обновить данные:", **table_suggestions(user_id))
 
     # Инициализируем параметры обновления данных
-    user_update_params[user_id] = {}
-    user_update_states[user_id] = 'waiting_table_name'
+    start_dialog(user_id, 'update', 'waiting_table_name', transaction_params(user_id))
 
 
 # Обработка ввода названия таблицы для обновления данных
-@router.message(lambda message: message.from_user.id in user_update_states and user_update_states[
-    message.from_user.id] == 'waiting_table_name')
-async def handle_update_table_name(message: types.Message):
+@dialog_step('update', 'waiting_table_name')
+async def handle_update_table_name(message: types.Message, dialog):
     user_id = message.from_user.id
-    table_name = message.text.strip()
+    table_name = await schema_cache.resolve_table_name(user_id, message.text)
 
-    user_update_params[user_id]['table_name'] = table_name
+    dialog.params['table_name'] = table_name
 
     try:
-        # Получаем список колонок
-        columns_query = f"""
-        SELECT column_name 
-        FROM information_schema.columns 
-        WHERE table_name = '{table_name}';
-        """
-        columns = await fetch(columns_query)
-
-        if not columns:
-            await message.answer(f"Таблица '{table_name}' не найдена.")
-            user_update_states.pop(user_id, None)
-            user_update_params.pop(user_id, None)
+        # Получаем список колонок из кэша схемы
+        table = await schema_cache.get_table(user_id, table_name)
+
+        if not table:
+            report_missing_table(message, table_name)
             return
 
         # Сохраняем информацию о колонках
-        user_update_params[user_id]['available_columns'] = columns
+        columns = table['columns']
+        dialog.params['available_columns'] = columns
+        dialog.params['schema'] = table['schema']
 
         # Формируем ответ для пользователя
         columns_info = ", ".join([col['column_name'] for col in columns])
-        await message.answer(
-            f"Таблица '{table_name}' содержит следующие колонки:\n{columns_info}\n\nВведите название колонки, которую хотите обновить:")
+        reply(message,
+            f"Таблица '{table_name}' содержит следующие колонки:\n{columns_info}\n\nВведите название колонки, которую хотите обновить:",
+            **column_suggestions(user_id, table_name))
 
-        user_update_states[user_id] = 'waiting_column_name'
+        dialog.step = 'waiting_column_name'
 
     except Exception as e:
         logging.error(f"Ошибка получения колонок таблицы: {e}")
-        await message.answer("Ошибка при получении информации о колонках таблицы.")
-        user_update_states.pop(user_id, None)
-        user_update_params.pop(user_id, None)
+        reply(message, "Ошибка при получении информации о колонках таблицы.")
+        end_dialog(user_id)
+
+
+# Несколько различных значений колонки (по префиксу) из ограниченного числа строк,
+# чтобы не сканировать и не сортировать всю таблицу
+async def sample_column_values(user_id, dialog, prefix=''):
+    values_query = sql.sample_values_query(
+        dialog.params['table_name'], dialog.params['column_name'],
+        UPDATE_SAMPLE_ROWS, UPDATE_SHOWN_VALUES, dialog.params['schema'])
+    values = await fetch(user_id, values_query, sql.like_prefix(prefix), timeout=command_timeout('update'), readonly=True)
+    return [str(val['value']) for val in values]
 
 
 # Обработка ввода названия колонки для обновления данных
-@router.message(lambda message: message.from_user.id in user_update_states and user_update_states[
-    message.from_user.id] == 'waiting_column_name')
-async def handle_update_column_name(message: types.Message):
+@dialog_step('update', 'waiting_column_name')
+async def handle_update_column_name(message: types.Message, dialog):
     user_id = message.from_user.id
-    column_name = message.text.strip()
-    table_name = user_update_params[user_id]['table_name']
+    table_name = dialog.params['table_name']
+    column_name = schema_cache.resolve_column_name(
+        [col['column_name'] for col in dialog.params['available_columns']], message.text)
 
     # Проверяем, что колонка существует
-    available_columns = [col['column_name'] for col in user_update_params[user_id]['available_columns']]
-    if column_name not in available_columns:
-        await message.answer(f"Колонка '{column_name}' не найдена. Пожалуйста, выберите корректную колонку.")
+    column = next((col for col in dialog.params['available_columns'] if col['column_name'] == column_name), None)
+    if column is None:
+        report_missing_column(message, table_name, column_name, "Пожалуйста, выберите корректную колонку.")
         return
 
-    user_update_params[user_id]['column_name'] = column_name
+    dialog.params['column_name'] = column_name
+    dialog.params['cast_type'] = column['cast_type']
+    dialog.params['udt_name'] = column['udt_name']
+    dialog.params['column_type'] = column['data_type']
 
-    # Запрашиваем существующие значения в выбранной колонке для отображения пользователю
+    # Показываем пользователю несколько существующих значений колонки
     try:
-        values_query = f"SELECT DISTINCT {column_name} FROM {table_name};"
-        values = await fetch(values_query)
+        values = await sample_column_values(user_id, dialog)
 
         if not values:
-            await message.answer(f"Нет данных для колонки '{column_name}'.")
-            user_update_states.pop(user_id, None)
-            user_update_params.pop(user_id, None)
+            reply(message, f"Нет данных для колонки '{column_name}'.")
+            end_dialog(user_id)
             return
 
-        # Выводим найденные значения пользователю для выбора
-        values_info = ", ".join([str(val[column_name]) for val in values])
-        await message.answer(f"Колонка '{column_name}' содержит следующие значения:\n{values_info}\n\nВведите значение, которое хотите обновить:")
+        values_info = ", ".join(values)
+        reply(message,
+            f"Примеры значений колонки '{column_name}':\n{values_info}\n\n"
+            "Введите значение, которое хотите обновить, или '?префикс' для поиска значений:")
 
-        user_update_params[user_id]['available_values'] = values
-        user_update_states[user_id] = 'waiting_value_selection'
+        dialog.step = 'waiting_value_selection'
 
     except Exception as e:
         logging.error(f"Ошибка получения значений колонки: {e}")
-        await message.answer("Ошибка при получении значений колонки.")
-        user_update_states.pop(user_id, None)
-        user_update_params.pop(user_id, None)
+        reply(message, "Ошибка при получении значений колонки.")
+        end_dialog(user_id)
 
 
 # Обработка выбора значения для изменения
-@router.message(lambda message: message.from_user.id in user_update_states and user_update_states[
-    message.from_user.id] == 'waiting_value_selection')
-async def handle_value_selection(message: types.Message):
+@dialog_step('update', 'waiting_value_selection')
+async def handle_value_selection(message: types.Message, dialog):
     user_id = message.from_user.id
     selected_value = message.text.strip()
-    column_name = user_update_params[user_id]['column_name']
-    available_values = [str(val[column_name]) for val in user_update_params[user_id]['available_values']]
+    column_name = dialog.params['column_name']
+    table_name = dialog.params['table_name']
+
+    try:
+        # Поиск значений по префиксу
+        if selected_value.startswith('?'):
+            values = await sample_column_values(user_id, dialog, selected_value[1:])
+            if values:
+                reply(message, f"Найденные значения:\n{', '.join(values)}\n\nВведите значение, которое хотите обновить:")
+            else:
+                reply(message, "Значения с таким началом не найдены.")
+            return
+
+        # Подсчитываем (с ограничением) строки с этим значением; сравнение с приведенным
+        # параметром позволяет использовать индекс по колонке. Подсчет идет на основном сервере,
+        # как и следующий за ним UPDATE, чтобы отставание реплики не исказило число строк
+        count_query = sql.count_matching_query(
+            table_name, column_name, dialog.params['cast_type'], UPDATE_COUNT_LIMIT + 1, dialog.params['schema'])
+        rows = (await fetch(user_id, count_query, selected_value, timeout=command_timeout('update')))[0]['rows']
+    except Exception as e:
+        logging.error(f"Ошибка поиска значения: {e}")
+        reply(message, f"Значение '{selected_value}' не найдено. Пожалуйста, выберите корректное значение.")
+        return
 
     # Проверяем, что значение существует в колонке
-    if selected_value not in available_values:
-        await message.answer(f"Значение '{selected_value}' не найдено. Пожалуйста, выберите корректное значение.")
+    if rows == 0:
+        reply(message, f"Значение '{selected_value}' не найдено. Пожалуйста, выберите корректное значение.")
         return
 
-    user_update_params[user_id]['selected_value'] = selected_value
-    await message.answer(f"Вы выбрали значение '{selected_value}'. Введите новое значение для замены:")
+    rows_info = f"более {UPDATE_COUNT_LIMIT}" if rows > UPDATE_COUNT_LIMIT else str(rows)
+    dialog.params['selected_value'] = selected_value
+    reply(message,
+        f"Вы выбрали значение '{selected_value}'. Будет изменено строк: {rows_info}.\n"
+        "Введите новое значение для замены или 'отмена':")
 
-    user_update_states[user_id] = 'waiting_new_value'
+    dialog.step = 'waiting_new_value'
 
 
 # Обработка ввода нового значения для обновления данных
-@router.message(lambda message: message.from_user.id in user_update_states and user_update_states[
-    message.from_user.id] == 'waiting_new_value')
-async def handle_new_value(message: types.Message):
+@dialog_step('update', 'waiting_new_value')
+async def handle_new_value(message: types.Message, dialog):
     user_id = message.from_user.id
     new_value = message.text.strip()
-    column_name = user_update_params[user_id]['column_name']
-    table_name = user_update_params[user_id]['table_name']
-    selected_value = user_update_params[user_id]['selected_value']
+    column_name = dialog.params['column_name']
+    table_name = dialog.params['table_name']
+    selected_value = dialog.params['selected_value']
 
+    # Преобразуем новое значение в тип колонки до обращения к базе
     try:
-        # Получаем тип данных колонки
-        type_query = f"""
-        SELECT data_type 
-        FROM information_schema.columns 
-        WHERE table_name = '{table_name}' AND column_name = '{column_name}';
-        """
-        column_type = await fetch(type_query)
-
-        if not column_type:
-            await message.answer("Ошибка при получении типа данных колонки.")
-            return
-
-        data_type = column_type[0]['data_type']
+        new_value = coerce_value(new_value, dialog.params['udt_name'])
+    except ValueError as e:
+        reply(message, f"Некорректное значение для типа данных '{dialog.params['column_type']}' ({e}). Введите корректное значение:")
+        return
 
-        # Преобразуем новое значение в соответствующий тип
-        if data_type == 'integer':
-            try:
-                new_value = int(new_value)
-                selected_value = int(selected_value)  # Преобразуем выбранное значение в целое число
-            except ValueError:
-                await message.answer("Пожалуйста, введите корректное целое число.")
-                return
-        elif data_type == 'boolean':
-            if new_value.lower() in ['true', '1']:
-                new_value = True
-            elif new_value.lower() in ['false', '0']:
-                new_value = False
-            else:
-                await message.answer("Пожалуйста, введите 'true' или 'false'.")
-                return
-        # Обработка других типов данных
-        # Можно добавить дополнительные условия для других типов данных
+    if transaction_expired(message, dialog):
+        return
 
+    try:
         # Выполняем запрос на обновление данных
-        update_query = f"UPDATE {table_name} SET {column_name} = $1 WHERE {column_name} = $2;"
-        await execute(update_query, new_value, selected_value)
+        update_query = sql.update_query(table_name, column_name, dialog.params['cast_type'], dialog.params['schema'])
+        if dialog.params.get('explain'):
+            reply(message, await run_explain(user_id, table_name, 'update', update_query, (new_value, selected_value)))
+        elif transactions.get(user_id) is not None:
+            buffer_step(message, update_query, (new_value, selected_value),
+                        f"замена '{selected_value}' на '{new_value}' в колонке '{column_name}' таблицы '{table_name}'",
+                        table_name)
+        else:
+            started = time.perf_counter()
+            status = await execute(user_id, update_query, new_value, selected_value, timeout=command_timeout('update'))
+            updated = status.split()[-1]
+            explain.record(user_id, table_name, 'update', time.perf_counter() - started, int(updated))
+            result_cache.invalidate_table(user_id, table_name)
 
-        await message.answer(f"Значение '{selected_value}' в колонке '{column_name}' успешно обновлено на '{new_value}'.")
+            reply(message, f"Значение '{selected_value}' в колонке '{column_name}' успешно обновлено на '{new_value}'. Изменено строк: {updated}.")
 
     except Exception as e:
         logging.error(f"Ошибка обновления данных: {e}")
-        await message.answer("Произошла ошибка при обновлении данных.")
+        reply(message, "Произошла ошибка при обновлении данных.")
 
     # Очищаем состояние после обновления данных
-    user_update_states.pop(user_id, None)
-    user_update_params.pop(user_id, None)
+    end_dialog(user_id)
+
+
+# Режим /explain: диалог /select, /insert или /update проходит как обычно, но на последнем шаге
+# сгенерированный запрос выполняется с EXPLAIN ANALYZE в транзакции, которая откатывается
+EXPLAIN_FLOWS = {
+    'select': start_select_data,
+    'insert': start_insert_data,
+    'update': start_update_data,
+}
 
 
+@router.message(Command("explain"))
+async def start_explain(message: types.Message):
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    flow = args[0].lower().lstrip('/') if len(args) == 1 else None
+    if flow not in EXPLAIN_FLOWS:
+        reply(message, "Использование: /explain select, /explain insert или /explain update.")
+        return
+
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+        return
+
+    reply(message, "Режим /explain: вместо результата будет показан план запроса, изменения не сохраняются.")
+    await EXPLAIN_FLOWS[flow](message)
+    dialog = get_dialog(user_id)
+    if dialog is not None and dialog.flow == flow:
+        dialog.params['explain'] = True
+        save_dialog(user_id, dialog)
+
+
+# План запроса, который выполнил бы диалог; время выполнения попадает в историю таблицы
+async def run_explain(user_id, table_name, operation, query, args, readonly=False):
+    plan = await explain_query(user_id, query, *args, timeout=command_timeout(operation), readonly=readonly)
+    explain.record_plan(user_id, table_name, operation, plan)
+    return f"План {operation} для таблицы '{table_name}':\n{explain.summarize_plan(plan)}"
+
+
+# История времени запросов к таблице: замеры обычных команд и /explain
+@router.message(Command("profile"))
+async def show_profile(message: types.Message):
+    user_id = message.from_user.id
+    if not is_connected(user_id):
+        reply(message, "Пожалуйста, сначала подключитесь к базе данных с помощью команды /connect.")
+        return
+
+    args = message.text.split()[1:]
+    if len(args) != 1:
+        reply(message, "Использование: /profile <таблица>")
+        return
+
+    history = explain.format_history(user_id, args[0])
+    reply(message, history or f"Замеров запросов к таблице '{args[0]}' пока нет.")
+
+
+# Inline-режим (@бот префикс): подсказки имен таблиц и колонок из индекса в памяти.
+# Выбранное имя отправляется обычным сообщением и попадает в текущий шаг диалога
+@router.inline_query()
+async def suggest_names(inline_query: types.InlineQuery):
+    user_id = inline_query.from_user.id
+    results = []
+    if is_connected(user_id):
+        await autocomplete.load(user_id)
+
+        # Если диалог ждет колонку, подсказываются колонки выбранной таблицы
+        dialog = get_dialog(user_id)
+        table_name = dialog.params.get('table_name') if dialog is not None and 'column' in dialog.step else None
+
+        for i, (kind, name, description) in enumerate(autocomplete.suggest(user_id, inline_query.query, table_name)):
+            results.append(types.InlineQueryResultArticle(
+                id=f"{kind}:{i}", title=name, description=description,
+                input_message_content=types.InputTextMessageContent(message_text=name)))
+    await inline_query.answer(results, cache_time=autocomplete.INLINE_CACHE_TIME, is_personal=True)
+
+
+# Все остальные сообщения - шаги диалогов: обработчик находится по (flow, step) за одно обращение к словарю
+@dialog_router.message()
+async def handle_dialog_step(message: types.Message):
+    await dispatch(message)
+
+
+# Регистрируем маршрутизаторы в диспетчере: сначала команды, затем шаги диалогов
+def setup_routers():
+    dp.include_router(router)
+    dp.include_router(dialog_router)
+
+
+def handle_stop_signals():
+    # Polling сам обрабатывает SIGINT/SIGTERM, в остальных режимах подключаем их к stop_event
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+
+
+# Рабочий процесс многопроцессного режима: обновления приходят от основного процесса
+async def run_worker(address):
+    setup_routers()
+    handle_stop_signals()
+    await on_startup()
+    try:
+        await webhook.run_local_server(dp, bot, stop_event, address)
+    finally:
+        await on_shutdown()
+        await bot.session.close()
+
 
 # Основной запуск бота
 async def main():
-    # Регистрируем маршрутизатор в диспетчере
-    dp.include_router(router)
+    setup_routers()
+
+    if shards.BOT_WORKERS > 1:
+        # Этот процесс только принимает обновления и раздает их рабочим процессам
+        handle_stop_signals()
+        try:
+            await shards.run_supervisor(dp, bot, stop_event, run_worker)
+        finally:
+            await bot.session.close()
+            logging.info("Бот остановлен.")
+        return
 
     # Запуск бота
     await on_startup()
 
     try:
-        await dp.start_polling(bot)
+        if webhook.BOT_MODE == 'webhook':
+            handle_stop_signals()
+            await webhook.run_webhook(dp, bot, stop_event)
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     finally:
         await on_shutdown()
+        await bot.session.close()
+        logging.info("Бот остановлен.")
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,134 @@
+# Массовая вставка строк: вставленный текст или CSV/TSV-файл загружается через COPY пачками
+import asyncio
+import csv
+import io
+import logging
+import time
+
+from coercion import coerce_rows
+from db import QueryCancelledError, copy_records
+
+# Сколько строк отправляется в одном COPY
+BULK_BATCH_SIZE = 1000
+
+# Как часто (в секундах) обновлять сообщение с прогрессом
+PROGRESS_INTERVAL = 2
+
+# Сколько ошибок показывать пользователю в итоговом отчете
+MAX_REPORTED_ERRORS = 20
+
+
+def detect_delimiter(first_line, filename=None):
+    if filename and filename.lower().endswith('.tsv'):
+        return '\t'
+    if '\t' in first_line:
+        return '\t'
+    if ';' in first_line and ',' not in first_line:
+        return ';'
+    return ','
+
+
+def read_rows(stream, delimiter):
+    """Построчно читает CSV из текстового потока, возвращая (номер строки, поля)."""
+    reader = csv.reader(stream, delimiter=delimiter)
+    for row in reader:
+        if not row or all(not field.strip() for field in row):
+            continue
+        yield reader.line_num, row
+
+
+def text_stream(data):
+    return io.StringIO(data, newline='')
+
+
+def file_stream(binary_file):
+    binary_file.seek(0)
+    return io.TextIOWrapper(binary_file, encoding='utf-8-sig', newline='')
+
+
+def iter_batches(rows, columns, udt_names, batch_size=BULK_BATCH_SIZE):
+    """Группирует строки в пачки и преобразует каждую пачку по колонкам (coercion.coerce_rows).
+
+    Возвращает (номер первой строки, номер последней строки, записи, ошибки преобразования).
+    """
+    raw = []
+    line_nums = []
+    errors = []
+    header_checked = False
+
+    def flush():
+        records, cell_errors = coerce_rows(raw, columns, udt_names)
+        errors.extend((line_nums[index], f"колонка {column}: {text}") for index, column, text in cell_errors)
+        errors.sort()
+        batch_lines = line_nums + [line_num for line_num, _ in errors]
+        return min(batch_lines), max(batch_lines), records, errors
+
+    for line_num, row in rows:
+        # Строка заголовка с названиями колонок пропускается
+        if not header_checked:
+            header_checked = True
+            if [field.strip() for field in row] == list(columns):
+                continue
+
+        if len(row) != len(columns):
+            errors.append((line_num, f"ожидалось {len(columns)} значений, получено {len(row)}"))
+        else:
+            raw.append(row)
+            line_nums.append(line_num)
+
+        if len(raw) + len(errors) >= batch_size:
+            yield flush()
+            raw, line_nums, errors = [], [], []
+
+    if raw or errors:
+        yield flush()
+
+
+async def load_rows(user_id, schema, table_name, columns, udt_names, rows, progress=None):
+    """Загружает строки пачками через COPY. Ошибка одной пачки не прерывает остальные,
+    а отмена (/cancel или остановка задачи) прерывает всю загрузку.
+
+    progress - корутина-функция progress(inserted, processed), вызывается не чаще PROGRESS_INTERVAL.
+    Возвращает (число вставленных строк, число ошибок, первые MAX_REPORTED_ERRORS ошибок).
+    """
+    inserted = 0
+    processed = 0
+    error_count = 0
+    errors = []
+    last_report = time.monotonic()
+
+    for first_line, last_line, batch, batch_errors in iter_batches(rows, columns, udt_names):
+        for line_num, text in batch_errors:
+            error_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append((f"строка {line_num}", text))
+        processed += len(batch) + len({line_num for line_num, _ in batch_errors})
+
+        if batch:
+            try:
+                await copy_records(user_id, table_name, columns, batch, schema_name=schema)
+                inserted += len(batch)
+            except (asyncio.CancelledError, QueryCancelledError):
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка загрузки строк {first_line}-{last_line}: {e}")
+                error_count += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append((f"строки {first_line}-{last_line}", str(e)))
+
+        if progress is not None and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await progress(inserted, processed)
+
+    return inserted, error_count, errors
+
+
+def format_report(table_name, inserted, error_count, errors):
+    lines = [f"Загрузка в таблицу '{table_name}' завершена. Вставлено строк: {inserted}."]
+    if error_count:
+        lines.append(f"Ошибок: {error_count}")
+        for where, text in errors:
+            lines.append(f"{where}: {text[:150]}")
+        if error_count > len(errors):
+            lines.append(f"... и еще {error_count - len(errors)}")
+    return "\n".join(lines)
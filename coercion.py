@@ -0,0 +1,261 @@
+# Преобразование введенных пользователем строк в значения типов PostgreSQL до отправки в базу
+import datetime
+import decimal
+import json
+import re
+import uuid
+from functools import lru_cache
+
+# Значения, которые записываются как NULL. В текстовых колонках слово null - обычный текст,
+# NULL там задается только пустым значением
+NULL_VALUES = ('', 'null')
+TEXT_NULL_VALUES = ('',)
+
+_INT_RANGES = {
+    'int2': (-2 ** 15, 2 ** 15 - 1),
+    'int4': (-2 ** 31, 2 ** 31 - 1),
+    'int8': (-2 ** 63, 2 ** 63 - 1),
+}
+
+_BOOL_VALUES = {
+    'true': True, 't': True, '1': True, 'yes': True, 'y': True, 'on': True,
+    'false': False, 'f': False, '0': False, 'no': False, 'n': False, 'off': False,
+}
+
+
+def _int_parser(low, high):
+    def parse(value):
+        result = int(value)
+        if not low <= result <= high:
+            raise ValueError("число вне допустимого диапазона")
+        return result
+    return parse
+
+
+def parse_numeric(value):
+    try:
+        return decimal.Decimal(value)
+    except decimal.InvalidOperation:
+        raise ValueError("ожидалось число")
+
+
+def parse_bool(value):
+    try:
+        return _BOOL_VALUES[value.lower()]
+    except KeyError:
+        raise ValueError("ожидалось true или false")
+
+
+def parse_timestamptz(value):
+    result = datetime.datetime.fromisoformat(value)
+    if result.tzinfo is None:
+        result = result.replace(tzinfo=datetime.timezone.utc)
+    return result
+
+
+def parse_timestamp(value):
+    result = datetime.datetime.fromisoformat(value)
+    return result.replace(tzinfo=None)
+
+
+def parse_timetz(value):
+    result = datetime.time.fromisoformat(value)
+    if result.tzinfo is None:
+        result = result.replace(tzinfo=datetime.timezone.utc)
+    return result
+
+
+# Интервал в записи PostgreSQL: '1 day 02:03:04', '3 hours 30 minutes', '-1.5 h', '00:15'
+_INTERVAL_UNITS = {
+    'microseconds': ('us', 'usec', 'usecs', 'microsecond', 'microseconds'),
+    'milliseconds': ('ms', 'msec', 'msecs', 'millisecond', 'milliseconds'),
+    'seconds': ('s', 'sec', 'secs', 'second', 'seconds'),
+    'minutes': ('m', 'min', 'mins', 'minute', 'minutes'),
+    'hours': ('h', 'hr', 'hrs', 'hour', 'hours'),
+    'days': ('d', 'day', 'days'),
+    'weeks': ('w', 'week', 'weeks'),
+}
+_INTERVAL_UNIT_NAMES = {alias: unit for unit, aliases in _INTERVAL_UNITS.items() for alias in aliases}
+_INTERVAL_MONTH_UNITS = ('mon', 'mons', 'month', 'months', 'y', 'year', 'years')
+_INTERVAL_PART = re.compile(r'\s*([+-]?\d+(?:\.\d+)?)\s*([a-z]+)')
+_INTERVAL_CLOCK = re.compile(r'\s*([+-]?)(\d+):(\d{1,2})(?::(\d{1,2}(?:\.\d+)?))?\s*$')
+
+
+def parse_interval(value):
+    # asyncpg передает interval как timedelta, в которой нет месяцев, поэтому месяцы и годы
+    # не пересчитываются в дни (их длина разная), а отклоняются
+    text = value.lower()
+    result = datetime.timedelta()
+    position = 0
+    while match := _INTERVAL_PART.match(text, position):
+        number, unit = match.groups()
+        if unit in _INTERVAL_MONTH_UNITS:
+            raise ValueError("месяцы и годы в интервале не поддерживаются, укажите дни")
+        if unit not in _INTERVAL_UNIT_NAMES:
+            raise ValueError(f"неизвестная единица интервала: {unit}")
+        result += datetime.timedelta(**{_INTERVAL_UNIT_NAMES[unit]: float(number)})
+        position = match.end()
+
+    clock = _INTERVAL_CLOCK.match(text, position)
+    if clock:
+        sign, hours, minutes, seconds = clock.groups()
+        duration = datetime.timedelta(hours=int(hours), minutes=int(minutes), seconds=float(seconds or 0))
+        result += -duration if sign == '-' else duration
+    elif text[position:].strip() or position == 0:
+        raise ValueError("ожидался интервал, например '1 day 02:00:00' или '3 hours'")
+    return result
+
+
+def parse_json(value):
+    # asyncpg принимает json/jsonb строкой, поэтому только проверяем корректность
+    json.loads(value)
+    return value
+
+
+def parse_bytea(value):
+    if value.startswith('\\x'):
+        return bytes.fromhex(value[2:])
+    return value.encode('utf-8')
+
+
+def parse_text(value):
+    return value
+
+
+# udt_name колонки -> функция разбора строки
+PARSERS = {
+    **{name: _int_parser(*limits) for name, limits in _INT_RANGES.items()},
+    'numeric': parse_numeric,
+    'float4': float,
+    'float8': float,
+    'bool': parse_bool,
+    'date': datetime.date.fromisoformat,
+    'time': datetime.time.fromisoformat,
+    'timetz': parse_timetz,
+    'interval': parse_interval,
+    'timestamp': parse_timestamp,
+    'timestamptz': parse_timestamptz,
+    'uuid': uuid.UUID,
+    'json': parse_json,
+    'jsonb': parse_json,
+    'bytea': parse_bytea,
+}
+
+
+# Элемент массива в записи PostgreSQL: в кавычках (внутри могут быть запятые и экранирование \")
+# или без кавычек до следующей запятой; за ним - запятая или конец
+_ARRAY_ITEM = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|([^,"]*))\s*(,|$)', re.DOTALL)
+_ARRAY_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+
+
+def _split_array(value):
+    value = value.strip()
+    if value.startswith('['):
+        items = json.loads(value)
+        return [None if item is None else str(item) for item in items]
+    if not (value.startswith('{') and value.endswith('}')):
+        raise ValueError("ожидался массив в формате {a,b} или [a, b]")
+    body = value[1:-1].strip()
+    if not body:
+        return []
+
+    items = []
+    position = 0
+    while True:
+        match = _ARRAY_ITEM.match(body, position)
+        if match is None:
+            raise ValueError("некорректный элемент массива: проверьте кавычки")
+        quoted, plain, separator = match.groups()
+        if quoted is not None:
+            # "NULL" в кавычках - строка, а не NULL
+            items.append(_ARRAY_ESCAPE.sub(r'\1', quoted))
+        else:
+            plain = plain.strip()
+            if not plain:
+                raise ValueError("пустой элемент массива")
+            items.append(None if plain.lower() == 'null' else plain)
+        if not separator:
+            return items
+        position = match.end()
+
+
+@lru_cache(maxsize=None)
+def get_parser(udt_name):
+    """Возвращает функцию разбора для типа; массивы (_int4 и т.п.) разбираются поэлементно.
+
+    Для неизвестных типов (enum, пользовательские типы) строка передается как есть.
+    """
+    if udt_name.startswith('_'):
+        element_parser = get_parser(udt_name[1:])
+
+        def parse_array(value):
+            return [None if item is None else element_parser(item) for item in _split_array(value)]
+        return parse_array
+    return PARSERS.get(udt_name, parse_text)
+
+
+def _null_values(parser):
+    return TEXT_NULL_VALUES if parser is parse_text else NULL_VALUES
+
+
+def coerce_value(value, udt_name):
+    """Преобразует одно значение; пустая строка и NULL (кроме текстовых колонок) становятся NULL.
+
+    Ошибка - ValueError.
+    """
+    value = value.strip()
+    parser = get_parser(udt_name)
+    if value.lower() in _null_values(parser):
+        return None
+    try:
+        return parser(value)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(str(e))
+
+
+def coerce_column(values, udt_name):
+    """Преобразует колонку значений за один проход.
+
+    Возвращает (значения, ошибки), ошибки - список (индекс, текст ошибки); на месте
+    ошибочного значения остается None.
+    """
+    parser = get_parser(udt_name)
+    null_values = _null_values(parser)
+    result = []
+    errors = []
+    append = result.append
+    for index, value in enumerate(values):
+        value = value.strip()
+        if value.lower() in null_values:
+            append(None)
+            continue
+        try:
+            append(parser(value))
+        except Exception as e:
+            append(None)
+            errors.append((index, f"'{value[:50]}': {e}"))
+    return result, errors
+
+
+def coerce_rows(rows, columns, udt_names):
+    """Преобразует пачку строк по колонкам.
+
+    Возвращает (записи без ошибочных строк, ошибки по ячейкам (индекс строки, колонка, текст)).
+    """
+    if not rows:
+        return [], []
+    converted = []
+    cell_errors = []
+    bad_rows = set()
+    for column, udt_name, values in zip(columns, udt_names, zip(*rows)):
+        column_values, errors = coerce_column(values, udt_name)
+        converted.append(column_values)
+        for index, text in errors:
+            bad_rows.add(index)
+            cell_errors.append((index, column, text))
+
+    records = [record for index, record in enumerate(zip(*converted)) if index not in bad_rows]
+    cell_errors.sort()
+    return records, cell_errors
@@ -0,0 +1,819 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+
+import asyncpg
+
+import metrics
+
+# Размеры пула соединений для одного пользователя
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 5
+
+# Кэш подготовленных выражений на каждом соединении (LRU по тексту запроса).
+# Запросы строятся в sql.py так, что одинаковые по форме запросы совпадают по тексту
+STATEMENT_CACHE_SIZE = 256
+MAX_CACHED_STATEMENT_LIFETIME = 3600
+
+# Сколько строк серверный курсор передает за один раз
+CURSOR_PREFETCH = 50
+
+# Параметры EXPLAIN для /explain: фактическое время, работа с буферами, план в JSON
+EXPLAIN_OPTIONS = "ANALYZE, BUFFERS, FORMAT JSON"
+
+# Максимальное число одновременно открытых пулов (LRU)
+MAX_POOLS = 50
+
+# Через сколько секунд простоя пул закрывается
+POOL_IDLE_TIMEOUT = 600
+POOL_REAPER_INTERVAL = 60
+
+# Read-реплики (/connect): как часто и с каким таймаутом проверяется их доступность
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', 10))
+REPLICA_CHECK_TIMEOUT = float(os.getenv('REPLICA_CHECK_TIMEOUT', 3))
+
+# Максимальное отставание реплики в секундах, при котором она получает запросы (0 - не проверять)
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 0))
+
+# Сколько секунд после записи пользователь читает с основного сервера, чтобы видеть свои изменения
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 5))
+
+# Отставание реплики в секундах; NULL - сервер не в режиме восстановления (не реплика)
+REPLICA_LAG_QUERY = """
+SELECT CASE WHEN pg_is_in_recovery()
+            THEN coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+       END
+"""
+
+# Ошибки, после которых реплика считается недоступной, а чтение повторяется на основном сервере
+REPLICA_ERRORS = (
+    OSError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.ConnectionDoesNotExistError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.AdminShutdownError,
+    asyncpg.TooManyConnectionsError,
+)
+
+# Таймаут запроса (в Python 3.11 asyncio.TimeoutError - подкласс OSError) не повод переходить
+# на основной сервер: тот же тяжелый запрос нагрузил бы его, а разгрузка основного - смысл реплик
+QUERY_TIMEOUT_ERRORS = (asyncio.TimeoutError, TimeoutError)
+
+
+# Ограничение времени выполнения запроса (в секундах) по умолчанию и для отдельных команд.
+# Переопределяется переменными окружения QUERY_TIMEOUT и QUERY_TIMEOUT_<КОМАНДА>
+QUERY_TIMEOUT = float(os.getenv('QUERY_TIMEOUT', 30))
+COMMAND_TIMEOUTS = {
+    name: float(os.getenv(f'QUERY_TIMEOUT_{name.upper()}', default))
+    for name, default in {
+        'select': 60,
+        'update': 30,
+        'insert': 30,
+        'bulk_insert': 600,
+        'export': 600,
+        'ddl': 300,
+        'stats': 60,
+        'transaction': 120,
+    }.items()
+}
+
+
+class TransactionStepError(Exception):
+    """Ошибка шага транзакции; first и last - номера шагов (с 1), отправленных одной командой."""
+
+    def __init__(self, first, last, error):
+        super().__init__(f"{type(error).__name__}: {error}")
+        self.first = first
+        self.last = last
+
+
+class NotConnectedError(Exception):
+    """Пользователь не выполнил /connect."""
+
+
+class QueryCancelledError(Exception):
+    """Запрос отменен пользователем командой /cancel."""
+
+
+def command_timeout(command):
+    return COMMAND_TIMEOUTS.get(command, QUERY_TIMEOUT)
+
+
+class Replica:
+    """Пул соединений одной read-реплики, ее состояние и число выполняющихся на ней запросов."""
+    __slots__ = ('params', 'pool', 'healthy', 'outstanding', 'served')
+
+    def __init__(self, params):
+        self.params = params
+        self.pool = None
+        self.healthy = False
+        self.outstanding = 0
+        self.served = 0
+
+    @property
+    def address(self):
+        return f"{self.params['host']}:{self.params['port']}"
+
+    async def check(self):
+        try:
+            if self.pool is None:
+                self.pool = await asyncio.wait_for(_create_pool(self.params), REPLICA_CHECK_TIMEOUT)
+            async with self.pool.acquire(timeout=REPLICA_CHECK_TIMEOUT) as conn:
+                lag = await conn.fetchval(REPLICA_LAG_QUERY, timeout=REPLICA_CHECK_TIMEOUT)
+        except (*REPLICA_ERRORS, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            self.mark_failed(e)
+            return
+        healthy = not REPLICA_MAX_LAG or lag is None or lag <= REPLICA_MAX_LAG
+        if healthy != self.healthy:
+            logging.info(f"Реплика {self.address} {'доступна' if healthy else f'отстает на {lag:.0f} с'}.")
+        self.healthy = healthy
+
+    def mark_failed(self, error):
+        if self.healthy:
+            logging.warning(f"Реплика {self.address} недоступна: {error}")
+        self.healthy = False
+
+    def use(self):
+        return _ReplicaUse(self)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+
+class _ReplicaUse:
+    __slots__ = ('replica',)
+
+    def __init__(self, replica):
+        self.replica = replica
+
+    def __enter__(self):
+        self.replica.outstanding += 1
+        self.replica.served += 1
+        return self.replica
+
+    def __exit__(self, *exc):
+        self.replica.outstanding -= 1
+
+
+def _choose_replica(replicas):
+    """Здоровая реплика с наименьшим числом выполняющихся запросов или None."""
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        return None
+    return min(healthy, key=lambda replica: (replica.outstanding, replica.served))
+
+
+def parse_replicas(text, default_port):
+    """'host1:5433, host2' -> [('host1', '5433'), ('host2', default_port)]; '-' или пусто - без реплик."""
+    replicas = []
+    for item in text.replace(';', ',').split(','):
+        item = item.strip()
+        if not item or item == '-':
+            continue
+        host, sep, port = item.rpartition(':')
+        if not sep or not port.isdigit():
+            host, port = item, default_port
+        replicas.append((host.strip('[]'), str(port)))
+    return replicas
+
+
+# Реестр пулов: ключ (user_id + параметры подключения) ->
+# [пул основного сервера, время последнего использования, список Replica]
+_pools = OrderedDict()
+# Параметры подключения каждого пользователя, чтобы пересоздать вытесненный пул
+_user_params = {}
+# Время последнего обращения пользователя к базе. По нему параметры (вместе с паролем)
+# забываются после простоя, даже если пул пользователя уже вытеснен по LRU
+_user_last_used = {}
+_pools_lock = asyncio.Lock()
+_reaper_task = None
+_replica_monitor_task = None
+
+# user_id -> время последней записи (для чтения своих изменений с основного сервера)
+_last_write = {}
+
+# Сохраненные подключения: user_id -> {имя: параметры}. Хранятся только в памяти и, как
+# параметры текущего подключения, забываются, если пользователь не обращался к ним дольше POOL_IDLE_TIMEOUT
+_saved_params = {}
+_saved_last_used = {}
+MAX_SAVED_CONNECTIONS = 20
+
+# Обработчики освобождения подключения: вызываются с владельцем (user_id или (user_id, имя
+# сохраненного подключения)), когда его пул закрыт по простою или LRU или параметры забыты.
+# Так кэши других модулей (схема, подсказки, соединения LISTEN) живут не дольше подключения
+_release_callbacks = []
+
+# Выполняющиеся запросы каждого пользователя: user_id (или (user_id, имя сохраненного
+# подключения)) -> множество задач
+_running = {}
+# Задачи, отмененные командой /cancel (а не остановкой бота)
+_user_cancelled = set()
+
+
+def _pool_key(user_id, params):
+    return (
+        user_id,
+        params.get('user'),
+        params.get('password'),
+        params.get('database'),
+        params.get('host'),
+        str(params.get('port')),
+        tuple(params.get('replicas') or ()),
+    )
+
+
+async def _create_pool(params):
+    return await asyncpg.create_pool(
+        user=params.get('user'),
+        password=params.get('password'),
+        database=params.get('database'),
+        host=params.get('host'),
+        port=int(params.get('port')),
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        max_inactive_connection_lifetime=POOL_IDLE_TIMEOUT,
+        statement_cache_size=STATEMENT_CACHE_SIZE,
+        max_cached_statement_lifetime=MAX_CACHED_STATEMENT_LIFETIME,
+    )
+
+
+async def _close_pool(key, pool, replicas=()):
+    for pool_to_close in (pool, *replicas):
+        try:
+            await pool_to_close.close()
+        except Exception as e:
+            logging.error(f"Ошибка закрытия пула {key[0]}: {e}")
+
+
+async def _open_replicas(params):
+    # Недоступная реплика не мешает подключению: она получит запросы, когда пройдет проверку
+    replicas = [Replica({**params, 'host': host, 'port': port}) for host, port in params.get('replicas') or ()]
+    await asyncio.gather(*(replica.check() for replica in replicas))
+    return replicas
+
+
+async def _close_pools(closed):
+    # Пулы закрываются уже без _pools_lock: close() ждет завершения выполняющихся на пуле
+    # запросов (например, долгой выгрузки), и остальные пользователи не должны ждать вместе с ним
+    await asyncio.gather(*(_close_pool(key, pool, replicas) for key, pool, replicas in closed))
+
+
+def _pop_pool(key):
+    pool, _, replicas = _pools.pop(key)
+    return key, pool, replicas
+
+
+def _evict_lru():
+    # Убираем из реестра самые давно использованные пулы сверх лимита; закрывает их вызывающий
+    evicted = []
+    while len(_pools) > MAX_POOLS:
+        key = next(iter(_pools))
+        logging.info(f"Пул пользователя {key[0]} вытеснен по LRU.")
+        evicted.append(_pop_pool(key))
+    return evicted
+
+
+def on_release(callback):
+    """Регистрирует callback(owner), вызываемый после закрытия пула или забывания параметров.
+
+    callback может быть корутинной функцией; ошибки обработчиков только логируются.
+    """
+    _release_callbacks.append(callback)
+    return callback
+
+
+async def _released(owners):
+    for owner in dict.fromkeys(owners):
+        for callback in _release_callbacks:
+            try:
+                result = callback(owner)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logging.error(f"Ошибка освобождения данных подключения {owner}: {e}")
+
+
+def pool_targets():
+    """Базы, к которым сейчас открыт хотя бы один пул, в виде connection_target."""
+    return {(key[1], key[3], key[4], key[5]) for key in _pools}
+
+
+def _remember_params(user_id, params):
+    _user_params[user_id] = dict(params)
+    _user_last_used[user_id] = time.monotonic()
+
+
+def _forget_params(user_id):
+    _user_params.pop(user_id, None)
+    _user_last_used.pop(user_id, None)
+    _last_write.pop(user_id, None)
+
+
+async def _connect(user_id, params):
+    key = _pool_key(user_id, params)
+    async with _pools_lock:
+        if key in _pools:
+            _pools.move_to_end(key)
+            _pools[key][1] = time.monotonic()
+            _remember_params(user_id, params)
+            return _pools[key]
+
+    pool = await _create_pool(params)
+    try:
+        replicas = await _open_replicas(params)
+    except BaseException:
+        await _close_pool(key, pool)
+        raise
+
+    async with _pools_lock:
+        # Пул с этими параметрами мог быть открыт параллельно
+        existing = _pools.get(key)
+        if existing is not None:
+            _pools.move_to_end(key)
+            _remember_params(user_id, params)
+        else:
+            # Старый пул пользователя с другими параметрами закрывается
+            stale = [k for k in _pools if k[0] == user_id and k != key]
+            closed = [_pop_pool(k) for k in stale]
+            entry = _pools[key] = [pool, time.monotonic(), replicas]
+            _remember_params(user_id, params)
+            closed += _evict_lru()
+
+    if existing is not None:
+        await _close_pool(key, pool, replicas)
+        return existing
+    await _close_pools(closed)
+    await _released([k[0] for k, _, _ in closed])
+    return entry
+
+
+async def connect_to_db(user_id, params):
+    """Открывает пул соединений пользователя (и пулы его read-реплик), заменяя предыдущий."""
+    return (await _connect(user_id, params))[0]
+
+
+async def _get_entry(user_id):
+    params = _user_params.get(user_id)
+    if params is None:
+        raise NotConnectedError(f"Пользователь {user_id} не подключен к базе данных.")
+
+    _user_last_used[user_id] = time.monotonic()
+    key = _pool_key(user_id, params)
+    async with _pools_lock:
+        entry = _pools.get(key)
+        if entry is not None:
+            _pools.move_to_end(key)
+            entry[1] = time.monotonic()
+            return entry
+
+    # Пул был закрыт по простою или LRU - открываем заново
+    return await _connect(user_id, params)
+
+
+async def get_pool(user_id):
+    """Возвращает пул пользователя, при необходимости пересоздавая вытесненный."""
+    return (await _get_entry(user_id))[0]
+
+
+async def _route(user_id, readonly):
+    """Пул основного сервера и реплика для запроса (None - выполнять на основном сервере).
+
+    Чтение идет на здоровую реплику с наименьшим числом выполняющихся запросов, кроме
+    REPLICA_STICKY_SECONDS после записи пользователя; запись - всегда на основной сервер.
+    """
+    pool, _, replicas = await _get_entry(user_id)
+    if not readonly or not replicas:
+        return pool, None
+    if time.monotonic() - _last_write.get(user_id, float('-inf')) < REPLICA_STICKY_SECONDS:
+        return pool, None
+    return pool, _choose_replica(replicas)
+
+
+def replica_status(user_id):
+    """[(адрес, доступна, выполняется запросов)] реплик пользователя без обращения к базе."""
+    params = _user_params.get(user_id)
+    entry = _pools.get(_pool_key(user_id, params)) if params is not None else None
+    if entry is None:
+        return []
+    return [(replica.address, replica.healthy, replica.outstanding) for replica in entry[2]]
+
+
+def is_connected(user_id):
+    return user_id in _user_params
+
+
+def connection_target(user_id):
+    """База, к которой подключен пользователь: (пользователь БД, база, хост, порт) или None.
+
+    Пароль в ключ не входит: одна и та же роль на одном сервере видит одни и те же данные.
+    """
+    params = _user_params.get(user_id)
+    if params is None:
+        return None
+    return (params.get('user'), params.get('database'), params.get('host'), str(params.get('port')))
+
+
+def describe_params(params):
+    return f"{params.get('user')}@{params.get('host')}:{params.get('port')}/{params.get('database')}"
+
+
+def save_connection(user_id, name):
+    """Сохраняет текущее подключение пользователя под именем name."""
+    params = _user_params.get(user_id)
+    if params is None:
+        raise NotConnectedError(f"Пользователь {user_id} не подключен к базе данных.")
+    saved = _saved_params.setdefault(user_id, {})
+    if name not in saved and len(saved) >= MAX_SAVED_CONNECTIONS:
+        raise ValueError(f"Можно сохранить не больше {MAX_SAVED_CONNECTIONS} подключений.")
+    saved[name] = dict(params)
+    _saved_last_used[user_id] = time.monotonic()
+
+
+def _saved(user_id, name):
+    params = _saved_params.get(user_id, {}).get(name)
+    if params is None:
+        raise KeyError(name)
+    _saved_last_used[user_id] = time.monotonic()
+    return params
+
+
+def saved_connections(user_id):
+    """{имя: описание} сохраненных подключений пользователя; описание - без пароля."""
+    return {name: describe_params(params) for name, params in _saved_params.get(user_id, {}).items()}
+
+
+def is_active_connection(user_id, name):
+    params = _saved_params.get(user_id, {}).get(name)
+    current = _user_params.get(user_id)
+    return params is not None and current is not None and _pool_key(user_id, params) == _pool_key(user_id, current)
+
+
+async def use_saved_connection(user_id, name):
+    """Делает сохраненное подключение текущим."""
+    return await connect_to_db(user_id, _saved(user_id, name))
+
+
+async def forget_saved_connection(user_id, name):
+    """Удаляет сохраненное подключение и закрывает его пул для параллельных запросов."""
+    saved = _saved_params.get(user_id, {})
+    if saved.pop(name, None) is None:
+        return False
+    if not saved:
+        _saved_params.pop(user_id, None)
+        _saved_last_used.pop(user_id, None)
+    await close_connection((user_id, name))
+    return True
+
+
+async def open_saved_connection(user_id, name):
+    """Открывает пул сохраненного подключения отдельно от текущего (для /fanout).
+
+    Возвращает ключ владельца пула, который передается в fetch/iterate вместо user_id.
+    """
+    owner = (user_id, name)
+    await _connect(owner, _saved(user_id, name))
+    return owner
+
+
+async def open_listener(user_id, channel, callback):
+    """Открывает отдельное соединение (вне пула) и подписывает его на LISTEN channel."""
+    params = _user_params.get(user_id)
+    if params is None:
+        raise NotConnectedError(f"Пользователь {user_id} не подключен к базе данных.")
+
+    conn = await asyncpg.connect(
+        user=params.get('user'),
+        password=params.get('password'),
+        database=params.get('database'),
+        host=params.get('host'),
+        port=int(params.get('port')),
+    )
+    try:
+        await conn.add_listener(channel, callback)
+    except Exception:
+        await conn.close()
+        raise
+    return conn
+
+
+def _track(user_id, task):
+    _running.setdefault(user_id, set()).add(task)
+
+
+def _untrack(user_id, task):
+    tasks = _running.get(user_id)
+    if tasks is not None:
+        tasks.discard(task)
+        if not tasks:
+            _running.pop(user_id, None)
+    _user_cancelled.discard(task)
+
+
+async def _run_tracked(user_id, coro):
+    """Выполняет запрос отдельной задачей, чтобы его можно было отменить через /cancel.
+
+    При отмене задачи asyncpg отправляет серверу запрос на отмену выполняющейся команды.
+    """
+    task = asyncio.create_task(coro)
+    _track(user_id, task)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if task in _user_cancelled:
+            raise QueryCancelledError("Запрос отменен пользователем.")
+        raise
+    finally:
+        _untrack(user_id, task)
+
+
+async def _execute(user_id, query, args, timeout):
+    pool = await get_pool(user_id)
+    _last_write[user_id] = time.monotonic()
+    with metrics.QueryTimer('execute', user_id, query) as timer:
+        async with pool.acquire() as conn:
+            timer.acquired()
+            return await conn.execute(query, *args, timeout=timeout)
+
+
+async def _fetch_from(pool, operation, user_id, query, args, timeout):
+    with metrics.QueryTimer(operation, user_id, query) as timer:
+        async with pool.acquire() as conn:
+            timer.acquired()
+            rows = await conn.fetch(query, *args, timeout=timeout)
+            timer.rows = len(rows)
+            return rows
+
+
+async def _fetch(user_id, query, args, timeout, readonly):
+    pool, replica = await _route(user_id, readonly)
+    if replica is not None:
+        try:
+            with replica.use():
+                return await _fetch_from(replica.pool, 'fetch_replica', user_id, query, args, timeout)
+        except QUERY_TIMEOUT_ERRORS:
+            raise
+        except REPLICA_ERRORS as e:
+            replica.mark_failed(e)
+    return await _fetch_from(pool, 'fetch', user_id, query, args, timeout)
+
+
+async def _explain_from(pool, operation, user_id, query, args, timeout, readonly):
+    with metrics.QueryTimer(operation, user_id, query) as timer:
+        async with pool.acquire() as conn:
+            timer.acquired()
+            # ANALYZE действительно выполняет запрос, поэтому транзакция всегда откатывается
+            transaction = conn.transaction(readonly=readonly)
+            await transaction.start()
+            try:
+                await conn.execute(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+                plan = await conn.fetchval(f"EXPLAIN ({EXPLAIN_OPTIONS}) {query}", *args)
+            finally:
+                await transaction.rollback()
+    return json.loads(plan) if isinstance(plan, str) else plan
+
+
+async def _explain(user_id, query, args, timeout, readonly):
+    pool, replica = await _route(user_id, readonly)
+    if replica is not None:
+        try:
+            with replica.use():
+                return await _explain_from(replica.pool, 'explain_replica', user_id, query, args, timeout, True)
+        except QUERY_TIMEOUT_ERRORS:
+            raise
+        except REPLICA_ERRORS as e:
+            replica.mark_failed(e)
+    return await _explain_from(pool, 'explain', user_id, query, args, timeout, readonly)
+
+
+async def _copy_records(user_id, table_name, columns, records, schema_name, timeout):
+    pool = await get_pool(user_id)
+    _last_write[user_id] = time.monotonic()
+    with metrics.QueryTimer('copy', user_id, f"COPY {schema_name or ''}.{table_name}") as timer:
+        async with pool.acquire() as conn:
+            timer.acquired()
+            timer.rows = len(records)
+            return await conn.copy_records_to_table(
+                table_name, records=records, columns=columns, schema_name=schema_name, timeout=timeout)
+
+
+async def _run_transaction(user_id, steps, timeout):
+    pool = await get_pool(user_id)
+    _last_write[user_id] = time.monotonic()
+    with metrics.QueryTimer('transaction', user_id, f"TRANSACTION ({len(steps)})") as timer:
+        async with pool.acquire() as conn:
+            timer.acquired()
+            timer.rows = len(steps)
+            # BEGIN и таймаут - одним обращением; незавершенную транзакцию при ошибке
+            # или отмене откатывает пул, когда соединение возвращается в него
+            await conn.execute(f"BEGIN; SET LOCAL statement_timeout = {int(timeout * 1000)}")
+            first = 0
+            while first < len(steps):
+                query = steps[first][0]
+                last = first
+                while last + 1 < len(steps) and steps[last + 1][0] == query:
+                    last += 1
+                try:
+                    if last > first:
+                        await conn.executemany(query, [args for _, args in steps[first:last + 1]], timeout=timeout)
+                    else:
+                        await conn.execute(query, *steps[first][1], timeout=timeout)
+                except asyncpg.PostgresError as e:
+                    await conn.execute("ROLLBACK")
+                    raise TransactionStepError(first + 1, last + 1, e) from e
+                first = last + 1
+            await conn.execute("COMMIT")
+
+
+async def run_transaction(user_id, steps, timeout=COMMAND_TIMEOUTS['transaction']):
+    """Выполняет шаги [(запрос, аргументы)] одной транзакцией на выделенном соединении пула.
+
+    Подряд идущие шаги с одним и тем же запросом отправляются конвейером через executemany.
+    При ошибке транзакция откатывается целиком и поднимается TransactionStepError.
+    """
+    return await _run_tracked(user_id, _run_transaction(user_id, steps, timeout))
+
+
+async def execute(user_id, query, *args, timeout=QUERY_TIMEOUT):
+    return await _run_tracked(user_id, _execute(user_id, query, args, timeout))
+
+
+async def fetch(user_id, query, *args, timeout=QUERY_TIMEOUT, readonly=False):
+    """Выполняет запрос и возвращает все строки; readonly=True - можно выполнить на read-реплике."""
+    return await _run_tracked(user_id, _fetch(user_id, query, args, timeout, readonly))
+
+
+async def copy_records(user_id, table_name, columns, records, schema_name=None,
+                       timeout=COMMAND_TIMEOUTS['bulk_insert']):
+    """Загружает записи в таблицу одной командой COPY."""
+    return await _run_tracked(
+        user_id, _copy_records(user_id, table_name, columns, records, schema_name, timeout))
+
+
+async def explain_query(user_id, query, *args, timeout=QUERY_TIMEOUT, readonly=False):
+    """План запроса с фактическим временем выполнения (EXPLAIN ANALYZE) в виде JSON.
+
+    Запрос выполняется, но его изменения откатываются; readonly=True - можно на read-реплике.
+    """
+    return await _run_tracked(user_id, _explain(user_id, query, args, timeout, readonly))
+
+
+async def _iterate_from(pool, operation, user_id, query, args, prefetch, timeout):
+    # Время включает обработку строк читателем, пока курсор открыт
+    with metrics.QueryTimer(operation, user_id, query) as timer:
+        async with pool.acquire() as conn:
+            timer.acquired()
+            timer.rows = 0
+            async with conn.transaction(readonly=True):
+                await conn.execute(f"SET LOCAL statement_timeout = {int(timeout * 1000)}")
+                async for record in conn.cursor(query, *args, prefetch=prefetch):
+                    timer.rows += 1
+                    yield record
+
+
+async def iterate(user_id, query, *args, prefetch=CURSOR_PREFETCH, timeout=QUERY_TIMEOUT):
+    """Построчно читает результат через серверный курсор порциями по prefetch строк.
+
+    Курсор открывается в транзакции только для чтения, поэтому выполняется на read-реплике,
+    если она есть. Ограничение времени действует на каждую порцию (statement_timeout),
+    а при /cancel отменяется задача, которая читает курсор.
+    """
+    task = asyncio.current_task()
+    _track(user_id, task)
+    try:
+        pool, replica = await _route(user_id, readonly=True)
+        if replica is not None:
+            rows = 0
+            try:
+                with replica.use():
+                    async with aclosing(_iterate_from(replica.pool, 'iterate_replica', user_id, query, args,
+                                                      prefetch, timeout)) as records:
+                        async for record in records:
+                            rows += 1
+                            yield record
+                return
+            except QUERY_TIMEOUT_ERRORS:
+                raise
+            except REPLICA_ERRORS as e:
+                replica.mark_failed(e)
+                # Часть строк уже отдана читателю - повторить чтение с начала нельзя
+                if rows:
+                    raise
+        async with aclosing(_iterate_from(pool, 'iterate', user_id, query, args, prefetch, timeout)) as records:
+            async for record in records:
+                yield record
+    finally:
+        _untrack(user_id, task)
+
+
+def _owner_user(owner):
+    return owner[0] if isinstance(owner, tuple) else owner
+
+
+def cancel_queries(user_id):
+    """Отменяет все выполняющиеся запросы пользователя, в том числе к сохраненным подключениям.
+
+    Возвращает их число.
+    """
+    tasks = [task for owner, owner_tasks in list(_running.items()) if _owner_user(owner) == user_id
+             for task in owner_tasks]
+    for task in tasks:
+        _user_cancelled.add(task)
+        task.cancel()
+    return len(tasks)
+
+
+async def cancel_all_queries():
+    """Отменяет все выполняющиеся запросы и дожидается их завершения (при остановке бота)."""
+    tasks = [task for tasks in _running.values() for task in tasks if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def evict_idle_pools(timeout=POOL_IDLE_TIMEOUT):
+    """Закрывает пулы, которые не использовались дольше timeout секунд.
+
+    Параметры подключения (вместе с паролем) пользователей, не обращавшихся к базе дольше
+    timeout, забываются независимо от того, открыт ли еще их пул, - нужен повторный /connect.
+    """
+    now = time.monotonic()
+    async with _pools_lock:
+        idle = [k for k, (_, last_used, _) in _pools.items() if now - last_used > timeout]
+        closed = []
+        for key in idle:
+            logging.info(f"Пул пользователя {key[0]} закрыт по простою.")
+            closed.append(_pop_pool(key))
+
+        forgotten = [u for u, last_used in _user_last_used.items() if now - last_used > timeout]
+        for user_id in forgotten:
+            _forget_params(user_id)
+        # Сохраненные подключения живут, пока пользователь работает с любым из своих подключений
+        for user_id in [u for u, last_used in _saved_last_used.items()
+                        if now - max(last_used, _user_last_used.get(u, last_used)) > timeout]:
+            _saved_params.pop(user_id, None)
+            _saved_last_used.pop(user_id)
+    await _close_pools(closed)
+    await _released([key[0] for key in idle] + forgotten)
+
+
+async def _reap_idle_pools():
+    while True:
+        await asyncio.sleep(POOL_REAPER_INTERVAL)
+        try:
+            await evict_idle_pools()
+        except Exception as e:
+            logging.error(f"Ошибка закрытия простаивающих пулов: {e}")
+
+
+def start_pool_reaper():
+    global _reaper_task
+    if _reaper_task is None:
+        _reaper_task = asyncio.create_task(_reap_idle_pools())
+
+
+async def _monitor_replicas():
+    # Проверяются все реплики, в том числе недоступные: восстановившаяся снова получает запросы
+    while True:
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+        replicas = [replica for _, _, user_replicas in list(_pools.values()) for replica in user_replicas]
+        await asyncio.gather(*(replica.check() for replica in replicas), return_exceptions=True)
+
+
+def start_replica_monitor():
+    global _replica_monitor_task
+    if _replica_monitor_task is None:
+        _replica_monitor_task = asyncio.create_task(_monitor_replicas())
+
+
+async def close_connection(user_id=None):
+    """Закрывает пул пользователя или, без user_id, все пулы."""
+    global _reaper_task, _replica_monitor_task
+    async with _pools_lock:
+        if user_id is None:
+            keys = list(_pools)
+            users = list(_user_params)
+            _user_params.clear()
+            _user_last_used.clear()
+            _last_write.clear()
+            _saved_params.clear()
+            _saved_last_used.clear()
+        else:
+            keys = [k for k in _pools if k[0] == user_id]
+            users = [user_id]
+            _forget_params(user_id)
+        closed = [_pop_pool(key) for key in keys]
+    await _close_pools(closed)
+    await _released([key[0] for key in keys] + users)
+
+    if user_id is None:
+        for task in (_reaper_task, _replica_monitor_task):
+            if task is not None:
+                task.cancel()
+        _reaper_task = _replica_monitor_task = None
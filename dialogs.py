@@ -0,0 +1,80 @@
+# Пошаговые диалоги: одно состояние на пользователя и таблица (flow, step) -> обработчик
+import logging
+
+import metrics
+from sender import reply
+from sessions import Session, create_session_store
+
+# user_id -> Session(flow, step, params); записи истекают по TTL и ограничены по количеству
+user_dialogs = create_session_store()
+
+# (flow, step) -> обработчик шага
+STEP_HANDLERS = {}
+
+# Шаги, которые принимают не только текст, но и документы
+FILE_STEPS = set()
+
+
+def dialog_step(flow, step, accepts_files=False):
+    """Регистрирует обработчик шага диалога."""
+    def decorator(handler):
+        STEP_HANDLERS[(flow, step)] = handler
+        if accepts_files:
+            FILE_STEPS.add((flow, step))
+        return handler
+    return decorator
+
+
+def start_dialog(user_id, flow, step, params=None):
+    """Начинает диалог, заменяя незавершенный диалог пользователя, если он был."""
+    dialog = Session(flow, step, params)
+    user_dialogs.set(user_id, dialog)
+    return dialog
+
+
+def get_dialog(user_id):
+    return user_dialogs.get(user_id)
+
+
+def save_dialog(user_id, dialog):
+    """Сохраняет изменения диалога, сделанные вне обработчика шага (например, командой)."""
+    user_dialogs.set(user_id, dialog)
+
+
+def end_dialog(user_id):
+    user_dialogs.delete(user_id)
+
+
+def close_dialogs():
+    """Сохраняет незаписанные изменения диалогов (при остановке бота)."""
+    user_dialogs.close()
+
+
+async def dispatch(message):
+    """Передает сообщение обработчику текущего шага пользователя.
+
+    Возвращает False, если пользователь не находится в диалоге.
+    """
+    user_id = message.from_user.id
+    dialog = user_dialogs.get(user_id)
+    if dialog is None:
+        return False
+
+    key = (dialog.flow, dialog.step)
+    handler = STEP_HANDLERS.get(key)
+    if handler is None:
+        logging.error(f"Нет обработчика для шага {key}")
+        end_dialog(user_id)
+        return False
+
+    if message.text is None and key not in FILE_STEPS:
+        reply(message, "Ожидается текстовое сообщение.")
+        return True
+
+    with metrics.HandlerTimer(f"{dialog.flow}:{dialog.step}"):
+        await handler(message, dialog)
+
+    # Сохраняем изменения шага, если обработчик не завершил и не заменил диалог
+    if user_dialogs.get(user_id) is dialog:
+        user_dialogs.set(user_id, dialog)
+    return True
@@ -0,0 +1,200 @@
+# Разбор планов EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) для /explain и история времени
+# запросов к таблицам для /profile: по ней видно, что запрос к таблице стал заметно медленнее
+import os
+import time
+from collections import OrderedDict, deque
+from statistics import median
+
+from db import connection_target
+
+# Сколько последних замеров хранится для одной таблицы и для скольких таблиц (вытесняются давно не использованные)
+PROFILE_HISTORY_SIZE = int(os.getenv('PROFILE_HISTORY_SIZE', 50))
+PROFILE_MAX_TABLES = int(os.getenv('PROFILE_MAX_TABLES', 1000))
+
+# Замедление: медиана последних PROFILE_RECENT замеров операции больше медианы
+# предыдущих (не меньше PROFILE_RECENT) в PROFILE_REGRESSION_RATIO раз
+PROFILE_RECENT = 5
+PROFILE_REGRESSION_RATIO = 2.0
+
+# Seq Scan, фильтр которого отбросил столько строк, - кандидат на индекс
+PLAN_SEQ_SCAN_REMOVED_ROWS = 1000
+
+# Ошибка оценки числа строк планировщиком (во сколько раз) и минимальное число строк, при котором она важна
+PLAN_ESTIMATE_ERROR = 10
+PLAN_ESTIMATE_MIN_ROWS = 100
+
+# Сколько самых затратных узлов и сколько узлов дерева плана показывается
+PLAN_TOP_NODES = 3
+PLAN_SHOWN_NODES = 15
+
+
+def _children(node):
+    return node.get('Plans', ())
+
+
+def _walk(node, depth=0):
+    yield node, depth
+    for child in _children(node):
+        yield from _walk(child, depth + 1)
+
+
+def _total_ms(node):
+    # Actual Total Time - время одного выполнения узла, узел мог выполняться несколько раз
+    return node.get('Actual Total Time', 0.0) * node.get('Actual Loops', 1)
+
+
+def _self_ms(node):
+    return max(0.0, _total_ms(node) - sum(_total_ms(child) for child in _children(node)))
+
+
+def _actual_rows(node):
+    return node.get('Actual Rows', 0) * node.get('Actual Loops', 1)
+
+
+def _estimated_rows(node):
+    return node.get('Plan Rows', 0) * node.get('Actual Loops', 1)
+
+
+def node_label(node):
+    label = node['Node Type']
+    if 'Relation Name' in node:
+        label += f" on {node['Relation Name']}"
+    if 'Index Name' in node:
+        label += f" using {node['Index Name']}"
+    return label
+
+
+def _problems(plan):
+    problems = []
+    for node, _ in _walk(plan):
+        relation = node.get('Relation Name')
+        removed = node.get('Rows Removed by Filter', 0) * node.get('Actual Loops', 1)
+        if node['Node Type'] == 'Seq Scan' and removed >= PLAN_SEQ_SCAN_REMOVED_ROWS:
+            problems.append(
+                f"Seq Scan по {relation}: фильтр отбросил {removed} строк из {removed + _actual_rows(node)} "
+                f"по условию {node.get('Filter', '')} - возможно, не хватает индекса.")
+
+        actual, estimated = _actual_rows(node), _estimated_rows(node)
+        if max(actual, estimated) >= PLAN_ESTIMATE_MIN_ROWS:
+            error = max(actual, estimated) / max(min(actual, estimated), 1)
+            if error >= PLAN_ESTIMATE_ERROR:
+                hint = f" - обновите статистику: ANALYZE {relation}" if relation else ""
+                problems.append(f"{node_label(node)}: планировщик ожидал {estimated} строк, "
+                                f"получено {actual} (ошибка в {error:.0f} раз){hint}.")
+
+        if node.get('Sort Space Type') == 'Disk':
+            problems.append(f"Сортировка на диске ({node.get('Sort Space Used', 0)} КБ) - не хватает work_mem.")
+    return problems
+
+
+def summarize_plan(result):
+    """Текстовая сводка плана: время, самые затратные узлы, буферы и найденные проблемы.
+
+    result - разобранный JSON из EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON).
+    """
+    top = result[0]
+    plan = top['Plan']
+    lines = [f"Время: планирование {top.get('Planning Time', 0):.2f} мс, "
+             f"выполнение {top.get('Execution Time', 0):.2f} мс."]
+
+    hit, read = plan.get('Shared Hit Blocks', 0), plan.get('Shared Read Blocks', 0)
+    if hit or read:
+        lines.append(f"Буферы: из кэша {hit}, прочитано с диска {read}.")
+
+    nodes = list(_walk(plan))
+    total = _total_ms(plan) or 1.0
+    costly = sorted((node for node, _ in nodes), key=_self_ms, reverse=True)[:PLAN_TOP_NODES]
+    lines.append("\nСамые затратные узлы:")
+    lines += [f"- {node_label(node)}: {_self_ms(node):.2f} мс ({_self_ms(node) / total:.0%}), "
+              f"строк {_actual_rows(node)} (оценка {_estimated_rows(node)})" for node in costly]
+
+    lines.append("\nПлан:")
+    lines += [f"{'  ' * depth}{node_label(node)} ({_total_ms(node):.2f} мс, строк {_actual_rows(node)})"
+              for node, depth in nodes[:PLAN_SHOWN_NODES]]
+    if len(nodes) > PLAN_SHOWN_NODES:
+        lines.append(f"... и еще узлов: {len(nodes) - PLAN_SHOWN_NODES}")
+
+    problems = _problems(plan)
+    lines.append("\nПроблемы:" if problems else "\nЯвных проблем не найдено.")
+    lines += [f"- {problem}" for problem in problems]
+    return "\n".join(lines)
+
+
+class Sample:
+    """Один замер запроса к таблице."""
+    __slots__ = ('time', 'operation', 'seconds', 'rows', 'note')
+
+    def __init__(self, operation, seconds, rows=None, note=None):
+        self.time = time.time()
+        self.operation = operation
+        self.seconds = seconds
+        self.rows = rows
+        self.note = note
+
+
+# (база подключения, таблица) -> deque последних замеров; порядок - от давно не использованных
+_history = OrderedDict()
+
+
+def _history_key(user_id, table_name):
+    # История общая для всех пользователей одной базы: таблица одна и та же
+    return connection_target(user_id), table_name
+
+
+def record(user_id, table_name, operation, seconds, rows=None, note=None):
+    """Добавляет замер операции (select, insert, update, explain <операция>) к истории таблицы."""
+    key = _history_key(user_id, table_name)
+    samples = _history.get(key)
+    if samples is None:
+        samples = _history[key] = deque(maxlen=PROFILE_HISTORY_SIZE)
+        while len(_history) > PROFILE_MAX_TABLES:
+            _history.popitem(last=False)
+    else:
+        _history.move_to_end(key)
+    samples.append(Sample(operation, seconds, rows, note))
+
+
+def record_plan(user_id, table_name, operation, result):
+    """Добавляет к истории время выполнения из плана /explain и самый затратный узел."""
+    top = result[0]
+    costly = max((node for node, _ in _walk(top['Plan'])), key=_self_ms)
+    record(user_id, table_name, f"explain {operation}", top.get('Execution Time', 0) / 1000,
+           _actual_rows(top['Plan']), node_label(costly))
+
+
+def regression(samples):
+    """(медиана последних, медиана предыдущих) в секундах, если операция заметно замедлилась, иначе None."""
+    if len(samples) < 2 * PROFILE_RECENT:
+        return None
+    recent = median(s.seconds for s in samples[-PROFILE_RECENT:])
+    before = median(s.seconds for s in samples[:-PROFILE_RECENT])
+    if before > 0 and recent >= PROFILE_REGRESSION_RATIO * before:
+        return recent, before
+    return None
+
+
+def format_history(user_id, table_name):
+    """Сводка истории таблицы по операциям или None, если замеров нет."""
+    samples = _history.get(_history_key(user_id, table_name))
+    if not samples:
+        return None
+
+    operations = {}
+    for sample in samples:
+        operations.setdefault(sample.operation, []).append(sample)
+
+    lines = [f"Запросы к таблице '{table_name}' (последние {len(samples)}):"]
+    for operation, op_samples in operations.items():
+        last = ", ".join(f"{s.seconds * 1000:.1f}" for s in op_samples[-PROFILE_RECENT:])
+        lines.append(f"\n{operation}: замеров {len(op_samples)}, "
+                     f"медиана {median(s.seconds for s in op_samples) * 1000:.1f} мс, последние: {last} мс")
+        slowdown = regression(op_samples)
+        if slowdown is not None:
+            recent, before = slowdown
+            lines.append(f"  Замедление: медиана последних {PROFILE_RECENT} - {recent * 1000:.1f} мс "
+                         f"против {before * 1000:.1f} мс раньше. Проверьте план через /explain.")
+        last_sample = op_samples[-1]
+        if last_sample.note:
+            lines.append(f"  Последний план ({time.strftime('%H:%M:%S', time.localtime(last_sample.time))}): "
+                         f"{last_sample.note}")
+    return "\n".join(lines)
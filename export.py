@@ -0,0 +1,192 @@
+# Экспорт результатов выборки в файл: CSV, CSV.gz, JSON Lines и (при наличии pyarrow) Parquet
+import asyncio
+import csv
+import gzip
+import io
+import json
+import tempfile
+
+from aiogram.types import InputFile
+
+import offload
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Сколько строк читается из курсора за раз (и сколько строк в одной группе Parquet)
+EXPORT_CHUNK_ROWS = 5000
+
+# Файл хранится в памяти до этого размера, затем сбрасывается на диск
+EXPORT_SPOOL_SIZE = 4 * 1024 * 1024
+
+# Ограничение Telegram на размер отправляемого ботом документа
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+
+class ExportTooLargeError(Exception):
+    """Файл превысил TELEGRAM_DOCUMENT_LIMIT еще во время записи."""
+
+
+class SpooledInputFile(InputFile):
+    """Отправка временного файла в Telegram частями, без чтения его целиком в память."""
+
+    def __init__(self, spool, filename):
+        super().__init__(filename=filename)
+        self.spool = spool
+
+    async def read(self, bot):
+        self.spool.seek(0)
+        while chunk := self.spool.read(self.chunk_size):
+            yield chunk
+
+
+def available_formats():
+    formats = ['csv', 'csv.gz', 'jsonl']
+    if pyarrow is not None:
+        formats.append('parquet')
+    return formats
+
+
+def new_spool():
+    return tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+
+
+async def read_chunks(records, size=EXPORT_CHUNK_ROWS):
+    """Читает записи курсора порциями по size строк; строки - кортежи значений."""
+    chunk = []
+    async for record in records:
+        chunk.append(tuple(record))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Кодирование порций выполняется в пуле offload, в цикле событий остается только запись в файл
+
+def encode_csv(rows, header=None):
+    buffer = io.StringIO(newline='')
+    writer = csv.writer(buffer)
+    if header is not None:
+        writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def encode_csv_gz(rows, header=None):
+    # Каждая порция - отдельный gzip-член; их последовательность - корректный .gz-файл
+    return gzip.compress(encode_csv(rows, header))
+
+
+def encode_jsonl(rows, columns):
+    return b''.join(
+        json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str).encode('utf-8') + b'\n'
+        for row in rows)
+
+
+# Типы колонок Parquet по data_type из information_schema. numeric пишется строкой, чтобы
+# не терять точность (масштаб у колонки без ограничений свой у каждого значения); uuid, json,
+# массивы и прочие типы без точного соответствия - тоже строкой
+if pyarrow is not None:
+    PARQUET_TYPES = {
+        'smallint': pyarrow.int16(),
+        'integer': pyarrow.int32(),
+        'bigint': pyarrow.int64(),
+        'real': pyarrow.float32(),
+        'double precision': pyarrow.float64(),
+        'boolean': pyarrow.bool_(),
+        'bytea': pyarrow.binary(),
+        'date': pyarrow.date32(),
+        'time without time zone': pyarrow.time64('us'),
+        'timestamp without time zone': pyarrow.timestamp('us'),
+        'timestamp with time zone': pyarrow.timestamp('us', tz='UTC'),
+        'interval': pyarrow.duration('us'),
+    }
+
+
+def parquet_schema(columns, column_types):
+    """Схема файла строится заранее по типам колонок, а не выводится из первой порции:
+    иначе колонка из одних NULL в первой порции получает тип null и следующие порции не сходятся."""
+    return pyarrow.schema([(col, PARQUET_TYPES.get(data_type, pyarrow.string()))
+                           for col, data_type in zip(columns, column_types)])
+
+
+def _parquet_values(values, arrow_type):
+    if arrow_type != pyarrow.string():
+        return list(values)
+    return [value if value is None or isinstance(value, str) else str(value) for value in values]
+
+
+def encode_parquet(rows, schema):
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array(_parquet_values(values, field.type), type=field.type)
+         for values, field in zip(zip(*rows), schema)],
+        schema=schema)
+
+
+def check_size(spool):
+    """Прерывает выгрузку, как только файл перестал помещаться в лимит Telegram."""
+    if spool.tell() > TELEGRAM_DOCUMENT_LIMIT:
+        raise ExportTooLargeError()
+
+
+async def _write_csv(records, columns, spool, encode):
+    header = columns
+    count = 0
+    async for rows in read_chunks(records):
+        spool.write(await offload.run(encode, rows, header))
+        check_size(spool)
+        header = None
+        count += len(rows)
+    if header is not None:
+        spool.write(encode([], header))
+    return count
+
+
+# Писатели получают курсор, имена колонок, их типы (data_type) и файл; возвращают число строк.
+# Размер файла проверяется после каждой порции, чтобы не выгружать заведомо неотправляемый файл
+
+async def write_csv(records, columns, column_types, spool):
+    return await _write_csv(records, columns, spool, encode_csv)
+
+
+async def write_csv_gz(records, columns, column_types, spool):
+    return await _write_csv(records, columns, spool, encode_csv_gz)
+
+
+async def write_jsonl(records, columns, column_types, spool):
+    count = 0
+    async for rows in read_chunks(records):
+        spool.write(await offload.run(encode_jsonl, rows, columns))
+        check_size(spool)
+        count += len(rows)
+    return count
+
+
+async def write_parquet(records, columns, column_types, spool):
+    schema = parquet_schema(columns, column_types)
+    # Пустой результат дает файл только со схемой
+    writer = pyarrow.parquet.ParquetWriter(spool, schema)
+    count = 0
+    try:
+        async for rows in read_chunks(records):
+            table = await offload.run(encode_parquet, rows, schema)
+            # Сжатие группы строк тоже выполняется вне цикла событий
+            await asyncio.to_thread(writer.write_table, table)
+            check_size(spool)
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+EXPORT_WRITERS = {
+    'csv': write_csv,
+    'csv.gz': write_csv_gz,
+    'jsonl': write_jsonl,
+    'parquet': write_parquet,
+}
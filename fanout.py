@@ -0,0 +1,167 @@
+# Один запрос на чтение сразу на нескольких сохраненных подключениях (/fanout), например на шардах.
+# Подключения опрашиваются одновременно (не больше FANOUT_CONCURRENCY сразу) с таймаутом на каждое,
+# поэтому общее время равно времени самого медленного подключения, а не сумме
+import asyncio
+import html
+import os
+import re
+import time
+from contextlib import aclosing
+
+import offload
+import paging
+from db import iterate, open_saved_connection
+
+# Сколько подключений опрашивается одновременно
+FANOUT_CONCURRENCY = int(os.getenv('FANOUT_CONCURRENCY', 8))
+
+# Таймаут запроса на одном подключении, в секундах
+FANOUT_TIMEOUT = float(os.getenv('FANOUT_TIMEOUT', 30))
+
+# Подключения, ответившие дольше, перечисляются отдельно как медленные
+FANOUT_SLOW_SECONDS = float(os.getenv('FANOUT_SLOW_SECONDS', 5))
+
+# Сколько строк читается с одного подключения (остальные не передаются)
+FANOUT_MAX_ROWS = 20
+
+# До скольких символов обрезается текст ошибки подключения и сколько ошибок показывается
+FANOUT_ERROR_WIDTH = 200
+FANOUT_SHOWN_ERRORS = 10
+
+# Колонка с именем подключения в объединенном результате
+TARGET_COLUMN = 'connection'
+
+_READ_QUERY = re.compile(r'(select|with|values|table)\b', re.IGNORECASE)
+
+
+class TargetResult:
+    """Результат одного подключения; строки добавляются по мере чтения курсора."""
+    __slots__ = ('name', 'columns', 'rows', 'more', 'elapsed', 'error', 'timed_out')
+
+    def __init__(self, name):
+        self.name = name
+        self.columns = None
+        self.rows = []
+        self.more = False
+        self.elapsed = None
+        self.error = None
+        self.timed_out = False
+
+    @property
+    def ok(self):
+        return self.error is None and not self.timed_out
+
+
+def validate_query(query):
+    """Запрос без завершающей ';' или None, если это не один запрос на чтение.
+
+    Запрос в любом случае выполняется в транзакции только для чтения.
+    """
+    query = query.strip().rstrip(';').strip()
+    if not _READ_QUERY.match(query) or ';' in query:
+        return None
+    return query
+
+
+async def _query_target(user_id, result, query):
+    owner = await open_saved_connection(user_id, result.name)
+    async with aclosing(iterate(owner, query, prefetch=FANOUT_MAX_ROWS + 1, timeout=FANOUT_TIMEOUT)) as records:
+        async for record in records:
+            if result.columns is None:
+                result.columns = list(record.keys())
+            if len(result.rows) == FANOUT_MAX_ROWS:
+                result.more = True
+                break
+            result.rows.append(tuple(record))
+
+
+async def _run_target(user_id, result, query, semaphore):
+    async with semaphore:
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(_query_target(user_id, result, query), FANOUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            result.timed_out = True
+        except Exception as e:
+            result.error = f"{type(e).__name__}: {e}"[:FANOUT_ERROR_WIDTH]
+        finally:
+            result.elapsed = time.monotonic() - started
+
+
+async def run_fanout(user_id, names, query, concurrency=FANOUT_CONCURRENCY):
+    """Выполняет query на сохраненных подключениях names; возвращает (результаты, общее время)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    results = [TargetResult(name) for name in names]
+    started = time.monotonic()
+    outcomes = await asyncio.gather(*(_run_target(user_id, result, query, semaphore) for result in results),
+                                    return_exceptions=True)
+    # Запрос, отмененный через /cancel, завершается CancelledError только на своем подключении
+    for result, outcome in zip(results, outcomes):
+        if isinstance(outcome, asyncio.CancelledError):
+            result.error = "запрос отменен"
+    return results, time.monotonic() - started
+
+
+def _notes(results, mismatched, truncated):
+    notes = []
+    slow = [r for r in results if r.ok and r.elapsed >= FANOUT_SLOW_SECONDS]
+    if slow:
+        notes.append(f"Медленные (дольше {FANOUT_SLOW_SECONDS:g} с): "
+                     + ", ".join(f"{r.name} ({r.elapsed:.2f} с)" for r in slow))
+    timed_out = [r for r in results if r.timed_out]
+    if timed_out:
+        notes.append(f"Превышен таймаут {FANOUT_TIMEOUT:g} с: "
+                     + ", ".join(f"{r.name} (получено строк: {len(r.rows)})" for r in timed_out))
+    failed = [r for r in results if r.error is not None]
+    if failed:
+        lines = [f"{r.name}: {r.error}" for r in failed[:FANOUT_SHOWN_ERRORS]]
+        if len(failed) > FANOUT_SHOWN_ERRORS:
+            lines.append(f"и еще {len(failed) - FANOUT_SHOWN_ERRORS}")
+        notes.append("Ошибки:\n" + "\n".join(lines))
+    if mismatched:
+        notes.append("Другой набор колонок, строки не показаны: " + ", ".join(mismatched))
+    if truncated:
+        notes.append("Показаны не все строки: " + ", ".join(truncated))
+    return notes
+
+
+async def format_fanout(results, elapsed):
+    """Объединяет строки успешных подключений в одну таблицу с колонкой подключения.
+
+    Возвращает (текст, параметры отправки) для reply.
+    """
+    ok = [r for r in results if r.ok]
+    header = f"Подключений: {len(results)}, успешно: {len(ok)}. Общее время: {elapsed:.2f} с"
+    slowest = max(results, key=lambda r: r.elapsed or 0, default=None)
+    if slowest is not None and slowest.elapsed is not None:
+        header += f", самое медленное: {slowest.name} ({slowest.elapsed:.2f} с)"
+    header += "."
+
+    columns = next((r.columns for r in ok if r.columns is not None), None)
+    rows = []
+    row_owners = []
+    mismatched = []
+    for r in ok:
+        if r.columns is not None and r.columns != columns:
+            mismatched.append(r.name)
+            continue
+        rows += [(r.name, *row) for row in r.rows]
+        row_owners += [r.name] * len(r.rows)
+
+    # Сначала считаем служебные строки, остаток сообщения отдается под таблицу
+    notes = _notes(results, mismatched, [r.name for r in ok if r.more])
+    reserve = len(header) + sum(len(note) + 2 for note in notes) + paging.PAGE_HEADER_RESERVE
+    text, used, is_html = '', 0, False
+    if rows:
+        text, used, is_html = await offload.run(
+            paging.format_page, rows, [TARGET_COLUMN, *columns], paging.MESSAGE_LIMIT - reserve)
+        if used < len(rows):
+            cut = sorted(set(row_owners[used:]) - {r.name for r in ok if r.more})
+            notes = _notes(results, mismatched, [r.name for r in ok if r.more] + cut)
+    elif ok:
+        text = "Запрос не вернул строк."
+
+    # Таблица уже экранирована, остальное - имена подключений и тексты ошибок
+    escape = html.escape if is_html else str
+    parts = [escape(header), text, *(escape(note) for note in notes)]
+    return "\n\n".join(part for part in parts if part), {'parse_mode': 'HTML'} if is_html else {}
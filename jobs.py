@@ -0,0 +1,205 @@
+# Фоновые задачи для тяжелых операций: очередь, ограниченное число исполнителей и прогресс
+import asyncio
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from db import QueryCancelledError
+from sender import MESSAGE_LIMIT, send
+
+# Сколько задач выполняется одновременно и сколько может ждать в очереди
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 100))
+
+# Сколько завершенных задач помнить для /jobs и /job
+JOB_HISTORY_SIZE = 1000
+
+# Как часто (в секундах) обновлять сообщение с прогрессом
+JOB_PROGRESS_INTERVAL = 2
+
+STATUS_TITLES = {
+    'queued': 'в очереди',
+    'running': 'выполняется',
+    'done': 'завершена',
+    'failed': 'ошибка',
+    'cancelled': 'отменена',
+}
+
+
+class Job:
+    __slots__ = ('id', 'user_id', 'chat_id', 'title', 'func', 'status', 'progress', 'result',
+                 'message_id', 'created', 'started', 'finished', 'task', 'last_progress')
+
+    def __init__(self, job_id, user_id, chat_id, title, func):
+        self.id = job_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.title = title
+        self.func = func
+        self.status = 'queued'
+        self.progress = ''
+        self.result = ''
+        self.message_id = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.task = None
+        self.last_progress = 0.0
+
+    def describe(self):
+        text = f"Задача #{self.id} ({self.title}): {STATUS_TITLES[self.status]}"
+        if self.status == 'running' and self.progress:
+            text += f"\n{self.progress}"
+        if self.finished and self.started:
+            text += f"\nВремя выполнения: {self.finished - self.started:.1f} с"
+        if self.result:
+            text += f"\n{self.result}"
+        return text
+
+
+class QueueFullError(Exception):
+    """Очередь задач переполнена."""
+
+
+_bot = None
+_queue = None
+_workers = []
+_jobs = OrderedDict()  # id -> Job; завершенные вытесняются сверх JOB_HISTORY_SIZE
+_job_ids = itertools.count(1)
+
+
+async def _edit_status(job, text):
+    if job.message_id is None:
+        return
+    try:
+        await _bot.edit_message_text(text[:MESSAGE_LIMIT], chat_id=job.chat_id, message_id=job.message_id)
+    except Exception as e:
+        # Например, текст не изменился или сообщение удалено
+        logging.debug(f"Не удалось обновить сообщение задачи #{job.id}: {e}")
+
+
+async def set_progress(job, text):
+    """Обновляет прогресс задачи; сообщение редактируется не чаще JOB_PROGRESS_INTERVAL."""
+    job.progress = text
+    now = time.monotonic()
+    if now - job.last_progress >= JOB_PROGRESS_INTERVAL:
+        job.last_progress = now
+        await _edit_status(job, job.describe())
+
+
+async def submit(user_id, chat_id, title, func):
+    """Ставит задачу в очередь. func(job) - корутина, возвращающая текст результата."""
+    job = Job(next(_job_ids), user_id, chat_id, title, func)
+    # Задача ставится в очередь до отправки сообщения: пока оно отправляется,
+    # параллельные вызовы могли бы заполнить очередь
+    try:
+        _queue.put_nowait(job)
+    except asyncio.QueueFull:
+        raise QueueFullError("Слишком много задач в очереди, попробуйте позже.")
+    _jobs[job.id] = job
+    _trim_history()
+
+    text = job.describe()
+    try:
+        message = await _bot.send_message(chat_id, text)
+        job.message_id = message.message_id
+    except Exception as e:
+        logging.error(f"Не удалось отправить сообщение задачи #{job.id}: {e}")
+        return job
+    # Исполнитель мог взять задачу, пока отправлялось сообщение
+    if job.describe() != text:
+        await _edit_status(job, job.describe())
+    return job
+
+
+async def _run(job):
+    job.status = 'running'
+    job.started = time.time()
+    await _edit_status(job, job.describe())
+
+    # Задача выполняется в отдельной asyncio-задаче, чтобы /cancel мог прервать ее, не трогая исполнителя
+    job.task = asyncio.create_task(job.func(job))
+    try:
+        await asyncio.wait([job.task])
+    except asyncio.CancelledError:
+        job.task.cancel()
+        raise
+
+    try:
+        job.result = job.task.result() or ''
+        job.status = 'done'
+    except (asyncio.CancelledError, QueryCancelledError):
+        job.status = 'cancelled'
+    except Exception as e:
+        logging.error(f"Ошибка задачи #{job.id}: {e}")
+        job.status = 'failed'
+        job.result = str(e)[:500]
+    finally:
+        job.finished = time.time()
+        job.func = None
+        job.task = None
+
+    text = job.describe()
+    if len(text) <= MESSAGE_LIMIT and job.message_id is not None:
+        await _edit_status(job, text)
+    else:
+        send(job.chat_id, text)
+
+
+async def _worker():
+    while True:
+        job = await _queue.get()
+        try:
+            if job.status == 'queued':
+                await _run(job)
+            else:
+                # Задача отменена, пока ждала в очереди
+                await _edit_status(job, job.describe())
+        finally:
+            _queue.task_done()
+
+
+def _trim_history():
+    finished = [job_id for job_id, job in _jobs.items() if job.status not in ('queued', 'running')]
+    for job_id in finished[:max(0, len(_jobs) - JOB_HISTORY_SIZE)]:
+        del _jobs[job_id]
+
+
+def get_job(job_id):
+    return _jobs.get(job_id)
+
+
+def user_jobs(user_id):
+    return [job for job in _jobs.values() if job.user_id == user_id]
+
+
+def cancel_user_jobs(user_id):
+    """Отменяет задачи пользователя: ожидающие снимаются с очереди, выполняющиеся прерываются."""
+    cancelled = 0
+    for job in user_jobs(user_id):
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            job.finished = time.time()
+            cancelled += 1
+        elif job.status == 'running' and job.task is not None:
+            job.task.cancel()
+            cancelled += 1
+    return cancelled
+
+
+def start_jobs(bot, workers=JOB_WORKERS):
+    global _bot, _queue
+    _bot = bot
+    _queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+    for _ in range(workers):
+        _workers.append(asyncio.create_task(_worker()))
+
+
+async def stop_jobs():
+    """Останавливает исполнителей; незавершенные задачи отменяются."""
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
@@ -0,0 +1,254 @@
+# Метрики обработчиков и запросов к базе: гистограммы задержек, счетчики строк, байтов и ошибок.
+# Отдаются в текстовом формате Prometheus (METRICS_PORT) и кратко - командой /metrics
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+# Порт HTTP-сервера с метриками для Prometheus (0 - не запускать)
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+
+# Запросы дольше порога (в секундах) записываются в лог медленных запросов (0 - выключено)
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_SECONDS', 0))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+ROWS_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Обработчик (команда или шаг диалога), в рамках которого выполняется запрос.
+# Фоновые задачи наследуют значение от обработчика, который их создал
+current_operation = ContextVar('current_operation', default='-')
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля: верхняя граница корзины, в которую он попадает."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+
+# (имя, метки) -> Histogram или значение счетчика; метки - кортеж пар (имя, значение)
+_histograms = {}
+_counters = {}
+_help = {}
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = (name, _labels(labels))
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram(buckets)
+    histogram.observe(value)
+
+
+def inc(name, value=1, **labels):
+    key = (name, _labels(labels))
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def describe(name, text):
+    _help[name] = text
+
+
+describe('tgbot_handler_seconds', 'Время обработки команды или шага диалога')
+describe('tgbot_handler_errors_total', 'Необработанные ошибки обработчиков по типу')
+describe('tgbot_db_query_seconds', 'Время выполнения запроса без ожидания соединения')
+describe('tgbot_db_pool_wait_seconds', 'Ожидание свободного соединения в пуле')
+describe('tgbot_db_rows', 'Строк возвращено или загружено одним запросом')
+describe('tgbot_db_errors_total', 'Ошибки запросов по типу')
+describe('tgbot_db_slow_queries_total', 'Запросы дольше SLOW_QUERY_SECONDS')
+describe('tgbot_sent_messages_total', 'Отправленные сообщения')
+describe('tgbot_sent_bytes_total', 'Отправлено байтов в сообщениях и файлах')
+
+
+class HandlerTimer:
+    """Замеряет время обработчика и считает ошибки; label - команда или шаг диалога."""
+    __slots__ = ('label', 'started', 'token')
+
+    def __init__(self, label):
+        self.label = label
+
+    def __enter__(self):
+        self.token = current_operation.set(self.label)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe('tgbot_handler_seconds', time.perf_counter() - self.started, handler=self.label)
+        if exc_type is not None:
+            inc('tgbot_handler_errors_total', handler=self.label, error=exc_type.__name__)
+        current_operation.reset(self.token)
+
+
+class QueryTimer:
+    """Замеряет запрос к базе: ожидание соединения (acquired()), выполнение, строки и ошибки."""
+    __slots__ = ('operation', 'user_id', 'query', 'started', 'acquired_at', 'rows')
+
+    def __init__(self, operation, user_id, query):
+        self.operation = operation
+        self.user_id = user_id
+        self.query = query
+        self.rows = None
+        self.acquired_at = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def acquired(self):
+        self.acquired_at = time.perf_counter()
+        observe('tgbot_db_pool_wait_seconds', self.acquired_at - self.started, operation=self.operation)
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - (self.acquired_at or self.started)
+        step = current_operation.get()
+        observe('tgbot_db_query_seconds', duration, operation=self.operation, step=step)
+        if self.rows is not None:
+            observe('tgbot_db_rows', self.rows, buckets=ROWS_BUCKETS, operation=self.operation)
+        # GeneratorExit - читатель курсора остановился сам (например, страница заполнена)
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            inc('tgbot_db_errors_total', operation=self.operation, error=exc_type.__name__)
+        if SLOW_QUERY_SECONDS and duration >= SLOW_QUERY_SECONDS:
+            inc('tgbot_db_slow_queries_total', operation=self.operation, step=step)
+            logging.warning(f"Медленный запрос {duration:.2f} с ({self.operation}, {step}, "
+                            f"пользователь {self.user_id}): {' '.join(self.query.split())[:300]}")
+
+
+def sent(size):
+    inc('tgbot_sent_messages_total')
+    inc('tgbot_sent_bytes_total', size)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware маршрутизатора: вызывается только для сработавших обработчиков."""
+
+    async def __call__(self, handler, event, data):
+        with HandlerTimer(_handler_label(event, data)):
+            return await handler(event, data)
+
+
+def _handler_label(event, data):
+    if isinstance(getattr(event, 'data', None), str):
+        return f"callback:{event.data}"
+    text = getattr(event, 'text', None) or ''
+    if text.startswith('/'):
+        return text.split(maxsplit=1)[0].split('@', 1)[0]
+    # Текстовые команды вроде "отмена" - по имени функции-обработчика
+    return data['handler'].callback.__name__
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    typed = set()
+
+    def header(name, kind):
+        if name not in typed:
+            typed.add(name)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), histogram in sorted(_histograms.items()):
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+    for (name, labels), value in sorted(_counters.items()):
+        header(name, 'counter')
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def summary(limit=10):
+    """Краткая сводка для /metrics: самые затратные обработчики и запросы, ошибки."""
+    def top(name, label):
+        rows = [(dict(labels).get(label), h) for (n, labels), h in _histograms.items() if n == name]
+        rows.sort(key=lambda item: item[1].sum, reverse=True)
+        return [f"{key}: {h.count} шт., среднее {1000 * h.sum / h.count:.0f} мс, p95 ≤{1000 * h.quantile(0.95):.0f} мс"
+                for key, h in rows[:limit] if h.count]
+
+    lines = ["Обработчики (по суммарному времени):"]
+    lines += top('tgbot_handler_seconds', 'handler') or ["нет данных"]
+    lines.append("\nЗапросы к базе по шагам:")
+    lines += top('tgbot_db_query_seconds', 'step') or ["нет данных"]
+
+    waits = [h for (n, _), h in _histograms.items() if n == 'tgbot_db_pool_wait_seconds']
+    waited = sum(h.count for h in waits)
+    if waited:
+        lines.append(f"\nОжидание соединения: среднее {1000 * sum(h.sum for h in waits) / waited:.1f} мс")
+
+    errors = [(dict(labels), value) for (n, labels), value in _counters.items()
+              if n in ('tgbot_handler_errors_total', 'tgbot_db_errors_total')]
+    if errors:
+        lines.append("\nОшибки:")
+        lines += [f"{labels.get('handler') or labels.get('operation')}: {labels['error']} - {value}"
+                  for labels, value in sorted(errors, key=lambda item: -item[1])[:limit]]
+
+    slow = sum(value for (n, _), value in _counters.items() if n == 'tgbot_db_slow_queries_total')
+    sent_bytes = _counters.get(('tgbot_sent_bytes_total', ()), 0)
+    lines.append(f"\nМедленных запросов: {slow}, отправлено: {sent_bytes / 1024:.0f} КБ")
+    return "\n".join(lines)
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Запускает HTTP-сервер с метриками; возвращает runner для остановки или None."""
+    if not port:
+        return None
+
+    async def handle_metrics(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на {host}:{port}{METRICS_PATH}")
+    return runner
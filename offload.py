@@ -0,0 +1,44 @@
+# Пул для форматирования результатов и кодирования файлов вне цикла событий, чтобы большой
+# результат одного пользователя не задерживал обновления остальных.
+# Строки передаются в пул кортежами значений, а не объектами asyncpg.Record.
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# thread - пул потоков, process - пул процессов (использует несколько ядер),
+# inline - форматирование прямо в цикле событий
+RENDER_EXECUTOR = os.getenv('RENDER_EXECUTOR', 'thread')
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+
+_executor = None
+
+
+def start_render_pool(kind=RENDER_EXECUTOR, workers=RENDER_WORKERS):
+    global _executor
+    if kind == 'process':
+        _executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    elif kind == 'thread':
+        _executor = ThreadPoolExecutor(workers, thread_name_prefix='render')
+    elif kind != 'inline':
+        logging.error(f"Неизвестный RENDER_EXECUTOR={kind}, форматирование выполняется в цикле событий.")
+
+
+async def run(func, *args):
+    """Выполняет func(*args) в пуле; func и аргументы должны сериализоваться для пула процессов."""
+    if _executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+def stop_render_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+def to_rows(records):
+    """Записи asyncpg -> компактные кортежи значений для передачи в пул."""
+    return [tuple(record) for record in records]
@@ -0,0 +1,161 @@
+# Постраничный вывод результатов /select с keyset-пагинацией
+import decimal
+import html
+import os
+
+import offload
+from sql import quote_ident, table_ref
+
+# Лимит Telegram на длину сообщения (с запасом под заголовок)
+MESSAGE_LIMIT = 4096
+PAGE_HEADER_RESERVE = 200
+
+# Максимум строк на одной странице
+PAGE_MAX_ROWS = 50
+
+# Страница выводится моноширинной таблицей, если в ней не меньше PAGE_TABLE_MIN_ROWS строк
+# и таблица не шире PAGE_TABLE_MAX_WIDTH символов; иначе - строками "колонка=значение"
+PAGE_TABLE_MIN_ROWS = int(os.getenv('PAGE_TABLE_MIN_ROWS', 3))
+PAGE_TABLE_MAX_WIDTH = int(os.getenv('PAGE_TABLE_MAX_WIDTH', 100))
+
+# До скольких символов обрезается значение в ячейке таблицы
+PAGE_CELL_WIDTH = 40
+
+# Служебная колонка для пагинации по ctid, если у таблицы нет первичного ключа
+CTID_KEY = '__page_ctid'
+
+# ctid перед первой строкой таблицы: с него начинается первая страница таблицы без ключа
+CTID_START = (0, 0)
+
+
+def build_page_query(table_name, columns, key_columns, after_key=None, limit=PAGE_MAX_ROWS, schema=None):
+    """Строит запрос одной страницы: WHERE (ключ) > (последний ключ) ORDER BY ключ LIMIT n.
+
+    Таблица без первичного ключа читается по ctid без ORDER BY: условие ctid > $1 выполняется
+    TID Range Scan (PostgreSQL 14+), который читает только нужные страницы таблицы и отдает строки
+    в физическом порядке, так что ни одна страница вывода, включая первую, не требует полного
+    прохода и сортировки. На более старых серверах это последовательное чтение с фильтром.
+    """
+    select_exprs = [quote_ident(c) for c in columns]
+    query_from = f" FROM {table_ref(table_name, schema)}"
+    # +1 строка, чтобы узнать, есть ли следующая страница
+    limit_clause = f" LIMIT {limit + 1};"
+
+    if not key_columns:
+        select_exprs.append(f"ctid AS {CTID_KEY}")
+        query = f"SELECT {', '.join(select_exprs)}{query_from} WHERE ctid > $1::tid{limit_clause}"
+        # После сохранения сессии в JSON ctid приходит списком; кортеж нужен и для ключа result_cache
+        return query, [tuple(after_key[0]) if after_key is not None else CTID_START]
+
+    key_exprs = [quote_ident(c) for c in key_columns]
+    select_exprs += [quote_ident(c) for c in key_columns if c not in columns]
+    query = f"SELECT {', '.join(select_exprs)}{query_from}"
+    args = []
+    if after_key is not None:
+        placeholders = ', '.join(f"${i + 1}" for i in range(len(after_key)))
+        query += f" WHERE ({', '.join(key_exprs)}) > ({placeholders})"
+        args = list(after_key)
+
+    query += f" ORDER BY {', '.join(key_exprs)}{limit_clause}"
+    return query, args
+
+
+def page_columns(columns, key_columns):
+    """Колонки результата запроса страницы в порядке SELECT: выбранные, затем ключевые."""
+    if key_columns:
+        return list(columns) + [c for c in key_columns if c not in columns]
+    return list(columns) + [CTID_KEY]
+
+
+def row_key(row, names, key_columns):
+    if key_columns:
+        return tuple(row[names.index(c)] for c in key_columns)
+    return (row[names.index(CTID_KEY)],)
+
+
+def format_row(values, columns):
+    return ", ".join(f"{col}={value!r}" for col, value in zip(columns, values))
+
+
+def _cell(value):
+    text = 'NULL' if value is None else str(value).replace('\n', ' ')
+    if len(text) > PAGE_CELL_WIDTH:
+        text = text[:PAGE_CELL_WIDTH - 1] + "…"
+    return text
+
+
+def _format_table(rows, columns, max_chars):
+    # Моноширинная таблица с выравниванием колонок; None, если она не помещается по ширине
+    count = len(columns)
+    header = [_cell(col) for col in columns]
+    cells = [[_cell(value) for value in row[:count]] for row in rows]
+    widths = [max(len(header[i]), *(len(cell_row[i]) for cell_row in cells)) for i in range(count)]
+    if sum(widths) + 3 * (count - 1) > PAGE_TABLE_MAX_WIDTH:
+        return None
+
+    # Числовые колонки выравниваются по правому краю
+    numeric = [all(row[i] is None or isinstance(row[i], (int, float, decimal.Decimal)) for row in rows)
+               for i in range(count)]
+
+    def format_line(values, align=True):
+        return " | ".join(value.rjust(width) if align and is_number else value.ljust(width)
+                          for value, width, is_number in zip(values, widths, numeric)).rstrip()
+
+    lines = [html.escape(format_line(header, align=False)), "-+-".join("-" * width for width in widths)]
+    size = sum(len(line) + 1 for line in lines) + len("<pre></pre>")
+    used = 0
+    for cell_row in cells:
+        line = html.escape(format_line(cell_row))
+        if size + len(line) + 1 > max_chars:
+            break
+        lines.append(line)
+        size += len(line) + 1
+        used += 1
+    if not used:
+        return None
+    return "<pre>" + "\n".join(lines) + "</pre>", used, True
+
+
+def format_page(rows, columns, max_chars):
+    """Форматирует строки страницы (кортежи значений); выполняется в пуле offload.
+
+    Возвращает (текст, сколько строк поместилось, текст в HTML).
+    """
+    if len(rows) >= PAGE_TABLE_MIN_ROWS:
+        table = _format_table(rows, columns, max_chars)
+        if table is not None:
+            return table
+
+    lines = []
+    size = 0
+    for row in rows:
+        line = format_row(row, columns)
+        if len(line) > max_chars:
+            line = line[:max_chars - 1] + "…"
+        if lines and size + len(line) + 1 > max_chars:
+            break
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines), len(lines), False
+
+
+async def read_page_rows(records, max_rows=PAGE_MAX_ROWS):
+    """Читает из курсора не больше max_rows + 1 строки (лишняя показывает, есть ли продолжение)."""
+    rows = []
+    async for record in records:
+        rows.append(tuple(record))
+        if len(rows) > max_rows:
+            break
+    return rows
+
+
+async def render_page(rows, columns, key_columns, max_rows=PAGE_MAX_ROWS,
+                      max_chars=MESSAGE_LIMIT - PAGE_HEADER_RESERVE):
+    """Форматирует строки страницы вне цикла событий.
+
+    Возвращает (текст страницы, текст в HTML, ключ последней строки, есть ли продолжение).
+    """
+    text, used, is_html = await offload.run(format_page, rows[:max_rows], list(columns), max_chars)
+    has_more = used < len(rows)
+    last_key = row_key(rows[used - 1], page_columns(columns, key_columns), key_columns) if used else None
+    return text, is_html, last_key, has_more
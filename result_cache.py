@@ -0,0 +1,191 @@
+# Кэш страниц /select для часто читаемых таблиц.
+# Ключ - база подключения и нормализованный текст запроса с параметрами, поэтому пользователи
+# с одинаковым подключением получают общие записи. Записи живут RESULT_CACHE_TTL секунд,
+# общий объем ограничен RESULT_CACHE_MAX_BYTES (LRU) и сбрасывается при изменениях таблицы.
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from db import connection_target, on_release, open_listener, pool_targets
+
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE', 'false').lower() in ('1', 'true', 'yes')
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL', 60))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+# Сброс по LISTEN/NOTIFY для изменений, сделанных в обход бота: триггер на таблице
+# выполняет pg_notify(канал, имя таблицы), пустое сообщение сбрасывает всю базу
+RESULT_CACHE_LISTEN = os.getenv('RESULT_CACHE_LISTEN', 'false').lower() in ('1', 'true', 'yes')
+RESULT_CACHE_CHANNEL = os.getenv('RESULT_CACHE_CHANNEL', 'tg_bot_cache')
+
+# После неудачной подписки следующая попытка - не раньше чем через столько секунд;
+# пауза удваивается при каждой новой неудаче до RESULT_CACHE_LISTEN_RETRY_MAX
+RESULT_CACHE_LISTEN_RETRY = 5
+RESULT_CACHE_LISTEN_RETRY_MAX = 300
+
+# Примерные накладные расходы на одну запись кэша сверх размера данных
+ENTRY_OVERHEAD = 256
+
+
+class CacheEntry:
+    __slots__ = ('value', 'size', 'expires', 'table')
+
+    def __init__(self, value, size, expires, table):
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.table = table
+
+
+_entries = OrderedDict()  # ключ -> CacheEntry, от давно использованных к недавним
+_tables = {}  # (база, таблица) -> ключи записей этой таблицы
+_size = 0
+_listeners = {}  # база -> соединение с LISTEN
+_listen_failures = {}  # база -> (время, раньше которого не переподключаться, текущая пауза)
+
+
+def make_key(user_id, query, args=()):
+    """Ключ записи или None, если кэш выключен или параметры нельзя использовать как ключ."""
+    if not RESULT_CACHE_ENABLED:
+        return None
+    target = connection_target(user_id)
+    if target is None:
+        return None
+    key = (target, ' '.join(query.split()), tuple(args))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _remove(key):
+    global _size
+    entry = _entries.pop(key, None)
+    if entry is None:
+        return
+    _size -= entry.size
+    keys = _tables.get(entry.table)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del _tables[entry.table]
+
+
+def get(key):
+    if key is None:
+        return None
+    entry = _entries.get(key)
+    if entry is None:
+        return None
+    if entry.expires < time.monotonic():
+        _remove(key)
+        return None
+    _entries.move_to_end(key)
+    return entry.value
+
+
+async def put(user_id, key, table_name, value, size):
+    """Сохраняет результат запроса к таблице table_name; size - примерный объем в байтах."""
+    global _size
+    if key is None:
+        return
+    size += ENTRY_OVERHEAD
+    if size > RESULT_CACHE_MAX_BYTES:
+        return
+
+    if RESULT_CACHE_LISTEN:
+        await _ensure_listener(user_id, key[0])
+
+    _remove(key)
+    table = (key[0], table_name)
+    _entries[key] = CacheEntry(value, size, time.monotonic() + RESULT_CACHE_TTL, table)
+    _tables.setdefault(table, set()).add(key)
+    _size += size
+
+    while _size > RESULT_CACHE_MAX_BYTES:
+        _remove(next(iter(_entries)))
+
+
+def invalidate_table(user_id, table_name):
+    """Сбрасывает записи таблицы после изменения ее данных или структуры ботом."""
+    target = connection_target(user_id)
+    if target is not None:
+        _invalidate(target, table_name)
+
+
+def _invalidate(target, table_name):
+    for key in list(_tables.get((target, table_name), ())):
+        _remove(key)
+
+
+def _invalidate_target(target):
+    for key in [key for key in _entries if key[0] == target]:
+        _remove(key)
+
+
+async def _ensure_listener(user_id, target):
+    if target in _listeners:
+        return
+    failure = _listen_failures.get(target)
+    if failure is not None and time.monotonic() < failure[0]:
+        return
+
+    def on_notify(connection, pid, channel, payload):
+        # Имя может прийти со схемой: public.users
+        table_name = payload.rsplit('.', 1)[-1].strip('"')
+        if table_name:
+            _invalidate(target, table_name)
+        else:
+            _invalidate_target(target)
+
+    def on_terminate(connection):
+        # Пока соединение не восстановлено, уведомления теряются - сбрасываем записи базы
+        _listeners.pop(target, None)
+        _invalidate_target(target)
+
+    _listeners[target] = None  # Параллельные запросы не открывают второе соединение
+    try:
+        conn = await open_listener(user_id, RESULT_CACHE_CHANNEL, on_notify)
+    except Exception as e:
+        _listeners.pop(target, None)
+        delay = RESULT_CACHE_LISTEN_RETRY if failure is None else min(failure[1] * 2, RESULT_CACHE_LISTEN_RETRY_MAX)
+        _listen_failures[target] = (time.monotonic() + delay, delay)
+        logging.error(f"Не удалось подписаться на {RESULT_CACHE_CHANNEL}, повтор через {delay} с: {e}")
+        return
+    _listen_failures.pop(target, None)
+    if target not in _listeners:
+        # Пока соединение открывалось, пулы этой базы закрылись
+        await _close_listener(conn)
+        return
+    conn.add_termination_listener(on_terminate)
+    _listeners[target] = conn
+
+
+async def _close_listener(conn):
+    try:
+        await conn.close()
+    except Exception as e:
+        logging.error(f"Ошибка закрытия соединения LISTEN: {e}")
+
+
+@on_release
+async def _release_listeners(owner):
+    # Соединение LISTEN живет, пока к его базе открыт хотя бы один пул; записи базы без
+    # подписки могут устареть и тоже сбрасываются
+    targets = pool_targets()
+    for target in [target for target in _listeners if target not in targets]:
+        conn = _listeners.pop(target)
+        _invalidate_target(target)
+        if conn is not None:
+            await _close_listener(conn)
+    for target in [target for target in _listen_failures if target not in targets]:
+        del _listen_failures[target]
+
+
+async def close_listeners():
+    _listen_failures.clear()
+    for target, conn in list(_listeners.items()):
+        _listeners.pop(target, None)
+        if conn is not None:
+            await _close_listener(conn)
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+
+import sql
+from db import fetch, on_release
+
+# Сколько секунд метаданные схемы считаются актуальными
+SCHEMA_TTL = 300
+
+# Все колонки таблиц из search_path вместе с признаком первичного ключа - одним запросом
+_COLUMNS_QUERY = """
+SELECT c.table_schema, c.table_name, c.column_name, c.data_type,
+       c.udt_schema, c.udt_name,
+       c.is_nullable = 'YES' AS is_nullable,
+       k.ordinal_position AS pk_position
+FROM information_schema.columns c
+LEFT JOIN information_schema.table_constraints tc
+       ON tc.table_schema = c.table_schema
+      AND tc.table_name = c.table_name
+      AND tc.constraint_type = 'PRIMARY KEY'
+LEFT JOIN information_schema.key_column_usage k
+       ON k.constraint_schema = tc.constraint_schema
+      AND k.constraint_name = tc.constraint_name
+      AND k.column_name = c.column_name
+WHERE c.table_schema = ANY(current_schemas(false)){table_filter}
+ORDER BY array_position(current_schemas(false), c.table_schema::name), c.table_name, c.ordinal_position;
+"""
+SCHEMA_QUERY = _COLUMNS_QUERY.format(table_filter='')
+
+# Колонки одной таблицы - для обновления кэша после DDL
+TABLE_QUERY = _COLUMNS_QUERY.format(table_filter='\n  AND c.table_name = $1')
+
+# user_id -> (время загрузки, {table_name: описание таблицы})
+_schemas = {}
+_locks = {}
+
+
+def _cast_type(udt_schema, udt_name):
+    # Имя типа, к которому можно привести текст на стороне сервера: $1::text::int4
+    if udt_schema == 'pg_catalog':
+        return udt_name
+    return f"{sql.quote_ident(udt_schema)}.{sql.quote_ident(udt_name)}"
+
+
+def _build_tables(rows):
+    tables = {}
+    for row in rows:
+        table = tables.get(row['table_name'])
+        if table is None:
+            table = {'schema': row['table_schema'], 'columns': [], 'primary_key': []}
+            tables[row['table_name']] = table
+        elif table['schema'] != row['table_schema']:
+            # Одноименная таблица дальше по search_path недоступна без схемы
+            continue
+
+        table['columns'].append({
+            'column_name': row['column_name'],
+            'data_type': row['data_type'],
+            'udt_name': row['udt_name'],
+            'cast_type': _cast_type(row['udt_schema'], row['udt_name']),
+            'is_nullable': row['is_nullable'],
+        })
+        if row['pk_position'] is not None:
+            table['primary_key'].append((row['pk_position'], row['column_name']))
+
+    for table in tables.values():
+        table['primary_key'] = [name for _, name in sorted(table['primary_key'])]
+    return tables
+
+
+async def get_tables(user_id):
+    """Возвращает метаданные всех таблиц пользователя, загружая их не чаще раза в SCHEMA_TTL."""
+    cached = _schemas.get(user_id)
+    if cached is not None and time.monotonic() - cached[0] < SCHEMA_TTL:
+        return cached[1]
+
+    lock = _locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        # Пока ждали блокировку, схему мог загрузить параллельный запрос
+        cached = _schemas.get(user_id)
+        if cached is not None and time.monotonic() - cached[0] < SCHEMA_TTL:
+            return cached[1]
+
+        tables = _build_tables(await fetch(user_id, SCHEMA_QUERY, readonly=True))
+        _schemas[user_id] = (time.monotonic(), tables)
+        return tables
+
+
+async def get_table(user_id, table_name):
+    """Описание таблицы: {'schema', 'columns': [...], 'primary_key': [...]} или None."""
+    tables = await get_tables(user_id)
+    return tables.get(table_name)
+
+
+async def get_column(user_id, table_name, column_name):
+    table = await get_table(user_id, table_name)
+    if table is None:
+        return None
+    return next((col for col in table['columns'] if col['column_name'] == column_name), None)
+
+
+async def resolve_table_name(user_id, text):
+    """Имя таблицы из ввода пользователя.
+
+    Точное совпадение с именем из каталога сохраняется как есть - так работают и имена
+    в смешанном регистре с клавиатуры подсказок; остальное понимается как в PostgreSQL
+    (sql.normalize_ident): без кавычек - в нижнем регистре.
+    """
+    text = text.strip()
+    try:
+        tables = await get_tables(user_id)
+    except Exception as e:
+        # Ошибку базы покажет сама команда, имя пока понимаем по правилам PostgreSQL
+        logging.warning(f"Не удалось загрузить схему для разбора имени таблицы: {e}")
+        tables = {}
+    return text if text in tables else sql.normalize_ident(text)
+
+
+def resolve_column_name(column_names, text):
+    """Имя колонки из ввода: точное совпадение с одной из column_names, иначе sql.normalize_ident."""
+    text = text.strip()
+    return text if text in column_names else sql.normalize_ident(text)
+
+
+def cached_tables(user_id):
+    """Загруженные метаданные таблиц пользователя или None, без обращения к базе."""
+    cached = _schemas.get(user_id)
+    return cached[1] if cached is not None else None
+
+
+async def refresh_table(user_id, table_name):
+    """Перечитывает одну таблицу после DDL вместо сброса всей схемы.
+
+    Возвращает новое описание таблицы или None, если таблицы больше нет.
+    Читается с основного сервера: реплика могла еще не получить изменения схемы.
+    """
+    table = _build_tables(await fetch(user_id, TABLE_QUERY, table_name)).get(table_name)
+    tables = cached_tables(user_id)
+    if tables is not None:
+        if table is None:
+            tables.pop(table_name, None)
+        else:
+            tables[table_name] = table
+    return table
+
+
+def invalidate(user_id):
+    """Сбрасывает кэш после DDL или смены подключения."""
+    _schemas.pop(user_id, None)
+
+
+@on_release
+def _release(user_id):
+    # Пул закрыт или параметры забыты: схема и блокировка пользователя больше не нужны
+    _schemas.pop(user_id, None)
+    _locks.pop(user_id, None)
@@ -0,0 +1,191 @@
+# Очередь исходящих сообщений: ограничение частоты, разбиение длинных текстов и объединение мелких
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+
+import metrics
+
+# Лимит Telegram на длину одного сообщения
+MESSAGE_LIMIT = 4096
+
+# Ограничения Telegram: около 30 сообщений в секунду всего и около 1 в секунду в один чат
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+# Для скольких чатов хранятся лимиты между отправками (давно не писавшие вытесняются)
+CHAT_BUCKETS_MAX = 10000
+
+# Сколько ждать перед отправкой, чтобы объединить несколько быстрых ответов в одно сообщение
+COALESCE_DELAY = 0.05
+
+# Повторные попытки при RetryAfter и сетевых ошибках
+SEND_MAX_RETRIES = 5
+SEND_BACKOFF = 1
+
+# Сколько секунд при остановке ждать отправки оставшихся сообщений
+SENDER_DRAIN_TIMEOUT = 10
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+_bot = None
+_global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+_queues = {}  # chat_id -> очередь (текст, параметры send_message)
+_workers = {}  # chat_id -> задача, отправляющая сообщения этого чата
+# chat_id -> TokenBucket; переживает задачу чата, поэтому лимит действует и между короткими паузами
+_chat_buckets = OrderedDict()
+
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    """Делит текст на части не длиннее limit, по возможности по границам строк."""
+    if len(text) <= limit:
+        return [text]
+
+    parts = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        parts.append(current)
+    return parts
+
+
+def set_global_rate(rate, burst):
+    """Меняет общий лимит отправки (в многопроцессном режиме он делится между процессами)."""
+    global _global_bucket
+    _global_bucket = TokenBucket(rate, burst)
+
+
+def start_sender(bot):
+    global _bot
+    _bot = bot
+
+
+def send(chat_id, text, **kwargs):
+    """Ставит сообщение в очередь и сразу возвращает управление обработчику."""
+    queue = _queues.setdefault(chat_id, deque())
+    parts = split_text(text)
+    # Клавиатура и прочие параметры относятся к последней части
+    for part in parts[:-1]:
+        queue.append((part, {}))
+    queue.append((parts[-1], kwargs))
+
+    if chat_id not in _workers:
+        _workers[chat_id] = asyncio.create_task(_chat_worker(chat_id))
+
+
+def reply(message, text, **kwargs):
+    send(message.chat.id, text, **kwargs)
+
+
+def _take_coalesced(queue):
+    text, kwargs = queue.popleft()
+    if kwargs:
+        return text, kwargs
+    # Подряд идущие простые сообщения склеиваются, пока помещаются в одно
+    while queue and not queue[0][1] and len(text) + 2 + len(queue[0][0]) <= MESSAGE_LIMIT:
+        text = f"{text}\n\n{queue.popleft()[0]}"
+    # Сообщение с разметкой (parse_mode) не склеивается с простым текстом
+    if (queue and queue[0][1] and 'parse_mode' not in queue[0][1]
+            and len(text) + 2 + len(queue[0][0]) <= MESSAGE_LIMIT):
+        next_text, kwargs = queue.popleft()
+        text = f"{text}\n\n{next_text}"
+    return text, kwargs
+
+
+async def _deliver(chat_id, text, kwargs):
+    for attempt in range(SEND_MAX_RETRIES):
+        try:
+            await _bot.send_message(chat_id, text, **kwargs)
+            metrics.sent(len(text.encode('utf-8')))
+            return
+        except TelegramRetryAfter as e:
+            logging.warning(f"Превышен лимит Telegram для чата {chat_id}, ожидание {e.retry_after} с.")
+            await asyncio.sleep(e.retry_after)
+        except TelegramNetworkError as e:
+            logging.warning(f"Сетевая ошибка при отправке в чат {chat_id}: {e}")
+            await asyncio.sleep(SEND_BACKOFF * 2 ** attempt)
+        except Exception as e:
+            logging.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
+            return
+    logging.error(f"Сообщение в чат {chat_id} не отправлено после {SEND_MAX_RETRIES} попыток.")
+
+
+def _chat_bucket(chat_id):
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is not None:
+        _chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    # Лимит чата, который не писал дольше времени полного восполнения, равен новому - его можно забыть
+    refill = CHAT_BURST / CHAT_RATE
+    now = time.monotonic()
+    while _chat_buckets:
+        oldest = next(iter(_chat_buckets.values()))
+        if now - oldest.updated < refill and len(_chat_buckets) < CHAT_BUCKETS_MAX:
+            break
+        _chat_buckets.popitem(last=False)
+    bucket = _chat_buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+    return bucket
+
+
+async def _chat_worker(chat_id):
+    queue = _queues[chat_id]
+    bucket = _chat_bucket(chat_id)
+    try:
+        while queue:
+            await asyncio.sleep(COALESCE_DELAY)
+            text, kwargs = _take_coalesced(queue)
+            await bucket.acquire()
+            await _global_bucket.acquire()
+            await _deliver(chat_id, text, kwargs)
+    finally:
+        _workers.pop(chat_id, None)
+        if not queue:
+            _queues.pop(chat_id, None)
+
+
+async def stop_sender(timeout=SENDER_DRAIN_TIMEOUT):
+    """Дожидается отправки оставшихся сообщений."""
+    workers = list(_workers.values())
+    if not workers:
+        return
+    done, pending = await asyncio.wait(workers, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.warning(f"Не отправлены сообщения в {len(pending)} чатов при остановке.")
+        await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,222 @@
+# Хранилище сессий пользователей с TTL и ограничением числа записей (LRU)
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Через сколько секунд бездействия сессия удаляется
+SESSION_TTL = int(os.getenv('SESSION_TTL', 1800))
+
+# Максимальное число сессий в памяти
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 50000))
+
+# memory - только в памяти, sqlite - сессии сохраняются в файл и переживают перезапуск
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.sqlite3')
+
+# Сколько секунд копятся изменения сессий перед одной общей записью в SQLite
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', 0.2))
+
+# Диалоги, которые никогда не сохраняются на диск (содержат пароль)
+NON_PERSISTENT_FLOWS = {'connect'}
+
+
+class Session:
+    """Состояние диалога пользователя: команда, шаг и введенные данные."""
+
+    __slots__ = ('flow', 'step', 'params')
+
+    def __init__(self, flow, step, params=None):
+        self.flow = flow
+        self.step = step
+        self.params = params if params is not None else {}
+
+    def to_json(self):
+        return json.dumps({'flow': self.flow, 'step': self.step, 'params': self.params},
+                          ensure_ascii=False, default=str)
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        return cls(data['flow'], data['step'], data['params'])
+
+
+class MemorySessionStore:
+    """Сессии в памяти. Каждое обращение продлевает TTL, поэтому порядок LRU
+    совпадает с порядком истечения и устаревшие записи удаляются с начала очереди.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._items = OrderedDict()  # key -> [срок истечения, значение]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        now = time.monotonic()
+        if item[0] < now:
+            self._remove(key)
+            return None
+        item[0] = now + self.ttl
+        self._items.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value):
+        self._items[key] = [time.monotonic() + self.ttl, value]
+        self._items.move_to_end(key)
+        self.expire()
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    def delete(self, key):
+        self._remove(key)
+
+    def pop(self, key, default=None):
+        value = self.get(key)
+        self._remove(key)
+        return default if value is None else value
+
+    def expire(self):
+        now = time.monotonic()
+        while self._items:
+            key, (expires_at, _) = next(iter(self._items.items()))
+            if expires_at >= now:
+                break
+            self._remove(key)
+
+    def _remove(self, key):
+        self._items.pop(key, None)
+
+    def close(self):
+        pass
+
+
+class SqliteSessionStore(MemorySessionStore):
+    """Сессии диалогов в памяти с записью в SQLite, чтобы они переживали перезапуск бота.
+
+    Вытесненные из памяти по LRU сессии остаются в SQLite и загружаются при следующем обращении.
+    Запись идет в отдельном потоке: изменения за SESSION_FLUSH_INTERVAL собираются (по одному
+    последнему на пользователя) и сохраняются одной транзакцией, поэтому fsync не блокирует
+    цикл событий. Несохраненные изменения записываются в close().
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES):
+        super().__init__(ttl, max_entries)
+        self._path = path
+        # Соединение для чтения в потоке цикла событий; у потока записи свое
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._db.execute("DELETE FROM sessions WHERE expires_at < ?", (time.time(),))
+        self._db.commit()
+
+        # user_id -> (data, expires_at) или None (удалить): ждут записи и записываются сейчас
+        self._pending = {}
+        self._writing = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name='session-writer', daemon=True)
+        self._writer.start()
+
+    def _unsaved(self, key):
+        with self._lock:
+            for changes in (self._pending, self._writing):
+                if key in changes:
+                    return True, changes[key]
+        return False, None
+
+    def get(self, key):
+        value = super().get(key)
+        if value is not None:
+            return value
+
+        unsaved, row = self._unsaved(key)
+        if not unsaved:
+            row = self._db.execute(
+                "SELECT data, expires_at FROM sessions WHERE user_id = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        try:
+            value = Session.from_json(row[0])
+        except (ValueError, KeyError) as e:
+            logging.error(f"Поврежденная сессия пользователя {key}: {e}")
+            self._remove(key)
+            return None
+        super().set(key, value)
+        return value
+
+    def set(self, key, value):
+        super().set(key, value)
+        if value.flow in NON_PERSISTENT_FLOWS:
+            self._queue_write(key, None)
+        else:
+            self._queue_write(key, (value.to_json(), time.time() + self.ttl))
+
+    def _remove(self, key):
+        super()._remove(key)
+        self._queue_write(key, None)
+
+    def _queue_write(self, key, row):
+        with self._lock:
+            self._pending[key] = row
+        self._wakeup.set()
+
+    def _write_loop(self):
+        db = sqlite3.connect(self._path)
+        try:
+            while True:
+                self._wakeup.wait()
+                if not self._closed:
+                    time.sleep(SESSION_FLUSH_INTERVAL)
+                with self._lock:
+                    self._wakeup.clear()
+                    self._writing, self._pending = self._pending, {}
+                    closed = self._closed
+                if self._writing:
+                    self._flush(db, self._writing)
+                with self._lock:
+                    self._writing = {}
+                if closed:
+                    return
+        finally:
+            db.close()
+
+    @staticmethod
+    def _flush(db, changes):
+        try:
+            with db:
+                db.executemany("DELETE FROM sessions WHERE user_id = ?",
+                               [(key,) for key, row in changes.items() if row is None])
+                db.executemany("INSERT OR REPLACE INTO sessions (user_id, data, expires_at) VALUES (?, ?, ?)",
+                               [(key, *row) for key, row in changes.items() if row is not None])
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка сохранения сессий: {e}")
+
+    def close(self):
+        """Записывает несохраненные изменения и закрывает базу."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        self._db.close()
+
+
+def create_session_store():
+    if SESSION_BACKEND == 'sqlite':
+        return SqliteSessionStore()
+    return MemorySessionStore()
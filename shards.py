@@ -0,0 +1,256 @@
+# Многопроцессный режим: основной процесс принимает обновления (polling или webhook) и раздает их
+# рабочим процессам по хэшу id пользователя через UNIX-сокеты. Обновления одного пользователя
+# всегда попадают в один процесс, поэтому его диалог и пул соединений живут там же.
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+
+import aiohttp
+from aiohttp import web
+
+import webhook
+
+# Число рабочих процессов; 1 - обычный однопроцессный режим
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))
+
+# Где создаются сокеты рабочих процессов
+SHARD_SOCKET_DIR = os.getenv('SHARD_SOCKET_DIR', tempfile.gettempdir())
+
+# Сколько обновлений может ждать отправки в один рабочий процесс
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', 1000))
+
+# Пауза перед повтором, если рабочий процесс перегружен или перезапускается
+SHARD_RETRY_DELAY = 0.5
+
+# Как часто проверять, что рабочие процессы живы
+SHARD_MONITOR_INTERVAL = 1
+
+# Таймаут long polling основного процесса
+POLLING_TIMEOUT = 30
+
+# Номер рабочего процесса или None в основном процессе и в однопроцессном режиме
+worker_index = None
+
+
+def shard_for(user_id, workers=BOT_WORKERS):
+    """Номер рабочего процесса для пользователя; обновления без пользователя идут в первый."""
+    if user_id is None:
+        return 0
+    return user_id % workers
+
+
+def worker_address(index):
+    return os.path.join(SHARD_SOCKET_DIR, f"tgbot-{os.getpid()}-{index}.sock")
+
+
+def raw_user_id(data):
+    """id пользователя из необработанного обновления Telegram (message, callback_query и т.п.)."""
+    for key, value in data.items():
+        if key != 'update_id' and isinstance(value, dict):
+            user = value.get('from')
+            return user.get('id') if user else None
+    return None
+
+
+def request_stop():
+    """Из рабочего процесса: просит основной процесс остановить все процессы."""
+    os.kill(os.getppid(), signal.SIGTERM)
+
+
+def _worker_main(index, address, workers, entry):
+    global worker_index
+    worker_index = index
+
+    import sender
+    # Общий лимит Telegram на отправку делится между процессами
+    sender.set_global_rate(sender.GLOBAL_RATE / workers, max(1, sender.GLOBAL_BURST // workers))
+    # entry - функция модуля, запустившего бота. При spawn этот модуль уже загружен
+    # в рабочем процессе как __mp_main__, поэтому повторно он не импортируется
+    asyncio.run(entry(address))
+
+
+class Shard:
+    """Рабочий процесс и очередь обновлений для него."""
+
+    def __init__(self, index, workers, entry):
+        self.index = index
+        self.workers = workers
+        self.entry = entry
+        self.address = worker_address(index)
+        self.queue = asyncio.Queue(maxsize=SHARD_QUEUE_SIZE)
+        self.process = None
+        self.forwarder = None
+
+    def start_process(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(
+            target=_worker_main, args=(self.index, self.address, self.workers, self.entry), name=f"tgbot-worker-{self.index}")
+        self.process.start()
+        logging.info(f"Рабочий процесс {self.index} запущен (pid {self.process.pid}).")
+
+    async def forward(self):
+        # Обновления отправляются по одному и по порядку: рабочий процесс отвечает сразу после
+        # постановки обновления в обработку, поэтому порядок обновлений пользователя сохраняется
+        headers = {'Content-Type': 'application/json'}
+        if webhook.WEBHOOK_SECRET:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = webhook.WEBHOOK_SECRET
+        url = f"http://worker{webhook.WEBHOOK_PATH}"
+        async with aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=self.address)) as session:
+            while True:
+                data = await self.queue.get()
+                try:
+                    await self._post(session, url, data, headers)
+                finally:
+                    self.queue.task_done()
+
+    async def _post(self, session, url, data, headers):
+        while True:
+            try:
+                async with session.post(url, data=data, headers=headers) as response:
+                    if response.status == 200:
+                        return
+                    if response.status == 400:
+                        logging.error(f"Рабочий процесс {self.index} отклонил обновление.")
+                        return
+                    # 503 - процесс перегружен или останавливается
+            except aiohttp.ClientError:
+                pass  # Процесс еще запускается или перезапускается
+            await asyncio.sleep(SHARD_RETRY_DELAY)
+
+    async def stop(self, timeout):
+        if self.forwarder is not None:
+            self.forwarder.cancel()
+            await asyncio.gather(self.forwarder, return_exceptions=True)
+        if self.process is not None and self.process.is_alive():
+            # Рабочий процесс по SIGTERM дожидается уже принятых обновлений
+            self.process.terminate()
+            await asyncio.to_thread(self.process.join, timeout)
+            if self.process.is_alive():
+                logging.warning(f"Рабочий процесс {self.index} не завершился, принудительная остановка.")
+                self.process.kill()
+                await asyncio.to_thread(self.process.join)
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+class Supervisor:
+    def __init__(self, entry, workers=BOT_WORKERS):
+        self.shards = [Shard(index, workers, entry) for index in range(workers)]
+        self.stopping = False
+
+    def route(self, user_id):
+        return self.shards[shard_for(user_id, len(self.shards))]
+
+    def start(self):
+        for shard in self.shards:
+            shard.start_process()
+            shard.forwarder = asyncio.create_task(shard.forward())
+
+    async def monitor(self):
+        # Упавший рабочий процесс перезапускается; его пользователи продолжают диалоги
+        # из общего хранилища сессий (SESSION_BACKEND=sqlite)
+        while not self.stopping:
+            await asyncio.sleep(SHARD_MONITOR_INTERVAL)
+            for shard in self.shards:
+                if not self.stopping and not shard.process.is_alive():
+                    logging.error(f"Рабочий процесс {shard.index} завершился с кодом {shard.process.exitcode}, перезапуск.")
+                    shard.start_process()
+
+    async def stop(self, timeout=webhook.WEBHOOK_DRAIN_TIMEOUT):
+        self.stopping = True
+        # Сначала отдаем рабочим процессам все уже принятые обновления
+        try:
+            await asyncio.wait_for(asyncio.gather(*(shard.queue.join() for shard in self.shards)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Не все принятые обновления переданы рабочим процессам.")
+        await asyncio.gather(*(shard.stop(timeout + 5) for shard in self.shards))
+
+
+async def _poll(bot, supervisor, allowed_updates):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(SHARD_RETRY_DELAY)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            shard = supervisor.route(webhook.update_user_id(update))
+            await shard.queue.put(update.model_dump_json(exclude_none=True, by_alias=True))
+
+
+def _create_front_app(supervisor):
+    app = web.Application()
+    app['accepting'] = True
+
+    async def handle_update(request):
+        if webhook.WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook.WEBHOOK_SECRET:
+            return web.Response(status=401)
+        if not app['accepting']:
+            return web.Response(status=503)
+        data = await request.read()
+        try:
+            user_id = raw_user_id(json.loads(data))
+        except (ValueError, AttributeError) as e:
+            logging.error(f"Некорректное обновление: {e}")
+            return web.Response(status=400)
+        try:
+            supervisor.route(user_id).queue.put_nowait(data)
+        except asyncio.QueueFull:
+            return web.Response(status=503)
+        return web.Response()
+
+    app.router.add_post(webhook.WEBHOOK_PATH, handle_update)
+    return app
+
+
+async def run_supervisor(dp, bot, stop_event, entry, workers=BOT_WORKERS):
+    """Основной процесс: запускает рабочие процессы и раздает им обновления до stop_event.
+
+    entry(address) - корутина рабочего процесса, которая обрабатывает обновления с сокета address.
+    """
+    supervisor = Supervisor(entry, workers)
+    supervisor.start()
+    monitor = asyncio.create_task(supervisor.monitor())
+    allowed_updates = dp.resolve_used_update_types()
+    logging.info(f"Запущено рабочих процессов: {workers}.")
+
+    runner = None
+    poller = None
+    try:
+        if webhook.BOT_MODE == 'webhook':
+            app = _create_front_app(supervisor)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, webhook.WEBHOOK_HOST, webhook.WEBHOOK_PORT).start()
+            if webhook.WEBHOOK_URL:
+                await bot.set_webhook(
+                    webhook.WEBHOOK_URL.rstrip('/') + webhook.WEBHOOK_PATH,
+                    secret_token=webhook.WEBHOOK_SECRET or None,
+                    allowed_updates=allowed_updates,
+                )
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.create_task(_poll(bot, supervisor, allowed_updates))
+
+        await stop_event.wait()
+    finally:
+        if runner is not None:
+            runner.app['accepting'] = False
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        monitor.cancel()
+        await supervisor.stop()
+        if runner is not None:
+            await runner.cleanup()
@@ -0,0 +1,133 @@
+# Построение SQL-запросов: идентификаторы экранируются, значения передаются только параметрами.
+# Одинаковые по форме запросы дают одинаковый текст, поэтому asyncpg повторно использует
+# подготовленные выражения из своего кэша на соединении.
+import re
+from functools import lru_cache
+
+# Сколько различных форм запросов хранить построенными
+QUERY_SHAPE_CACHE_SIZE = 1024
+
+
+def quote_ident(name):
+    """Экранирует идентификатор PostgreSQL: my"table -> "my""table"."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def normalize_ident(name):
+    """Приводит введенное пользователем имя к виду, как его понимает PostgreSQL:
+    имя в двойных кавычках сохраняется как есть, без кавычек - приводится к нижнему регистру.
+    """
+    name = name.strip()
+    if len(name) >= 2 and name.startswith('"') and name.endswith('"'):
+        return name[1:-1].replace('""', '"')
+    return name.lower()
+
+
+def table_ref(table_name, schema=None):
+    if schema:
+        return f"{quote_ident(schema)}.{quote_ident(table_name)}"
+    return quote_ident(table_name)
+
+
+def column_list(columns):
+    return ", ".join(quote_ident(col) for col in columns)
+
+
+@lru_cache(maxsize=QUERY_SHAPE_CACHE_SIZE)
+def insert_query(table_name, columns, schema=None):
+    placeholders = ", ".join(f"${i}" for i in range(1, len(columns) + 1))
+    return f"INSERT INTO {table_ref(table_name, schema)} ({column_list(columns)}) VALUES ({placeholders})"
+
+
+@lru_cache(maxsize=QUERY_SHAPE_CACHE_SIZE)
+def update_query(table_name, column_name, cast_type, schema=None):
+    column = quote_ident(column_name)
+    return (f"UPDATE {table_ref(table_name, schema)} SET {column} = $1 "
+            f"WHERE {column} = $2::text::{cast_type}")
+
+
+@lru_cache(maxsize=QUERY_SHAPE_CACHE_SIZE)
+def select_query(table_name, columns, schema=None):
+    return f"SELECT {column_list(columns)} FROM {table_ref(table_name, schema)}"
+
+
+@lru_cache(maxsize=QUERY_SHAPE_CACHE_SIZE)
+def count_matching_query(table_name, column_name, cast_type, limit, schema=None):
+    column = quote_ident(column_name)
+    return (f"SELECT count(*) AS rows FROM (SELECT 1 FROM {table_ref(table_name, schema)} "
+            f"WHERE {column} = $1::text::{cast_type} LIMIT {int(limit)}) matched")
+
+
+@lru_cache(maxsize=QUERY_SHAPE_CACHE_SIZE)
+def sample_values_query(table_name, column_name, sample_rows, shown_values, schema=None):
+    column = quote_ident(column_name)
+    return (f"SELECT DISTINCT value FROM (SELECT {column} AS value FROM {table_ref(table_name, schema)} "
+            f"WHERE {column} IS NOT NULL AND {column}::text LIKE $1 LIMIT {int(sample_rows)}) sample "
+            f"ORDER BY value LIMIT {int(shown_values)}")
+
+
+# Статистика таблицы из каталога: оценка числа строк из pg_class и по колонкам из pg_stats
+# (доля NULL, число различных значений, частые значения, границы гистограммы вместо min/max)
+_CATALOG_STATS = """
+SELECT c.reltuples::bigint AS estimate,
+       s.attname::text AS column_name,
+       s.inherited,
+       s.null_frac,
+       s.n_distinct,
+       (s.most_common_vals::text::text[])[1:{top}] AS top_values,
+       s.most_common_freqs[1:{top}] AS top_freqs,
+       (s.histogram_bounds::text::text[])[1] AS low,
+       (s.histogram_bounds::text::text[])[cardinality(s.histogram_bounds::text::text[])] AS high
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_stats s ON s.schemaname = n.nspname AND s.tablename = c.relname
+WHERE n.nspname = $1 AND c.relname = $2
+"""
+
+
+@lru_cache(maxsize=QUERY_SHAPE_CACHE_SIZE)
+def table_stats_query(table_name, columns, orderable, top, schema, exact=False):
+    """Один запрос со статистикой таблицы.
+
+    С exact=True к статистике из каталога присоединяется один проход по таблице: count(*),
+    число не-NULL значений каждой колонки и min/max для колонок из orderable
+    (индексы колонок в columns). Псевдонимы: nonnull_<i>, min_<i>, max_<i>.
+    """
+    query = _CATALOG_STATS.format(top=int(top))
+    if exact:
+        aggregates = ["count(*) AS exact_rows"]
+        for i, column in enumerate(columns):
+            aggregates.append(f"count({quote_ident(column)}) AS nonnull_{i}")
+            if i in orderable:
+                aggregates.append(f"min({quote_ident(column)})::text AS min_{i}")
+                aggregates.append(f"max({quote_ident(column)})::text AS max_{i}")
+        query = (f"SELECT stats.*, exact.* FROM ({query}) stats CROSS JOIN "
+                 f"(SELECT {', '.join(aggregates)} FROM {table_ref(table_name, schema)}) exact")
+    # Для таблиц с наследниками статистика по всей иерархии (inherited) идет первой
+    return f"SELECT * FROM ({query}) result ORDER BY column_name, inherited DESC"
+
+
+def like_prefix(prefix):
+    """Шаблон LIKE для поиска по началу строки с экранированными спецсимволами."""
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+# Имя типа в DDL: varchar(255), numeric(10, 2), timestamp with time zone, int[]
+_TYPE_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_ ]*(\(\s*\d+\s*(,\s*\d+\s*)?\))?(\[\])*$')
+
+
+def is_valid_type(data_type):
+    return bool(_TYPE_RE.match(data_type.strip()))
+
+
+def create_table_query(table_name, columns_definition):
+    # Определения колонок - это DDL, который пользователь вводит сам; экранируется только имя таблицы
+    return f"CREATE TABLE IF NOT EXISTS {quote_ident(table_name)} ({columns_definition})"
+
+
+def add_column_query(table_name, column_name, data_type, schema=None):
+    return f"ALTER TABLE {table_ref(table_name, schema)} ADD COLUMN {quote_ident(column_name)} {data_type}"
+
+
+def drop_column_query(table_name, column_name, schema=None):
+    return f"ALTER TABLE {table_ref(table_name, schema)} DROP COLUMN {quote_ident(column_name)}"
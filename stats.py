@@ -0,0 +1,92 @@
+# Сводка по таблице для /stats: все считает PostgreSQL, в бот приходит одна строка на колонку
+from db import command_timeout, fetch
+import sql
+
+# Сколько самых частых значений показывать для колонки
+STATS_TOP_VALUES = 5
+
+# Длина, до которой обрезаются значения в сводке
+STATS_VALUE_WIDTH = 30
+
+# Типы, для которых в точном режиме считаются min/max
+ORDERABLE_TYPES = {
+    'int2', 'int4', 'int8', 'numeric', 'float4', 'float8', 'money',
+    'date', 'time', 'timetz', 'timestamp', 'timestamptz', 'interval',
+    'text', 'varchar', 'bpchar', 'name',
+}
+
+
+def _short(value):
+    value = str(value)
+    if len(value) > STATS_VALUE_WIDTH:
+        return value[:STATS_VALUE_WIDTH - 1] + '…'
+    return value
+
+
+def _human(number):
+    number = float(number)
+    for unit, size in (('млрд', 1e9), ('млн', 1e6), ('тыс', 1e3)):
+        if abs(number) >= size:
+            return f"{number / size:.1f} {unit}"
+    return f"{number:.0f}"
+
+
+async def table_stats(user_id, table_name, table, exact=False):
+    """Статистика таблицы одним запросом. table - описание из schema_cache."""
+    columns = tuple(col['column_name'] for col in table['columns'])
+    orderable = frozenset(i for i, col in enumerate(table['columns']) if col['udt_name'] in ORDERABLE_TYPES)
+    query = sql.table_stats_query(table_name, columns, orderable, STATS_TOP_VALUES, table['schema'], exact)
+    rows = await fetch(user_id, query, table['schema'], table_name, timeout=command_timeout('stats'), readonly=True)
+    return format_stats(table_name, table, rows, exact)
+
+
+def format_stats(table_name, table, rows, exact=False):
+    if not rows:
+        return f"Таблица '{table_name}' не найдена."
+
+    first = rows[0]
+    estimate = first['estimate']
+    if exact:
+        total = first['exact_rows']
+        lines = [f"Таблица {table_name}: {total} строк"]
+    else:
+        total = estimate
+        lines = [f"Таблица {table_name}: ~{_human(max(estimate, 0))} строк (оценка)"]
+
+    # Первая строка по каждой колонке - статистика по всей иерархии наследования, если она есть
+    by_column = {}
+    for row in rows:
+        if row['column_name'] is not None:
+            by_column.setdefault(row['column_name'], row)
+    if not by_column:
+        lines.append("Статистика не собрана: выполните ANALYZE для таблицы.")
+
+    for i, col in enumerate(table['columns']):
+        name = col['column_name']
+        row = by_column.get(name)
+        parts = []
+
+        if exact and total:
+            parts.append(f"null {100 * (total - first[f'nonnull_{i}']) / total:.1f}%")
+        elif row is not None:
+            parts.append(f"null {100 * row['null_frac']:.1f}%")
+
+        if row is not None and row['n_distinct'] is not None:
+            # Отрицательное n_distinct - доля от числа строк
+            distinct = row['n_distinct'] if row['n_distinct'] >= 0 else -row['n_distinct'] * max(estimate, 0)
+            parts.append(f"различных ~{_human(distinct)}")
+
+        if exact and col['udt_name'] in ORDERABLE_TYPES:
+            if first[f'min_{i}'] is not None:
+                parts.append(f"min {_short(first[f'min_{i}'])}, max {_short(first[f'max_{i}'])}")
+        elif row is not None and row['low'] is not None:
+            parts.append(f"min ≈{_short(row['low'])}, max ≈{_short(row['high'])}")
+
+        lines.append(f"{name} ({col['data_type']}): {', '.join(parts) or 'нет статистики'}")
+
+        if row is not None and row['top_values']:
+            top = ", ".join(f"{_short(value)} {100 * freq:.0f}%"
+                            for value, freq in zip(row['top_values'], row['top_freqs']))
+            lines.append(f"  частые: {top}")
+
+    return "\n".join(lines)
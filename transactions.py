@@ -0,0 +1,150 @@
+# Транзакции из нескольких шагов диалогов (/begin, /commit, /rollback).
+# Между /begin и /commit изменения из /insert, /update и /alter_table не выполняются, а копятся
+# в буфере; /commit отправляет их одной транзакцией на выделенном соединении (db.run_transaction),
+# поэтому десять связанных изменений - это один COMMIT, а не десять.
+# Каждый шаг - точка сохранения: /rollback N отменяет шаги начиная с N без обращения к базе.
+# Транзакция без активности дольше TRANSACTION_IDLE_TIMEOUT отменяется автоматически
+import asyncio
+import logging
+import os
+import time
+
+from db import connection_target
+from sender import send
+
+# Через сколько секунд без новых шагов транзакция отменяется и сколько шагов в ней может быть
+TRANSACTION_IDLE_TIMEOUT = float(os.getenv('TRANSACTION_IDLE_TIMEOUT', 600))
+TRANSACTION_MAX_STEPS = int(os.getenv('TRANSACTION_MAX_STEPS', 1000))
+
+# Как часто проверяются простаивающие транзакции, в секундах
+TRANSACTION_CHECK_INTERVAL = 30
+
+# Сколько шагов показывается в описании транзакции
+TRANSACTION_SHOWN_STEPS = 30
+
+
+class Step:
+    """Отложенное изменение: запрос с аргументами и описание для пользователя."""
+    __slots__ = ('query', 'args', 'description', 'table_name', 'ddl')
+
+    def __init__(self, query, args, description, table_name, ddl=False):
+        self.query = query
+        self.args = args
+        self.description = description
+        self.table_name = table_name
+        self.ddl = ddl
+
+
+class Transaction:
+    """Открытая транзакция пользователя: шаги и база, к которой они относятся."""
+    __slots__ = ('chat_id', 'target', 'steps', 'last_active')
+
+    def __init__(self, chat_id, target):
+        self.chat_id = chat_id
+        self.target = target
+        self.steps = []
+        self.last_active = time.monotonic()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def describe(self):
+        if not self.steps:
+            return "В транзакции пока нет шагов."
+        lines = [f"{number}. {step.description}"
+                 for number, step in enumerate(self.steps[:TRANSACTION_SHOWN_STEPS], start=1)]
+        if len(self.steps) > TRANSACTION_SHOWN_STEPS:
+            lines.append(f"... и еще шагов: {len(self.steps) - TRANSACTION_SHOWN_STEPS}")
+        return "Шаги транзакции:\n" + "\n".join(lines)
+
+
+# user_id -> Transaction
+_transactions = {}
+_expiry_task = None
+
+
+def begin(user_id, chat_id):
+    """Открывает транзакцию для текущего подключения пользователя; возвращает (транзакция, новая ли)."""
+    transaction = get(user_id)
+    if transaction is not None:
+        return transaction, False
+    transaction = _transactions[user_id] = Transaction(chat_id, connection_target(user_id))
+    return transaction, True
+
+
+def get(user_id):
+    """Открытая транзакция пользователя или None (просроченная при этом отменяется)."""
+    transaction = _transactions.get(user_id)
+    if transaction is not None and time.monotonic() - transaction.last_active > TRANSACTION_IDLE_TIMEOUT:
+        _expire(user_id, transaction)
+        return None
+    return transaction
+
+
+def add_step(user_id, query, args, description, table_name, ddl=False):
+    """Добавляет шаг в открытую транзакцию и возвращает его номер (с 1)."""
+    transaction = _transactions[user_id]
+    if len(transaction.steps) >= TRANSACTION_MAX_STEPS:
+        raise ValueError(f"В транзакции может быть не больше {TRANSACTION_MAX_STEPS} шагов. "
+                         "Примените ее командой /commit.")
+    transaction.steps.append(Step(query, args, description, table_name, ddl))
+    transaction.touch()
+    return len(transaction.steps)
+
+
+def rollback_to(user_id, number):
+    """Отменяет шаги начиная с number; возвращает число отмененных шагов."""
+    transaction = _transactions[user_id]
+    removed = len(transaction.steps) - (number - 1)
+    del transaction.steps[number - 1:]
+    transaction.touch()
+    return removed
+
+
+def discard(user_id):
+    """Закрывает транзакцию без применения и возвращает ее (None, если ее не было)."""
+    return _transactions.pop(user_id, None)
+
+
+def restore(user_id, transaction):
+    """Возвращает транзакцию после неудачного /commit, если пользователь не открыл новую."""
+    if user_id not in _transactions:
+        transaction.touch()
+        _transactions[user_id] = transaction
+
+
+def _expire(user_id, transaction):
+    del _transactions[user_id]
+    logging.info(f"Транзакция пользователя {user_id} отменена по простою.")
+    send(transaction.chat_id,
+         f"Транзакция отменена: не было активности {TRANSACTION_IDLE_TIMEOUT:g} с. "
+         f"Шагов не применено: {len(transaction.steps)}.")
+
+
+def expire_idle(timeout=TRANSACTION_IDLE_TIMEOUT):
+    """Отменяет транзакции без активности дольше timeout секунд и сообщает об этом пользователям."""
+    now = time.monotonic()
+    idle = [(user_id, transaction) for user_id, transaction in _transactions.items()
+            if now - transaction.last_active > timeout]
+    for user_id, transaction in idle:
+        _expire(user_id, transaction)
+    return len(idle)
+
+
+async def _expire_idle_transactions():
+    while True:
+        await asyncio.sleep(TRANSACTION_CHECK_INTERVAL)
+        expire_idle()
+
+
+def start_transaction_reaper():
+    global _expiry_task
+    if _expiry_task is None:
+        _expiry_task = asyncio.create_task(_expire_idle_transactions())
+
+
+def stop_transaction_reaper():
+    global _expiry_task
+    if _expiry_task is not None:
+        _expiry_task.cancel()
+        _expiry_task = None
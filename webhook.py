@@ -0,0 +1,152 @@
+# Режим webhook: aiohttp-сервер принимает обновления и обрабатывает их конкурентно
+import asyncio
+import logging
+import os
+
+from aiohttp import web
+from aiogram import types
+
+# polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Публичный адрес, который регистрируется в Telegram. Если не задан, сервер только
+# принимает POST-запросы (удобно для локальной проверки поддельными обновлениями)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Сколько обновлений обрабатывается одновременно и сколько может ждать очереди
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', 100))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', 1000))
+
+# Сколько секунд при остановке ждать завершения уже принятых обновлений
+WEBHOOK_DRAIN_TIMEOUT = int(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 30))
+
+
+def update_user_id(update):
+    event = update.event
+    from_user = getattr(event, 'from_user', None)
+    return from_user.id if from_user else None
+
+
+def _is_cancel(update):
+    # /cancel не ждет завершения предыдущих обновлений пользователя, иначе он не сможет
+    # прервать долгий запрос
+    text = (getattr(update.message, 'text', None) or '').strip()
+    if text.lower() == 'отмена':
+        return True
+    # Только сама команда (в том числе /cancel@имя_бота), а не, например, /cancelled
+    return bool(text) and text.split()[0].split('@')[0] == '/cancel'
+
+
+def create_app(dp, bot, max_concurrency=WEBHOOK_MAX_CONCURRENCY, max_pending=WEBHOOK_MAX_PENDING):
+    """Создает aiohttp-приложение, которое сразу отвечает Telegram и обрабатывает обновление в фоне.
+
+    Обновления одного пользователя обрабатываются строго по очереди, чтобы шаги диалога
+    не перепутались, обновления разных пользователей - параллельно.
+    """
+    app = web.Application()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = set()
+    user_locks = {}  # user_id -> [блокировка, число обновлений, которые ее используют]
+    app['tasks'] = tasks
+    app['accepting'] = True
+
+    async def process(update):
+        if _is_cancel(update):
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+            return
+
+        user_id = update_user_id(update)
+        entry = user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], semaphore:
+                await dp.feed_update(bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            # Блокировку удаляем, когда ее больше никто не ждет
+            entry[1] -= 1
+            if entry[1] == 0:
+                user_locks.pop(user_id, None)
+
+    async def handle_update(request):
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        # При остановке и переполнении просим Telegram повторить запрос позже
+        if not app['accepting'] or len(tasks) >= max_pending:
+            return web.Response(status=503)
+
+        try:
+            update = types.Update.model_validate(await request.json(), context={'bot': bot})
+        except Exception as e:
+            logging.error(f"Некорректное обновление: {e}")
+            return web.Response(status=400)
+
+        task = asyncio.create_task(process(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return web.Response()
+
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    return app
+
+
+async def drain(app, timeout=WEBHOOK_DRAIN_TIMEOUT):
+    """Перестает принимать обновления и ждет завершения уже принятых."""
+    app['accepting'] = False
+    tasks = set(app['tasks'])
+    if not tasks:
+        return
+    logging.info(f"Ожидание завершения {len(tasks)} обновлений...")
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.warning(f"Прервано {len(pending)} обновлений при остановке.")
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def run_local_server(dp, bot, stop_event, path):
+    """Рабочий процесс многопроцессного режима: принимает обновления от основного процесса
+    на UNIX-сокете path и обрабатывает их так же, как webhook-сервер."""
+    app = create_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.UnixSite(runner, path).start()
+    logging.info(f"Рабочий процесс слушает {path}")
+
+    try:
+        await stop_event.wait()
+    finally:
+        await drain(app)
+        await runner.cleanup()
+
+
+async def run_webhook(dp, bot, stop_event):
+    """Запускает webhook-сервер и работает до stop_event, затем корректно завершает обработку."""
+    app = create_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    try:
+        await stop_event.wait()
+    finally:
+        await drain(app)
+        await runner.cleanup()